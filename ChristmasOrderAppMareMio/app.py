@@ -1,8 +1,36 @@
+import bisect
+import csv
+import hashlib
+import heapq
+import json
+import operator
+import os
+import pickle
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+import zipfile
+import numpy as np
 import streamlit as st
 import pandas as pd
-from collections import defaultdict
-from io import BytesIO
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from collections import OrderedDict, defaultdict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from io import BytesIO, TextIOWrapper
 from pathlib import Path
+from openpyxl import Workbook
 from streamlit_option_menu import option_menu
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -21,17 +49,11 @@ st.set_page_config(
 # ═══════════════════════════════════════════════════════════════════════════════
 
 SWISS_CSS = """
-<style>
-    /* ─────────────────────────────────────────────────────────────────────────
-       FONT IMPORT - Inter (Swiss-style sans-serif)
-       ───────────────────────────────────────────────────────────────────────── */
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700;800&display=swap');
-    
     /* ─────────────────────────────────────────────────────────────────────────
        CSS VARIABLES - Design Tokens with PHI Spacing
        ───────────────────────────────────────────────────────────────────────── */
     :root {
-        --font-primary: 'Inter', -apple-system, BlinkMacSystemFont, sans-serif;
+        --font-primary: 'Inter', -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
         
         /* Colors - Minimal palette with Christmas red accent */
         --color-black: #0A0A0A;
@@ -655,10 +677,75 @@ SWISS_CSS = """
         padding: 1rem;
         margin: 0.5rem 0;
     }
-</style>
 """
 
-st.markdown(SWISS_CSS, unsafe_allow_html=True)
+# ═══════════════════════════════════════════════════════════════════════════════
+# ASSET STATICI - BUNDLE CSS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+STATIC_DIR = Path(__file__).resolve().parent / "static"  # servita su app/static/
+STATIC_URL = "app/static"
+BUNDLE_DIR = STATIC_DIR / "dist"  # file generati, nome con hash del contenuto
+INTER_FONT_FILE = STATIC_DIR / "fonts" / "InterVariable.woff2"  # Inter (OFL), self-hosted; senza file: font di sistema
+
+
+def minify_css(css: str) -> str:
+    """Strip comments and redundant whitespace from a stylesheet."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+
+def write_hashed_asset(data: bytes, stem: str, suffix: str, directory: Path) -> str:
+    """Write ``data`` as ``<stem>.<hash><suffix>`` in ``directory``; return the file name.
+
+    Older builds of the same asset are removed so the directory holds one version.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{suffix}"
+    target = directory / name
+    if not target.exists():
+        tmp = directory / f".{name}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, target)
+    for stale in directory.glob(f"{stem}.*{suffix}"):
+        if stale.name != name:
+            stale.unlink(missing_ok=True)
+    return name
+
+
+def inter_font_face(url: str) -> str:
+    return (
+        "@font-face { font-family: 'Inter'; font-style: normal; font-weight: 300 800;"
+        f" font-display: swap; src: url('{url}') format('woff2'); }}"
+    )
+
+
+def font_css(font_url: str | None) -> str:
+    """Inter ``@font-face`` for the self-hosted font at ``font_url``; without it the system fonts apply."""
+    return inter_font_face(font_url) if font_url else ""
+
+
+@st.cache_resource
+def build_style_tag() -> str:
+    """Build the stylesheet once per process and return the markup injected on each rerun.
+
+    With static serving enabled the rerun only carries a ``<link>`` to the hashed
+    bundle; otherwise the minified CSS is inlined.
+    """
+    if not st.get_option("server.enableStaticServing"):
+        return f"<style>{minify_css(SWISS_CSS)}</style>"
+    font = None
+    if INTER_FONT_FILE.exists():
+        font = write_hashed_asset(INTER_FONT_FILE.read_bytes(), "inter", ".woff2", BUNDLE_DIR)
+    css = font_css(font) + SWISS_CSS
+    bundle = write_hashed_asset(minify_css(css).encode("utf-8"), "swiss", ".css", BUNDLE_DIR)
+    return f'<link rel="stylesheet" href="{STATIC_URL}/dist/{bundle}">'
+
+
+st.markdown(build_style_tag(), unsafe_allow_html=True)
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # DATA & CONFIG
@@ -666,6 +753,43 @@ st.markdown(SWISS_CSS, unsafe_allow_html=True)
 
 MENU_FILE = Path("MENU NATALE 2025 A3.pdf")
 
+# Archivio ordini condiviso da tutte le casse (un file SQLite in WAL mode)
+DATA_DIR = Path(__file__).resolve().parent / "data"
+ORDERS_DB_FILE = DATA_DIR / "ordini_natale_2025.sqlite3"
+DB_POOL_SIZE = 4
+FIRST_ORDER_ID = 100
+# Numeri ordine prenotati a blocchi da ogni cassa (niente lock a ogni ordine)
+ORDER_ID_BLOCK_SIZE = 20
+# True → numerazione giornaliera "DD-XXX" (es. 24-007) come nello schema Supabase
+ORDER_NUMBER_DAY_PREFIX = False
+# Journal eventi (audit + ripristino rapido): fsync a lotti, snapshot periodici
+JOURNAL_DIR = DATA_DIR / "journal"
+JOURNAL_FSYNC_EVERY = 16
+JOURNAL_FSYNC_INTERVAL = 0.5  # seconds
+JOURNAL_SNAPSHOT_EVERY = 1000
+# Export di fine stagione: ordini letti dal database a lotti, fogli in streaming
+EXPORT_BATCH_SIZE = 500
+EXPORT_PROGRESS_EVERY = 200  # ordini tra due aggiornamenti di avanzamento
+# Export in background: worker dedicati, file temporanei eliminati dopo il TTL
+EXPORT_WORKERS = 2
+EXPORT_JOBS_DIR = Path(tempfile.gettempdir()) / "maremio-exports"
+EXPORT_JOB_TTL = 30 * 60  # seconds
+# Piano di produzione: grammi per coperto dei piatti a etto senza peso nel menu
+PRODUCTION_GRAMS_PER_PORTION = 200
+# Ritiro al banco: giorni, orari e fasce da 15 minuti con capienza (vassoi, coperti)
+PICKUP_DAYS = ("2025-12-23", "2025-12-24", "2025-12-31")
+PICKUP_HOURS = (("09:00", "13:00"), ("16:00", "19:30"))
+PICKUP_SLOT_MINUTES = 15
+PICKUP_CAPACITY = (20, 60)
+PICKUP_CAPACITY_OVERRIDES: dict[str, tuple[int, int]] = {}  # es. {"2025-12-24 11:00": (30, 90)}
+# Rubrica: telefoni normalizzati in formato E.164 (+39 se manca il prefisso internazionale)
+PHONE_COUNTRY_CODE = "39"
+PHONE_MIN_DIGITS = 6  # sotto questa soglia non è un numero che identifica qualcuno
+PHONE_NATIONAL_MAX_DIGITS = 11  # oltre, le cifre includono già il prefisso internazionale
+# Doppioni in rubrica: punteggio minimo per proporre un'unione, blocchi troppo comuni saltati
+DEDUPE_THRESHOLD = 0.75
+DEDUPE_MAX_BLOCK = 50
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # MENU NATALE 2025 - Struttura completa con prezzi e unità
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -751,6 +875,10 @@ FALLBACK_MENU = {
     for category, data in MENU_2025.items()
 }
 
+# Categorie fisse (ordine del menu) per le colonne categoriali dei DataFrame
+MENU_CATEGORIES = list(MENU_2025)
+MENU_DISHES = list(dict.fromkeys(dish for dishes in FALLBACK_MENU.values() for dish in dishes))
+
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # HELPER FUNCTIONS
@@ -767,14 +895,9 @@ def build_menu() -> dict[str, list[str]]:
     return FALLBACK_MENU
 
 
-def get_dish_info(category: str, dish_name: str) -> dict | None:
+def get_dish_info(category: str, dish_name: str) -> "Dish | None":
     """Get full dish info (price, unit, desc) from menu 2025."""
-    if category not in MENU_2025:
-        return None
-    for item in MENU_2025[category]["items"]:
-        if item["name"] == dish_name:
-            return item
-    return None
+    return MENU_CATALOG.lookup(category, dish_name)
 
 
 def get_category_note(category: str) -> str:
@@ -796,6 +919,93 @@ def format_price(price: float, unit: str) -> str:
     return f"€{price:.2f}{unit_labels.get(unit, '')}"
 
 
+def format_euro(amount: float) -> str:
+    """Format an estimated amount for display."""
+    return f"€{amount:,.2f}"
+
+
+def truncate_label(text: str, keep: int, limit: int) -> str:
+    """Shorten ``text`` to ``keep`` chars + ellipsis when longer than ``limit``."""
+    return text[:keep] + "…" if len(text) > limit else text
+
+
+@dataclass(frozen=True, slots=True)
+class Dish:
+    """One menu entry with its display labels precomputed."""
+
+    dish_id: int
+    category: str
+    name: str
+    price: float
+    unit: str
+    desc: str
+    price_label: str  # e.g. "€6.90/etto"
+    display_name: str  # dish button label
+    short_name: str  # sidebar Top Piatti label
+
+
+class MenuCatalog:
+    """Frozen view of MENU_2025 built once at import.
+
+    Dish IDs are assigned in menu order starting from 1 (new dishes should be
+    appended to keep existing IDs stable). Lookups by ID, by (category, name)
+    and by name are all O(1).
+    """
+
+    def __init__(self, menu: dict):
+        dishes: list[Dish] = []
+        for category, data in menu.items():
+            for item in data["items"]:
+                price = item.get("price", 0)
+                unit = item.get("unit", "etto")
+                dishes.append(
+                    Dish(
+                        dish_id=len(dishes) + 1,
+                        category=category,
+                        name=item["name"],
+                        price=price,
+                        unit=unit,
+                        desc=item.get("desc", ""),
+                        price_label=format_price(price, unit),
+                        display_name=truncate_label(item["name"], 22, 24),
+                        short_name=truncate_label(item["name"], 20, 22),
+                    )
+                )
+        self.dishes: tuple[Dish, ...] = tuple(dishes)
+        self._by_key = {(d.category, d.name): d for d in self.dishes}
+        self._by_name = {d.name: d for d in self.dishes}
+        self._by_category: dict[str, tuple[Dish, ...]] = {
+            category: tuple(d for d in self.dishes if d.category == category) for category in menu
+        }
+
+    def __len__(self) -> int:
+        return len(self.dishes)
+
+    def get(self, dish_id: int) -> Dish | None:
+        if 1 <= dish_id <= len(self.dishes):
+            return self.dishes[dish_id - 1]
+        return None
+
+    def lookup(self, category: str, name: str) -> Dish | None:
+        return self._by_key.get((category, name))
+
+    def by_name(self, name: str) -> Dish | None:
+        return self._by_name.get(name)
+
+    def category_dishes(self, category: str) -> tuple[Dish, ...]:
+        return self._by_category.get(category, ())
+
+    def resolve(self, item: dict) -> Dish | None:
+        """Dish of a cart/order item, by ID when present, else by name."""
+        dish_id = item.get("dish_id")
+        if dish_id is not None:
+            return self.get(dish_id)
+        return self.lookup(item["category"], item["dish"])
+
+
+MENU_CATALOG = MenuCatalog(MENU_2025)
+
+
 def build_default_hot_buttons(menu: dict[str, list[str]]) -> list[dict]:
     """Create default hot buttons from menu."""
     buttons: list[dict] = []
@@ -811,11 +1021,18 @@ def build_default_hot_buttons(menu: dict[str, list[str]]) -> list[dict]:
 def ensure_state(menu: dict[str, list[str]]) -> None:
     """Initialize session state."""
     if "orders" not in st.session_state:
-        st.session_state.orders: list[dict] = []
+        st.session_state.orders = OrderIndex()
+    if "aggregates" not in st.session_state:
+        st.session_state.aggregates = OrderAggregates()
+    st.session_state.setdefault("order_cube", None)  # built on the first Dashboard view
+    if "orders_table" not in st.session_state:
+        st.session_state.orders_table = OrdersTable()
+    if "pickup_index" not in st.session_state:
+        st.session_state.pickup_index = PickupSlotIndex()
+    if "customer_orders" not in st.session_state:
+        st.session_state.customer_orders = CustomerOrdersIndex()
     if "current_items" not in st.session_state:
         st.session_state.current_items: list[dict] = []
-    if "next_order_id" not in st.session_state:
-        st.session_state.next_order_id = 100
     if "menu" not in st.session_state:
         st.session_state.menu = menu
     if "hot_buttons" not in st.session_state:
@@ -828,100 +1045,256 @@ def ensure_state(menu: dict[str, list[str]]) -> None:
     st.session_state.setdefault("form_customer", "")
     st.session_state.setdefault("form_contact", "")
     st.session_state.setdefault("form_note", "")
+    st.session_state.setdefault("form_pickup", "")
+    st.session_state.setdefault("form_customer_id", None)  # Rubrica customer linked to the form
+    st.session_state.setdefault("cart_error", "")
     # UI state
     st.session_state.setdefault("show_customer_form", True)
+    st.session_state.setdefault("selected_portion", 1)
+    st.session_state.setdefault("custom_portion", "")
+    st.session_state.setdefault("export_jobs", [])
     # Rubrica clienti
     if "customers" not in st.session_state:
-        st.session_state.customers: list[dict] = []
+        st.session_state.customers = CustomerIndex()
     st.session_state.setdefault("editing_customer_id", None)
     st.session_state.setdefault("customer_form_name", "")
     st.session_state.setdefault("customer_form_contact", "")
     st.session_state.setdefault("customer_form_note", "")
-    if "next_customer_id" not in st.session_state:
-        st.session_state.next_customer_id = 1
+    st.session_state.setdefault("dedupe_proposals", None)  # None = batch pass not run yet
 
 
-def build_orders_dataframe(orders: list[dict]) -> pd.DataFrame:
-    """Convert orders to DataFrame."""
-    rows: list[dict] = []
-    for order in orders:
-        for item in order["items"]:
-            rows.append(
-                {
-                    "ordine": order["order_id"],
-                    "cliente": order["customer"],
-                    "contatto": order["contact"],
-                    "categoria": item["category"],
-                    "piatto": item["dish"],
-                    "porzione": f"per {item['portion']}",
-                    "vassoi": item["qty"],
-                    "coperti": item["qty"] * item["portion"],
-                    "note": order["note"],
-                },
-            )
-    if not rows:
-        return pd.DataFrame(
-            columns=[
-                "ordine",
-                "cliente",
-                "contatto",
-                "categoria",
-                "piatto",
-                "porzione",
-                "vassoi",
-                "coperti",
-                "note",
-            ],
+ORDERS_COLUMNS = [
+    "ordine",
+    "cliente",
+    "contatto",
+    "categoria",
+    "piatto",
+    "porzione",
+    "vassoi",
+    "coperti",
+    "note",
+]
+
+
+def order_rows(order: dict):
+    """Yield one ``ORDERS_COLUMNS`` tuple per item of ``order``."""
+    for item in order["items"]:
+        yield (
+            order["order_id"],
+            order["customer"],
+            order["contact"],
+            item["category"],
+            item["dish"],
+            item["portion"],
+            item["qty"],
+            item["qty"] * item["portion"],
+            order["note"],
         )
-    return pd.DataFrame(rows)
 
 
-def build_totals(orders: list[dict]) -> tuple[pd.DataFrame, pd.DataFrame]:
-    """Calculate totals and frequency distribution."""
-    totals = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-    freq = defaultdict(lambda: defaultdict(int))
+def menu_categorical(values, categories: list[str]) -> pd.Categorical:
+    """Categorical over fixed menu categories; unknown values are appended, never lost."""
+    extra = sorted(set(values).difference(categories))
+    return pd.Categorical(values, categories=categories + extra)
 
-    for order in orders:
-        for item in order["items"]:
-            totals[item["category"]][item["dish"]][item["portion"]] += item["qty"]
-            freq[item["dish"]][item["qty"]] += 1
-
-    totals_rows: list[dict] = []
-    for category, dishes in totals.items():
-        for dish, portions in dishes.items():
-            for portion, qty in sorted(portions.items()):
-                totals_rows.append(
-                    {
-                        "categoria": category,
-                        "piatto": dish,
-                        "porzione": f"per {portion}",
-                        "vassoi": qty,
-                        "coperti": qty * portion,
-                    },
-                )
 
-    freq_rows: list[dict] = []
-    for dish, counts in freq.items():
-        for qty, count in sorted(counts.items()):
-            freq_rows.append(
+class OrdersTable:
+    """Columnar, versioned item-level orders table.
+
+    One row per order item, stored as one Python list per column. New orders
+    append rows, edited orders overwrite their rows in place (or are masked
+    and re-appended when the item count changed), deleted orders are masked
+    out. ``version`` bumps on every change and ``to_frame()`` only builds a
+    pandas DataFrame when the version moved since the last call. Masked rows
+    are dropped once they outnumber the live ones.
+
+    The frame uses compact dtypes: ``categoria``/``piatto`` are categoricals
+    over the menu (so groupbys run on integer codes), ``cliente``,
+    ``contatto`` and ``note`` are dictionary-encoded, ``porzione``, ``vassoi``
+    and ``coperti`` are small integers.
+    """
+
+    def __init__(self, orders=()):
+        self.columns: dict[str, list] = {name: [] for name in ORDERS_COLUMNS}
+        self.prices: list[float] = []  # unit price stored on each item (0 = none), kept out of the frame
+        self.valid: list[bool] = []
+        self.rows_by_order: dict[int, range] = {}
+        self.dead_rows = 0
+        self.version = 0
+        self._frame: pd.DataFrame | None = None
+        self._frame_version = -1
+        for order in orders:
+            self._append(order)
+
+    def __len__(self) -> int:
+        return len(self.valid) - self.dead_rows
+
+    def _append(self, order: dict) -> None:
+        start = len(self.valid)
+        for row, item in zip(order_rows(order), order["items"]):
+            for name, value in zip(ORDERS_COLUMNS, row):
+                self.columns[name].append(value)
+            self.prices.append(float(item.get("price") or 0))
+            self.valid.append(True)
+        self.rows_by_order[order["order_id"]] = range(start, len(self.valid))
+        self.version += 1
+
+    def _mask(self, order_id: int) -> None:
+        rows = self.rows_by_order.pop(order_id, None)
+        if rows is None:
+            return
+        for row in rows:
+            self.valid[row] = False
+        self.dead_rows += len(rows)
+        self.version += 1
+
+    def upsert_order(self, order: dict) -> None:
+        """Add a new order or patch the rows of an edited one."""
+        rows = self.rows_by_order.get(order["order_id"])
+        if rows is not None and len(rows) == len(order["items"]):
+            for row_idx, row, item in zip(rows, order_rows(order), order["items"]):
+                for name, value in zip(ORDERS_COLUMNS, row):
+                    self.columns[name][row_idx] = value
+                self.prices[row_idx] = float(item.get("price") or 0)
+            self.version += 1
+            return
+        self._mask(order["order_id"])
+        self._append(order)
+        self._maybe_compact()
+
+    def remove_order(self, order_id: int) -> None:
+        self._mask(order_id)
+        self._maybe_compact()
+
+    def _maybe_compact(self) -> None:
+        if self.dead_rows <= len(self):
+            return
+        keep = [i for i, alive in enumerate(self.valid) if alive]
+        remap = {old: new for new, old in enumerate(keep)}
+        self.columns = {name: [values[i] for i in keep] for name, values in self.columns.items()}
+        self.prices = [self.prices[i] for i in keep]
+        self.valid = [True] * len(keep)
+        self.rows_by_order = {
+            order_id: range(remap[rows.start], remap[rows.start] + len(rows)) if rows else range(0)
+            for order_id, rows in self.rows_by_order.items()
+        }
+        self.dead_rows = 0
+
+    def line_prices(self) -> np.ndarray:
+        """Stored unit price of each live row, aligned with ``to_frame()`` (for ``line_amounts``)."""
+        if self.dead_rows:
+            return np.asarray([p for p, alive in zip(self.prices, self.valid) if alive], dtype=float)
+        return np.asarray(self.prices, dtype=float)
+
+    def to_frame(self) -> pd.DataFrame:
+        """DataFrame of the live rows, rebuilt only when the table changed."""
+        if self._frame_version != self.version:
+            columns = self.columns
+            if self.dead_rows:
+                columns = {name: [v for v, alive in zip(values, self.valid) if alive] for name, values in columns.items()}
+            self._frame = pd.DataFrame(
                 {
-                    "piatto": dish,
-                    "qta": qty,
-                    "frequenza": count,
+                    "ordine": np.asarray(columns["ordine"], dtype=np.int32),
+                    "cliente": pd.Categorical(columns["cliente"]),
+                    "contatto": pd.Categorical(columns["contatto"]),
+                    "categoria": menu_categorical(columns["categoria"], MENU_CATEGORIES),
+                    "piatto": menu_categorical(columns["piatto"], MENU_DISHES),
+                    "porzione": np.asarray(columns["porzione"], dtype=np.int16),
+                    "vassoi": np.asarray(columns["vassoi"], dtype=np.int16),
+                    "coperti": np.asarray(columns["coperti"], dtype=np.int32),
+                    "note": pd.Categorical(columns["note"]),
                 },
             )
+            self._frame_version = self.version
+        return self._frame
+
 
-    totals_df = pd.DataFrame(
-        totals_rows,
-        columns=["categoria", "piatto", "porzione", "vassoi", "coperti"],
-    ).sort_values(["categoria", "piatto", "porzione"])
+def build_orders_dataframe(orders: list[dict]) -> pd.DataFrame:
+    """Convert orders to DataFrame."""
+    return OrdersTable(orders).to_frame()
 
-    freq_df = pd.DataFrame(
-        freq_rows,
-        columns=["piatto", "qta", "frequenza"],
-    ).sort_values(["piatto", "qta"])
 
-    return totals_df, freq_df
+class OrderAggregates:
+    """Running totals and quantity frequencies over a set of orders.
+
+    Keeps (categoria, piatto, porzione) → vassoi and (piatto, qta) → frequenza
+    as counters that are patched with the items of the order that changed, so
+    the Totali/Frequenze tables and the sidebar KPIs never re-walk every order.
+    """
+
+    def __init__(self, orders=()):
+        self.totals: dict[tuple[str, str, int], int] = defaultdict(int)
+        self.freq: dict[tuple[str, int], int] = defaultdict(int)
+        self.dish_vassoi: dict[str, int] = defaultdict(int)
+        self.total_vassoi = 0
+        self.total_coperti = 0
+        for order in orders:
+            self.add_order(order)
+
+    def _apply(self, order: dict, sign: int) -> None:
+        for item in order["items"]:
+            qty, portion = item["qty"], item["portion"]
+            self.totals[(item["category"], item["dish"], portion)] += sign * qty
+            self.freq[(item["dish"], qty)] += sign
+            self.dish_vassoi[item["dish"]] += sign * qty
+            self.total_vassoi += sign * qty
+            self.total_coperti += sign * qty * portion
+
+    def add_order(self, order: dict) -> None:
+        self._apply(order, 1)
+
+    def remove_order(self, order: dict | None) -> None:
+        if order is not None:
+            self._apply(order, -1)
+
+    def replace_order(self, previous: dict | None, order: dict) -> None:
+        """Swap the old version of an edited order for the new one."""
+        self.remove_order(previous)
+        self.add_order(order)
+
+    def top_dishes(self, n: int = 5) -> list[tuple[str, int]]:
+        ranked = sorted(((d, q) for d, q in self.dish_vassoi.items() if q > 0), key=lambda dq: dq[1], reverse=True)
+        return ranked[:n]
+
+    def frames(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Totali and Frequenze tables (same shape as ``totals_and_freq_from_df``)."""
+        totals_rows = [
+            {
+                "categoria": category,
+                "piatto": dish,
+                "porzione": portion,
+                "vassoi": qty,
+                "coperti": qty * portion,
+            }
+            for (category, dish, portion), qty in self.totals.items()
+            if qty
+        ]
+        freq_rows = [
+            {"piatto": dish, "qta": qty, "frequenza": count}
+            for (dish, qty), count in self.freq.items()
+            if count
+        ]
+        totals_df = pd.DataFrame(
+            totals_rows,
+            columns=["categoria", "piatto", "porzione", "vassoi", "coperti"],
+        )
+        totals_df["categoria"] = menu_categorical(totals_df["categoria"], MENU_CATEGORIES)
+        totals_df["piatto"] = menu_categorical(totals_df["piatto"], MENU_DISHES)
+        totals_df = totals_df.sort_values(["categoria", "piatto", "porzione"])
+
+        freq_df = pd.DataFrame(
+            freq_rows,
+            columns=["piatto", "qta", "frequenza"],
+        )
+        freq_df["piatto"] = menu_categorical(freq_df["piatto"], MENU_DISHES)
+        freq_df = freq_df.sort_values(["piatto", "qta"])
+
+        return totals_df, freq_df
+
+
+def build_totals(orders: list[dict]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Calculate totals and frequency distribution."""
+    return OrderAggregates(orders).frames()
 
 
 def export_excel(orders_df: pd.DataFrame, totals_df: pd.DataFrame, freq_df: pd.DataFrame) -> BytesIO:
@@ -943,14 +1316,14 @@ def totals_and_freq_from_df(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFram
         return empty_totals, empty_freq
 
     totals_df = (
-        df.groupby(["categoria", "piatto", "porzione"], dropna=False)
+        df.groupby(["categoria", "piatto", "porzione"], dropna=False, observed=True)
         .agg({"vassoi": "sum", "coperti": "sum"})
         .reset_index()
         .sort_values(["categoria", "piatto", "porzione"])
     )
 
     freq_df = (
-        df.groupby(["piatto", "vassoi"])
+        df.groupby(["piatto", "vassoi"], observed=True)
         .size()
         .reset_index(name="frequenza")
         .rename(columns={"vassoi": "qta"})
@@ -961,87 +1334,3023 @@ def totals_and_freq_from_df(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFram
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
-# COMPONENTS
+# PIANO DI PRODUZIONE CUCINA - kg, pezzi e contenitori per piatto
 # ═══════════════════════════════════════════════════════════════════════════════
 
+PRODUCTION_COLUMNS = ["categoria", "piatto", "unita", "vassoi", "coperti", "kg", "pezzi", "piatti", "contenitori"]
+_GRAMS_RE = re.compile(r"(\d+)\s*gr\b", re.IGNORECASE)  # "Tartare tonno 120gr", "~200gr a porzione"
+_SERVES_RE = re.compile(r"per (\d+) persone", re.IGNORECASE)  # "assaggio per 4 persone"
+_CONTAINER_RE = re.compile(r"vaschette da (\d+) porzioni", re.IGNORECASE)
 
-def render_header():
-    """Render compact Swiss-style header."""
-    st.markdown(
-        """
-        <div style="
-            display: flex;
-            align-items: center;
-            justify-content: space-between;
-            padding: 0.5rem 0;
-            border-bottom: 2px solid #0A0A0A;
-            margin-bottom: 0.5rem;
-        ">
-            <div style="display: flex; align-items: baseline; gap: 0.5rem;">
-                <span style="font-size: 1.5rem; font-weight: 800; letter-spacing: -0.03em; color: #0A0A0A;">MARE MIO</span>
-                <span style="font-size: 0.7rem; letter-spacing: 0.1em; text-transform: uppercase; color: #C41E3A;">Gastronomia di Mare</span>
-            </div>
-            <span style="font-size: 1.2rem; font-weight: 300; color: #D4D4D4; letter-spacing: -0.02em;">2025</span>
-        </div>
-        """,
-        unsafe_allow_html=True,
+
+def dish_production_spec(dish: Dish) -> dict:
+    """Kitchen yields of ``dish``, read from its name, description and category note.
+
+    ``grammi`` is per coperto (the category note's weight only applies to etto
+    dishes, which otherwise fall back to PRODUCTION_GRAMS_PER_PORTION),
+    ``persone`` is how many coperti one piece feeds, ``porzioni_contenitore`` is
+    the size of a vaschetta (0 → one container per tray).
+    """
+    note = get_category_note(dish.category)
+    grams = _GRAMS_RE.search(dish.name)
+    if grams is None and dish.unit == "etto":
+        grams = _GRAMS_RE.search(note)
+    serves = _SERVES_RE.search(dish.desc)
+    container = _CONTAINER_RE.search(note)
+    if grams:
+        grams_per_portion = int(grams.group(1))
+    else:
+        grams_per_portion = PRODUCTION_GRAMS_PER_PORTION if dish.unit == "etto" else 0
+    if container:
+        container_portions = int(container.group(1))
+    else:
+        container_portions = 2 if dish.unit == "vaschetta" else 0
+    return {
+        "categoria": dish.category,
+        "piatto": dish.name,
+        "unita": dish.unit,
+        "grammi": grams_per_portion,
+        "persone": int(serves.group(1)) if serves else 1,
+        "porzioni_contenitore": container_portions,
+        "prezzo": dish.price,
+    }
+
+
+DISH_SPECS = {(dish.category, dish.name): dish_production_spec(dish) for dish in MENU_CATALOG.dishes}
+PRODUCTION_SPECS = pd.DataFrame(list(DISH_SPECS.values())).set_index(["categoria", "piatto"])
+
+
+def production_lines(orders_df: pd.DataFrame) -> pd.DataFrame:
+    """Per-line kitchen quantities for an orders frame (same index as ``orders_df``).
+
+    Every line is joined with ``PRODUCTION_SPECS`` and converted to kg
+    (coperti × grammi), pieces (trays × pieces per tray), plates and
+    containers. Dishes not in the menu are treated as etto dishes with the
+    default portion weight.
+    """
+    keys = pd.MultiIndex.from_arrays([orders_df["categoria"].astype(str), orders_df["piatto"].astype(str)])
+    spec = PRODUCTION_SPECS.reindex(keys)
+    unit = spec["unita"].fillna("etto").to_numpy()
+    grams = spec["grammi"].fillna(PRODUCTION_GRAMS_PER_PORTION).to_numpy()
+    serves = spec["persone"].fillna(1).to_numpy()
+    container = spec["porzioni_contenitore"].fillna(0).to_numpy()
+
+    portion = orders_df["porzione"].to_numpy()
+    trays = orders_df["vassoi"].to_numpy()
+    covers = orders_df["coperti"].to_numpy()
+
+    return pd.DataFrame(
+        {
+            "categoria": orders_df["categoria"].array,
+            "piatto": orders_df["piatto"].array,
+            "unita": unit,
+            "vassoi": trays,
+            "coperti": covers,
+            "kg": covers * grams / 1000,
+            "pezzi": np.where(unit == "pezzo", np.ceil(portion / serves) * trays, 0),
+            "piatti": np.where(np.isin(unit, ["piatto", "porzione"]), covers, 0),
+            "contenitori": np.where(
+                container > 0, np.ceil(portion / np.where(container > 0, container, 1)) * trays, trays
+            ),
+        },
+        index=orders_df.index,
     )
 
 
-def render_kpis(orders_df: pd.DataFrame, num_orders: int):
-    """Render KPI metrics."""
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        st.metric(
-            label="Ordini",
-            value=num_orders,
-        )
-    
-    with col2:
-        st.metric(
-            label="Vassoi",
-            value=int(orders_df["vassoi"].sum()) if not orders_df.empty else 0,
-        )
-    
-    with col3:
-        st.metric(
-            label="Coperti",
-            value=int(orders_df["coperti"].sum()) if not orders_df.empty else 0,
-        )
+def production_plan(orders_df: pd.DataFrame) -> pd.DataFrame:
+    """Per-dish production sheet: ``production_lines`` summed per dish in one groupby."""
+    if orders_df.empty:
+        return pd.DataFrame(columns=PRODUCTION_COLUMNS)
 
+    plan = (
+        production_lines(orders_df)
+        .groupby(["categoria", "piatto", "unita"], observed=True, sort=False)
+        .sum()
+        .reset_index()
+        .sort_values(["categoria", "piatto"])
+        .astype({"pezzi": int, "piatti": int, "contenitori": int})
+        .reset_index(drop=True)
+    )
+    plan["kg"] = plan["kg"].round(2)
+    return plan[PRODUCTION_COLUMNS]
 
-def render_section_header(title: str, badge: str = None):
-    """Render a section header."""
-    badge_html = f'<span class="section-badge">{badge}</span>' if badge else ""
-    st.markdown(
-        f"""
-        <div class="section-header">
-            <h3 class="section-title">{title}</h3>
-            {badge_html}
-        </div>
-        """,
-        unsafe_allow_html=True,
+
+def export_production_excel(plan: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        plan.to_excel(writer, index=False, sheet_name="Produzione")
+    return output.getvalue()
+
+
+def lazy_production_export(orders_df: pd.DataFrame, version: int, signature: str = "all"):
+    """Download callable for the production sheet, cached like ``lazy_export``."""
+    key = (version, signature, "produzione")
+    cache = get_export_cache()
+    return lambda: cache.get_or_build(key, lambda: export_production_excel(production_plan(orders_df)))
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# RICAVI STIMATI - importi per riga, ordine, cliente e categoria
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+def line_amounts(orders_df: pd.DataFrame, prices=None) -> pd.Series:
+    """Estimated amount of every order line, vectorised and unit-aware.
+
+    ``etto`` prices are per 100 g of the line's production weight, ``pezzo``
+    per piece, ``porzione``/``piatto`` per plate, ``vaschetta`` per container.
+    Each line uses the unit price stored on its order item (``prices``,
+    aligned with the rows, or the frame's ``prezzo`` column), so past orders
+    keep their own amounts; lines without one (0/NaN) take the current menu
+    price, and dishes no longer in the menu are then priced at 0.
+    """
+    if orders_df.empty:
+        return pd.Series(dtype=float, index=orders_df.index, name="importo")
+    lines = production_lines(orders_df)
+    keys = pd.MultiIndex.from_arrays([orders_df["categoria"].astype(str), orders_df["piatto"].astype(str)])
+    price = PRODUCTION_SPECS["prezzo"].reindex(keys).fillna(0).to_numpy()
+    if prices is None and "prezzo" in orders_df:
+        prices = orders_df["prezzo"]
+    if prices is not None:
+        stored = np.nan_to_num(np.asarray(prices, dtype=float))
+        price = np.where(stored > 0, stored, price)
+    unit = lines["unita"].to_numpy()
+    quantity = np.select(
+        [unit == "etto", unit == "pezzo", np.isin(unit, ["porzione", "piatto"]), unit == "vaschetta"],
+        [lines["kg"].to_numpy() * 10, lines["pezzi"].to_numpy(), lines["piatti"].to_numpy(), lines["contenitori"].to_numpy()],
+        default=0,
     )
+    return pd.Series(np.round(price * quantity, 2), index=orders_df.index, name="importo")
 
 
-def render_sidebar(orders_df: pd.DataFrame, orders_count: int, menu: dict) -> str:
-    """Render the sidebar with navigation and contextual information. Returns selected category."""
-    with st.sidebar:
-        # Brand/Logo compact
-        st.markdown(
-            """
-            <div style="text-align: center; padding: 0.5rem 0; border-bottom: 1px solid #404040; margin-bottom: 0.75rem;">
-                <span style="font-size: 1.5rem;">🎄</span>
-                <span style="font-size: 0.9rem; font-weight: 800; letter-spacing: -0.02em; color: white; margin-left: 0.5rem;">MARE MIO</span>
-                <span style="font-size: 0.55rem; letter-spacing: 0.1em; color: #C41E3A; margin-left: 0.5rem;">2025</span>
-            </div>
-            """,
-            unsafe_allow_html=True
+def items_frame(items: list[dict]) -> pd.DataFrame:
+    """Cart/order items as the columns ``production_lines`` needs, plus their stored ``prezzo``."""
+    return pd.DataFrame(
+        {
+            "categoria": [item["category"] for item in items],
+            "piatto": [item["dish"] for item in items],
+            "porzione": [item["portion"] for item in items],
+            "vassoi": [item["qty"] for item in items],
+            "coperti": [item["qty"] * item["portion"] for item in items],
+            "prezzo": [float(item.get("price") or 0) for item in items],
+        }
+    )
+
+
+def estimate_items(items: list[dict]) -> float:
+    """Estimated total of a cart, with the same unit rules as ``line_amounts``."""
+    if not items:
+        return 0.0
+    return float(line_amounts(items_frame(items)).sum())
+
+
+def revenue_breakdown(orders_df: pd.DataFrame, amounts: pd.Series, by: list[str]) -> pd.DataFrame:
+    """Orders, trays, covers and estimated amount grouped by ``by`` columns."""
+    return (
+        orders_df.assign(importo=amounts.reindex(orders_df.index).fillna(0))
+        .groupby(by, dropna=False, observed=True)
+        .agg(ordini=("ordine", "nunique"), vassoi=("vassoi", "sum"), coperti=("coperti", "sum"), importo=("importo", "sum"))
+        .reset_index()
+        .round({"importo": 2})
+    )
+
+
+@dataclass(frozen=True)
+class RevenueReport:
+    """Line amounts of an orders frame with the per-order totals."""
+
+    lines: pd.Series
+    by_order: dict[int, float]
+
+    @property
+    def total(self) -> float:
+        return float(self.lines.sum())
+
+    def amount(self, frame: pd.DataFrame) -> float:
+        """Estimated amount of a filtered view of the same frame."""
+        return float(self.lines.reindex(frame.index).sum())
+
+
+def revenue_report(orders_df: pd.DataFrame, prices=None) -> RevenueReport:
+    lines = line_amounts(orders_df, prices)
+    by_order = lines.groupby(orders_df["ordine"]).sum().round(2).to_dict() if len(lines) else {}
+    return RevenueReport(lines, by_order)
+
+
+def current_revenue() -> RevenueReport:
+    """Revenue of the session's orders table, recomputed only when its version moved."""
+    table = st.session_state.orders_table
+    cached = st.session_state.get("revenue_cache")
+    if cached is None or cached[0] != table.version:
+        cached = (table.version, revenue_report(table.to_frame(), table.line_prices()))
+        st.session_state.revenue_cache = cached
+    return cached[1]
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# DASHBOARD - FILTRI A BITMAP (cliente, categoria, piatto + intervallo ordini)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+FILTER_COLUMNS = ("cliente", "categoria", "piatto")
+
+
+class FrameFilterIndex:
+    """Filter index over one version of the item-level orders frame.
+
+    Each cliente/categoria/piatto value maps to a boolean row bitmap built
+    from the categorical codes (on first use, then kept with the index), and
+    the rows are argsorted by order ID so an order range is two binary
+    searches. ``select`` ANDs the bitmaps and takes only the matching rows;
+    with no active filter it returns the frame itself, not a copy. Built
+    once per ``OrdersTable.version`` together with the sorted option lists.
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame
+        self._codes = {column: frame[column].cat.codes.to_numpy() for column in FILTER_COLUMNS}
+        self._code_of = {
+            column: {value: code for code, value in enumerate(frame[column].cat.categories)} for column in FILTER_COLUMNS
+        }
+        self._bitmaps: dict[tuple[str, str], np.ndarray] = {}
+        orders = frame["ordine"].to_numpy()
+        self._by_order = np.argsort(orders, kind="stable")
+        self._sorted_orders = orders[self._by_order]
+        # Values actually present, alphabetical ("" customers left out)
+        self.options = {}
+        for column in FILTER_COLUMNS:
+            categories = frame[column].cat.categories
+            present = categories[np.unique(self._codes[column][self._codes[column] >= 0])]
+            self.options[column] = sorted(value for value in present if value)
+
+    @property
+    def order_bounds(self) -> tuple[int, int]:
+        return int(self._sorted_orders[0]), int(self._sorted_orders[-1])
+
+    def bitmap(self, column: str, value: str) -> np.ndarray:
+        """Rows where ``column == value`` (read-only, shared between calls)."""
+        key = (column, value)
+        bitmap = self._bitmaps.get(key)
+        if bitmap is None:
+            code = self._code_of[column].get(value)
+            if code is None:
+                bitmap = np.zeros(len(self.frame), dtype=bool)
+            else:
+                bitmap = self._codes[column] == code
+            bitmap.flags.writeable = False
+            self._bitmaps[key] = bitmap
+        return bitmap
+
+    def select(self, equals: dict[str, str], order_range: tuple[int, int] | None = None) -> pd.DataFrame:
+        """Rows matching every ``column: value`` in ``equals`` and the inclusive order range."""
+        mask = None
+        for column, value in equals.items():
+            bitmap = self.bitmap(column, value)
+            mask = bitmap if mask is None else mask & bitmap
+        if order_range is not None:
+            lo = int(np.searchsorted(self._sorted_orders, order_range[0], side="left"))
+            hi = int(np.searchsorted(self._sorted_orders, order_range[1], side="right"))
+            if lo > 0 or hi < len(self._sorted_orders):
+                if mask is None:
+                    return self.frame.take(np.sort(self._by_order[lo:hi]))
+                in_range = np.zeros(len(self.frame), dtype=bool)
+                in_range[self._by_order[lo:hi]] = True
+                mask = mask & in_range
+        if mask is None:
+            return self.frame
+        return self.frame.take(np.flatnonzero(mask))
+
+
+def current_filter_index() -> FrameFilterIndex:
+    """Dashboard filter index of the session's orders table, rebuilt only when its version moved."""
+    table = st.session_state.orders_table
+    cached = st.session_state.get("filter_index_cache")
+    if cached is None or cached[0] != table.version:
+        cached = (table.version, FrameFilterIndex(table.to_frame()))
+        st.session_state.filter_index_cache = cached
+    return cached[1]
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CUBO ORDINI - aggregati pre-calcolati per il drill-down della Dashboard
+# ═══════════════════════════════════════════════════════════════════════════════
+
+CUBE_DIMENSIONS = ("categoria", "piatto", "porzione", "qta", "cliente", "contatto", "giorno")
+CUBE_FILTERS = ("categoria", "piatto", "cliente", "giorno")
+# Aggregazioni mantenute oltre alle celle di base (tutte le dimensioni)
+CUBOIDS = (
+    (),
+    ("categoria",),
+    ("categoria", "piatto"),
+    ("categoria", "piatto", "porzione", "qta"),
+    ("cliente", "contatto"),
+    ("cliente", "contatto", "categoria"),
+    ("giorno",),
+    ("giorno", "categoria", "piatto"),
+)
+BREAKDOWN_MEASURES = ["ordini", "vassoi", "coperti", "importo"]
+
+
+class _CubeCell:
+    __slots__ = ("righe", "vassoi", "coperti", "importo", "orders")
+
+    def __init__(self):
+        self.righe = 0
+        self.vassoi = 0
+        self.coperti = 0
+        self.importo = 0.0
+        self.orders: dict[int, int] = {}  # order ID → lines of that order in the cell
+
+
+class _Cuboid:
+    """One group-by of the cube, with its cells listed under each filter value."""
+
+    __slots__ = ("dims", "positions", "cells", "by_value")
+
+    def __init__(self, dims: tuple[str, ...]):
+        self.dims = dims
+        self.positions = tuple(CUBE_DIMENSIONS.index(dim) for dim in dims)
+        self.cells: dict[tuple, _CubeCell] = {}
+        self.by_value: dict[str, dict[object, set[tuple]]] = {
+            dim: defaultdict(set) for dim in dims if dim in CUBE_FILTERS
+        }
+
+    def add(self, line: tuple, order_id: int, amount: float, sign: int) -> None:
+        key = tuple(line[pos] for pos in self.positions)
+        cell = self.cells.get(key)
+        if cell is None:
+            if sign < 0:
+                return
+            cell = self.cells[key] = _CubeCell()
+            for dim, index in self.by_value.items():
+                index[key[self.dims.index(dim)]].add(key)
+        portion, qty = line[2], line[3]
+        cell.righe += sign
+        cell.vassoi += sign * qty
+        cell.coperti += sign * qty * portion
+        cell.importo += sign * amount
+        lines = cell.orders.get(order_id, 0) + sign
+        if lines > 0:
+            cell.orders[order_id] = lines
+        else:
+            cell.orders.pop(order_id, None)
+        if cell.righe <= 0:
+            del self.cells[key]
+            for dim, index in self.by_value.items():
+                value = key[self.dims.index(dim)]
+                index[value].discard(key)
+                if not index[value]:
+                    del index[value]
+
+    def load(self, lines: list[tuple], order_ids: list[int], amounts: list[float]) -> None:
+        """Bulk-add lines to an empty cuboid (one pass, index built at the end)."""
+        cells = self.cells
+        project = operator.itemgetter(*self.positions) if len(self.positions) > 1 else None
+        for line, order_id, amount in zip(lines, order_ids, amounts):
+            if project is not None:
+                key = project(line)
+            else:
+                key = tuple(line[pos] for pos in self.positions)
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = _CubeCell()
+            cell.righe += 1
+            cell.vassoi += line[3]
+            cell.coperti += line[3] * line[2]
+            cell.importo += amount
+            cell.orders[order_id] = cell.orders.get(order_id, 0) + 1
+        for dim, index in self.by_value.items():
+            pos = self.dims.index(dim)
+            for key in cells:
+                index[key[pos]].add(key)
+
+    def cost(self, equals: dict) -> int:
+        """Cells a query with ``equals`` would read (smallest filter bucket)."""
+        if not equals:
+            return len(self.cells)
+        return min(len(self.by_value[dim].get(value, ())) for dim, value in equals.items())
+
+    def select(self, equals: dict):
+        if not equals:
+            return self.cells.keys()
+        buckets = sorted((self.by_value[dim].get(value, set()) for dim, value in equals.items()), key=len)
+        return buckets[0].intersection(*buckets[1:])
+
+
+@dataclass(frozen=True)
+class CubeView:
+    """Dashboard figures for one filter combination, read from the cube."""
+
+    ordini: int
+    vassoi: int
+    coperti: int
+    importo: float
+    totals: pd.DataFrame  # same shape as ``totals_and_freq_from_df``
+    freq: pd.DataFrame
+    by_category: pd.DataFrame  # same shape as ``revenue_breakdown``
+    by_customer: pd.DataFrame
+    by_day: pd.DataFrame
+
+
+class OrderCube:
+    """Order lines pre-aggregated over categoria, piatto, formato, cliente and pickup day.
+
+    Besides the base cells (every dimension) the cube keeps the ``CUBOIDS``
+    group-bys, each cell with lines, trays, covers, estimated amount and the
+    orders it came from, so distinct order counts stay exact. All of them are
+    patched with the order that changed, like ``OrderAggregates``. A query
+    reads the cuboid that holds the wanted grouping and filters with the
+    fewest cells under the filter values (a customer's few base cells, the
+    season's handful of per-category cells) and sums those, instead of
+    regrouping item rows; answers are memoised until the next change.
+    """
+
+    def __init__(self, orders=()):
+        self.base = _Cuboid(CUBE_DIMENSIONS)
+        self.cuboids = [self.base, *(_Cuboid(dims) for dims in CUBOIDS)]
+        self._answers: dict[tuple, CubeView] = {}
+        self._apply(orders, 1)
+
+    def __len__(self) -> int:
+        return len(self.base.cells)
+
+    def _apply(self, orders, sign: int) -> None:
+        lines, order_ids, items = [], [], []
+        for order in orders:
+            day = order.get("pickup", "")[:10]
+            for item in order["items"]:
+                lines.append((item["category"], item["dish"], item["portion"], item["qty"], order["customer"], order["contact"], day))
+                order_ids.append(order["order_id"])
+                items.append(item)
+        if not items:
+            return
+        amounts = line_amounts(items_frame(items)).tolist()
+        for cuboid in self.cuboids:
+            if sign > 0 and not cuboid.cells:
+                cuboid.load(lines, order_ids, amounts)
+                continue
+            for line, order_id, amount in zip(lines, order_ids, amounts):
+                cuboid.add(line, order_id, amount, sign)
+        self._answers.clear()
+
+    def add_order(self, order: dict) -> None:
+        self._apply((order,), 1)
+
+    def remove_order(self, order: dict | None) -> None:
+        if order is not None:
+            self._apply((order,), -1)
+
+    def replace_order(self, previous: dict | None, order: dict) -> None:
+        self.remove_order(previous)
+        self.add_order(order)
+
+    def group(self, by: tuple[str, ...], equals: dict[str, str], orders: bool = True) -> dict[tuple, tuple]:
+        """``by`` values → (righe, vassoi, coperti, importo, ordini) of the cells matching ``equals``."""
+        needed = set(by) | set(equals)
+        cuboid = min((c for c in self.cuboids if needed <= set(c.dims)), key=lambda c: c.cost(equals))
+        positions = [cuboid.dims.index(dim) for dim in by]
+        exact = len(cuboid.dims) == len(needed)  # one selected cell per group
+        groups: dict[tuple, list] = {}
+        for key in cuboid.select(equals):
+            cell = cuboid.cells[key]
+            group_key = tuple(key[pos] for pos in positions)
+            acc = groups.get(group_key)
+            if acc is None:
+                orders_seen = cell.orders if exact or not orders else set(cell.orders)
+                groups[group_key] = [cell.righe, cell.vassoi, cell.coperti, cell.importo, orders_seen]
+            else:
+                acc[0] += cell.righe
+                acc[1] += cell.vassoi
+                acc[2] += cell.coperti
+                acc[3] += cell.importo
+                if orders:
+                    acc[4].update(cell.orders)
+        return {
+            key: (righe, vassoi, coperti, round(importo, 2), len(seen) if orders else 0)
+            for key, (righe, vassoi, coperti, importo, seen) in groups.items()
+        }
+
+    def query(self, **equals: str) -> CubeView:
+        """Figures for the lines matching every ``dimension=value`` (categoria, piatto, cliente, giorno)."""
+        signature = tuple(sorted(equals.items()))
+        view = self._answers.get(signature)
+        if view is None:
+            view = self._answers[signature] = self._view(equals)
+        return view
+
+    def _view(self, equals: dict[str, str]) -> CubeView:
+        total = self.group((), equals).get((), (0, 0, 0, 0.0, 0))
+        formats = self.group(("categoria", "piatto", "porzione", "qta"), equals, orders=False)
+        totals: dict[tuple, list[int]] = defaultdict(lambda: [0, 0])
+        freq: dict[tuple, int] = defaultdict(int)
+        for (category, dish, portion, qty), (righe, vassoi, coperti, _, _) in formats.items():
+            totals[(category, dish, portion)][0] += vassoi
+            totals[(category, dish, portion)][1] += coperti
+            freq[(dish, qty)] += righe
+
+        totals_df = pd.DataFrame(
+            [(*key, vassoi, coperti) for key, (vassoi, coperti) in totals.items()],
+            columns=["categoria", "piatto", "porzione", "vassoi", "coperti"],
         )
-        
-        # ─────────────────────────────────────────────────────────────────
-        # NAVIGAZIONE PRINCIPALE - option_menu
+        totals_df["categoria"] = menu_categorical(totals_df["categoria"], MENU_CATEGORIES)
+        totals_df["piatto"] = menu_categorical(totals_df["piatto"], MENU_DISHES)
+        freq_df = pd.DataFrame([(*key, count) for key, count in freq.items()], columns=["piatto", "qta", "frequenza"])
+        freq_df["piatto"] = menu_categorical(freq_df["piatto"], MENU_DISHES)
+        by_category = self._breakdown(("categoria",), equals)
+        by_category["categoria"] = menu_categorical(by_category["categoria"], MENU_CATEGORIES)
+        return CubeView(
+            ordini=total[4],
+            vassoi=total[1],
+            coperti=total[2],
+            importo=total[3],
+            totals=totals_df.sort_values(["categoria", "piatto", "porzione"], ignore_index=True),
+            freq=freq_df.sort_values(["piatto", "qta"], ignore_index=True),
+            by_category=by_category.sort_values("categoria", ignore_index=True),
+            by_customer=self._breakdown(("cliente", "contatto"), equals),
+            by_day=self._breakdown(("giorno",), equals),
+        )
+
+    def _breakdown(self, by: tuple[str, ...], equals: dict[str, str]) -> pd.DataFrame:
+        """Same columns as ``revenue_breakdown``, sorted by ``by``."""
+        rows = [
+            (*key, ordini, vassoi, coperti, importo)
+            for key, (_, vassoi, coperti, importo, ordini) in self.group(by, equals).items()
+        ]
+        return pd.DataFrame(rows, columns=[*by, *BREAKDOWN_MEASURES]).sort_values(list(by), ignore_index=True)
+
+
+def current_order_cube() -> OrderCube:
+    """The session's cube, built on first use and then patched by ``sync_state_from_store``."""
+    if st.session_state.order_cube is None:
+        st.session_state.order_cube = OrderCube(st.session_state.orders)
+    return st.session_state.order_cube
+
+
+def current_cube_view(equals: dict[str, str], order_range: tuple[int, int]) -> CubeView:
+    """Dashboard figures for the active filters.
+
+    The whole season is answered by the session cube; a narrowed order range
+    gets a cube of just those orders, kept until the data or the range moves.
+    """
+    low, high = current_filter_index().order_bounds
+    if order_range[0] <= low and order_range[1] >= high:
+        return current_order_cube().query(**equals)
+    version = st.session_state.orders_table.version
+    cached = st.session_state.get("range_cube_cache")
+    if cached is None or cached[:2] != (version, tuple(order_range)):
+        start, end = order_range
+        cube = OrderCube(order for order in st.session_state.orders if start <= order["order_id"] <= end)
+        cached = (version, tuple(order_range), cube)
+        st.session_state.range_cube_cache = cached
+    return cached[2].query(**equals)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# EXPORT EXCEL - GENERAZIONE LAZY E CACHE
+# ═══════════════════════════════════════════════════════════════════════════════
+
+EXPORT_CACHE_SIZE = 8  # file generati tenuti in memoria (LRU, condivisi tra sessioni)
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+class ExportCache:
+    """Thread-safe LRU of generated export files keyed by ``(data_version, signature)``.
+
+    Entries for an older data version are dropped as soon as a newer one is
+    stored, and a build for a version older than the newest stored one is
+    returned but not kept. The cache never holds more than ``max_entries``
+    files. Builds run under a per-key lock: concurrent clicks on the same
+    export share one build, different exports build in parallel.
+    """
+
+    def __init__(self, max_entries: int = EXPORT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._building: dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()  # guards _entries/_building only, never held while building
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def _cached(self, key: tuple):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            return None
+
+    def get_or_build(self, key: tuple, build) -> bytes:
+        data = self._cached(key)
+        if data is not None:
+            return data
+        with self._lock:
+            key_lock = self._building.setdefault(key, threading.Lock())
+        with key_lock:
+            # Another click may have finished the same build while we waited
+            data = self._cached(key)
+            if data is not None:
+                return data
+            try:
+                data = build()
+            except BaseException:
+                with self._lock:
+                    self._building.pop(key, None)
+                raise
+            with self._lock:
+                self._building.pop(key, None)
+                if all(k[0] <= key[0] for k in self._entries):
+                    for stale in [k for k in self._entries if k[0] < key[0]]:
+                        del self._entries[stale]
+                    self._entries[key] = data
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            return data
+
+
+@st.cache_resource
+def get_export_cache() -> ExportCache:
+    return ExportCache()
+
+
+def lazy_export(orders_df: pd.DataFrame, version: int, signature: str = "all", fmt: str = "xlsx"):
+    """Zero-argument ``data`` callable for ``st.download_button``.
+
+    The file is built only when the button is clicked (on Streamlit's
+    download thread) and reused while ``(version, signature, fmt)`` is
+    unchanged. ``orders_df`` is the frame snapshot taken at render time.
+    """
+    key = (version, signature, fmt)
+    exporter = EXPORTERS[fmt]
+    cache = get_export_cache()
+    return lambda: cache.get_or_build(key, lambda: exporter.build(export_tables(orders_df)))
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# EXPORT MULTI-FORMATO - REGISTRO (Excel, CSV gzip, Parquet, Arrow IPC, NDJSON)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+def export_tables(orders_df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """The tables every export carries: ordini, totali, frequenze."""
+    totals_df, freq_df = totals_and_freq_from_df(orders_df)
+    return {"ordini": orders_df, "totali": totals_df, "frequenze": freq_df}
+
+
+def arrow_table(frame: pd.DataFrame) -> pa.Table:
+    """Arrow view of a frame: numeric buffers are reused, categoricals become dictionaries."""
+    return pa.Table.from_pandas(frame, preserve_index=False)
+
+
+def encode_csv_gz(frame: pd.DataFrame) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.CompressedOutputStream(sink, "gzip") as out:
+        pa_csv.write_csv(arrow_table(frame), out)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_parquet(frame: pd.DataFrame) -> bytes:
+    sink = pa.BufferOutputStream()
+    pq.write_table(arrow_table(frame), sink, compression="zstd")
+    return sink.getvalue().to_pybytes()
+
+
+def encode_arrow_ipc(frame: pd.DataFrame) -> bytes:
+    table = arrow_table(frame)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_ndjson(frame: pd.DataFrame) -> bytes:
+    return frame.to_json(orient="records", lines=True, force_ascii=False).encode("utf-8")
+
+
+@dataclass(frozen=True)
+class Exporter:
+    """Export format: ``build(tables)`` returns the whole file for ``export_tables()``."""
+
+    label: str
+    suffix: str
+    mime: str
+    build: Callable[[dict[str, pd.DataFrame]], bytes]
+
+
+def table_bundle(encode, member_suffix: str):
+    """``build`` for single-table formats: a zip with one ``<table><member_suffix>`` per table."""
+
+    def build(tables: dict[str, pd.DataFrame]) -> bytes:
+        output = BytesIO()
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+            for name, frame in tables.items():
+                archive.writestr(f"{name}{member_suffix}", encode(frame))
+        return output.getvalue()
+
+    return build
+
+
+# Formato → exporter; per aggiungerne uno basta registrarlo qui
+EXPORTERS: dict[str, Exporter] = {
+    "xlsx": Exporter("Excel", ".xlsx", XLSX_MIME, lambda t: export_excel(t["ordini"], t["totali"], t["frequenze"]).getvalue()),
+    "csv.gz": Exporter("CSV (gzip)", ".csv.zip", "application/zip", table_bundle(encode_csv_gz, ".csv.gz")),
+    "parquet": Exporter("Parquet", ".parquet.zip", "application/zip", table_bundle(encode_parquet, ".parquet")),
+    "arrow": Exporter("Arrow IPC", ".arrow.zip", "application/zip", table_bundle(encode_arrow_ipc, ".arrow")),
+    "ndjson": Exporter("NDJSON", ".ndjson.zip", "application/zip", table_bundle(encode_ndjson, ".ndjson")),
+}
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# EXPORT DELTA - SOLO GLI ORDINI CAMBIATI DALL'ULTIMO EXPORT
+# ═══════════════════════════════════════════════════════════════════════════════
+
+DELTA_CONSUMER = "cucina"  # destinatario di default (watermark salvato nel database)
+DELTA_LABELS = {"created": "nuovo", "updated": "modificato", "deleted": "eliminato"}
+DELTA_COLUMNS = ["modifica", "modificato_il", *ORDERS_COLUMNS]
+
+
+def delta_frame(changes: list[dict]) -> pd.DataFrame:
+    """One row per item of created/updated orders, one bare row per deleted order."""
+    rows = []
+    for change in changes:
+        head = (DELTA_LABELS[change["change"]], change["changed_at"])
+        if change["order"] is None:
+            rows.append(head + (change["order_id"],) + (None,) * (len(ORDERS_COLUMNS) - 1))
+        else:
+            rows.extend(head + row for row in order_rows(change["order"]))
+    return pd.DataFrame(rows, columns=DELTA_COLUMNS)
+
+
+def export_delta_excel(frame: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        frame.to_excel(writer, index=False, sheet_name="Modifiche")
+    return output.getvalue()
+
+
+def lazy_delta_export(store: "OrderStore", consumer: str = DELTA_CONSUMER, repeat: bool = False):
+    """Download callable: changes since ``consumer``'s watermark, which then moves forward.
+
+    Not cached: every click delivers (and acknowledges) a new window. With
+    ``repeat`` the last window is built again and the watermark stays put.
+    """
+
+    def build() -> bytes:
+        if repeat:
+            _, changes = store.last_order_delta(consumer)
+        else:
+            _, changes = store.take_order_delta(consumer)
+        return export_delta_excel(delta_frame(changes))
+
+    return build
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# EXPORT STREAMING - XLSX a memoria costante (openpyxl write-only)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+@dataclass(frozen=True)
+class ExportStats:
+    """Outcome of a streaming export."""
+
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else float(self.rows)
+
+
+def excel_sheet_title(name: str) -> str:
+    """Sheet title Excel accepts: no ``[]:*?/\\`` and at most 31 characters."""
+    return re.sub(r"[\[\]:*?/\\]", " ", name)[:31] or "Foglio"
+
+
+def write_excel_stream(orders, target, per_category: bool = True, progress=None) -> ExportStats:
+    """Write the season workbook from an order iterator using write-only sheets.
+
+    ``orders`` is consumed once (e.g. ``OrderStore.iter_orders()``). Rows go
+    straight to each sheet's temp file and totals are kept as counters, so
+    memory is bounded by the menu size, not by the number of orders.
+    ``target`` is a path or a writable binary stream (``BytesIO``, an open
+    file, an HTTP response body). Sheets: Ordini, one per category (if
+    ``per_category``), Totali, Frequenze. ``progress`` is called with the
+    number of orders written every ``EXPORT_PROGRESS_EVERY`` orders.
+    """
+    started = time.perf_counter()
+    workbook = Workbook(write_only=True)
+    orders_sheet = workbook.create_sheet("Ordini")
+    orders_sheet.append(ORDERS_COLUMNS)
+    category_sheets = {}
+
+    def category_sheet(category: str):
+        if category not in category_sheets:
+            sheet = workbook.create_sheet(excel_sheet_title(category))
+            sheet.append(ORDERS_COLUMNS)
+            category_sheets[category] = sheet
+        return category_sheets[category]
+
+    if per_category:
+        for category in MENU_CATEGORIES:
+            category_sheet(category)
+
+    aggregates = OrderAggregates()
+    rows = 0
+    for count, order in enumerate(orders, 1):
+        aggregates.add_order(order)
+        for row in order_rows(order):
+            orders_sheet.append(row)
+            if per_category:
+                category_sheet(row[3]).append(row)
+            rows += 1
+        if progress is not None and count % EXPORT_PROGRESS_EVERY == 0:
+            progress(count)
+
+    for title, frame in zip(("Totali", "Frequenze"), aggregates.frames()):
+        sheet = workbook.create_sheet(title)
+        sheet.append(list(frame.columns))
+        for record in frame.itertuples(index=False, name=None):
+            sheet.append(record)
+            rows += 1
+
+    workbook.save(target)
+    return ExportStats(rows, time.perf_counter() - started)
+
+
+@contextmanager
+def open_binary_target(target):
+    """Yield a binary stream for a path (opened and closed here) or an existing stream."""
+    if isinstance(target, (str, Path)):
+        with open(target, "wb") as handle:
+            yield handle
+    else:
+        yield target
+
+
+def write_csv_stream(orders, target, progress=None) -> ExportStats:
+    """Write one ``ORDERS_COLUMNS`` row per item as UTF-8 CSV (with BOM, for Excel).
+
+    Same contract as ``write_excel_stream``: one pass over ``orders``,
+    ``target`` is a path or a writable binary stream.
+    """
+    started = time.perf_counter()
+    with open_binary_target(target) as raw:
+        text = TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+        writer = csv.writer(text)
+        writer.writerow(ORDERS_COLUMNS)
+        rows = 0
+        for count, order in enumerate(orders, 1):
+            for row in order_rows(order):
+                writer.writerow(row)
+                rows += 1
+            if progress is not None and count % EXPORT_PROGRESS_EVERY == 0:
+                progress(count)
+        text.flush()
+        text.detach()
+    return ExportStats(rows, time.perf_counter() - started)
+
+
+def lazy_season_export(store: "OrderStore"):
+    """Download callable for the full season workbook, streamed from the store on click.
+
+    The workbook is written to an anonymous temp file and handed over as an
+    open file, not kept in ``ExportCache``: the season grows with every
+    order and a cached copy would hold the whole file in memory.
+    """
+
+    def build():
+        output = tempfile.TemporaryFile()
+        write_excel_stream(store.iter_orders(), output)
+        output.seek(0)
+        return output
+
+    return build
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# EXPORT IN BACKGROUND - JOB CON AVANZAMENTO E ANNULLAMENTO
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class ExportCancelled(Exception):
+    """Raised inside a running export when the user cancelled the job."""
+
+
+@dataclass
+class ExportJob:
+    """One background export. Written by the worker thread, read by the UI."""
+
+    job_id: str
+    kind: str
+    label: str
+    path: Path
+    file_name: str
+    mime: str
+    status: str = "queued"  # queued → running → done | failed | cancelled
+    progress: float = 0.0
+    error: str = ""
+    stats: ExportStats | None = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def report(self, fraction: float) -> None:
+        """Progress hook for the writers; aborts the export once cancelled."""
+        if self.cancel_event.is_set():
+            raise ExportCancelled(self.job_id)
+        self.progress = min(max(fraction, 0.0), 1.0)
+
+
+# Tipo di export → (etichetta, estensione, MIME, writer in streaming)
+EXPORT_JOB_KINDS = {
+    "xlsx": ("Excel stagione", ".xlsx", XLSX_MIME, write_excel_stream),
+    "csv": ("CSV ordini", ".csv", "text/csv", write_csv_stream),
+}
+
+
+class ExportJobManager:
+    """Runs exports on a small thread pool so the till's script thread stays free.
+
+    Finished files are kept in ``directory`` and removed ``ttl`` seconds after
+    the job ended (leftovers of a previous process are swept the same way).
+    """
+
+    def __init__(self, directory: Path, workers: int = EXPORT_WORKERS, ttl: float = EXPORT_JOB_TTL):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+        self._jobs: dict[str, ExportJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, store: "OrderStore") -> ExportJob:
+        self.evict_expired()
+        label, suffix, mime, writer = EXPORT_JOB_KINDS[kind]
+        job_id = uuid.uuid4().hex[:12]
+        stamp = datetime.now().strftime("%Y%m%d-%H%M")
+        job = ExportJob(
+            job_id,
+            kind,
+            label,
+            self.directory / f"{job_id}{suffix}",
+            f"ordini_natale_2025_{stamp}{suffix}",
+            mime,
+        )
+        with self._lock:
+            self._jobs[job_id] = job
+        self._executor.submit(self._run, job, writer, store)
+        return job
+
+    def _run(self, job: ExportJob, writer, store: "OrderStore") -> None:
+        if job.cancel_event.is_set():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            return
+        job.status = "running"
+        orders = None
+        try:
+            # Inside the try: a locked or broken archive fails the job instead of the worker
+            total = max(store.count_orders(), 1)
+            orders = store.iter_orders()
+            job.stats = writer(orders, job.path, progress=lambda done: job.report(done / total))
+        except ExportCancelled:
+            job.status = "cancelled"
+            job.path.unlink(missing_ok=True)
+        except Exception as exc:
+            job.status = "failed"
+            job.error = str(exc)
+            job.path.unlink(missing_ok=True)
+        else:
+            job.progress = 1.0
+            job.status = "done"
+        finally:
+            if orders is not None:
+                orders.close()
+            job.finished_at = time.time()
+
+    def get(self, job_id: str) -> ExportJob | None:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> None:
+        job = self._jobs.get(job_id)
+        if job is not None and job.active:
+            job.cancel_event.set()
+
+    def evict_expired(self, now: float | None = None) -> None:
+        """Drop finished jobs older than ``ttl`` together with their files."""
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [
+                job for job in self._jobs.values()
+                if job.finished_at is not None and now - job.finished_at > self.ttl
+            ]
+            for job in expired:
+                del self._jobs[job.job_id]
+                job.path.unlink(missing_ok=True)
+            live = {job.path for job in self._jobs.values()}
+        for path in self.directory.iterdir():
+            try:
+                stale = path not in live and now - path.stat().st_mtime > self.ttl
+            except FileNotFoundError:
+                continue
+            if stale:
+                path.unlink(missing_ok=True)
+
+    def shutdown(self) -> None:
+        for job in list(self._jobs.values()):
+            job.cancel_event.set()
+        self._executor.shutdown(wait=True)
+
+
+@st.cache_resource
+def get_export_jobs() -> ExportJobManager:
+    return ExportJobManager(EXPORT_JOBS_DIR)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# INDICE ORDINI - lookup O(1) per ID, ordine di inserimento
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+class OrderIndex:
+    """Session collection of orders keyed by ``order_id``.
+
+    Backed by a single insertion-ordered dict: lookup, update and delete are
+    O(1) (CPython tombstones deleted slots and compacts on resize), iteration
+    is oldest-first and ``reversed()`` walks newest-first for the order list
+    without copying. Updating an order keeps its original position.
+    """
+
+    def __init__(self, orders=()):
+        self._by_id: dict[int, dict] = {}
+        for order in orders:
+            self.upsert(order)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self._by_id
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __reversed__(self):
+        return reversed(self._by_id.values())
+
+    def get(self, order_id: int) -> dict | None:
+        return self._by_id.get(order_id)
+
+    def upsert(self, order: dict) -> dict | None:
+        """Insert or replace an order; returns the previous version, if any."""
+        previous = self._by_id.get(order["order_id"])
+        self._by_id[order["order_id"]] = order
+        return previous
+
+    def remove(self, order_id: int) -> dict | None:
+        """Delete an order; returns it, or None if it was not indexed."""
+        return self._by_id.pop(order_id, None)
+
+    def ids(self) -> list[int]:
+        return list(self._by_id)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# RUBRICA - INDICE DI RICERCA (prefissi + trigrammi)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+SEARCH_RESULTS_LIMIT = 50
+RUBRICA_SUGGESTIONS = 5  # clienti proposti nel form ordine mentre si cerca
+
+
+def fold_text(text: str) -> str:
+    """Lowercase, accents removed, punctuation turned into spaces (``"Niccolò D'Amico"`` → ``"niccolo d amico"``)."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^0-9a-z@.]+", " ", stripped).split())
+
+
+def phone_digits(contact: str) -> str:
+    """Digits of a phone-like contact ("" for e-mails and free text)."""
+    if "@" in contact:
+        return ""
+    return re.sub(r"\D", "", contact)
+
+
+def phone_key(contact: str) -> str:
+    """E.164-style key of a phone contact, e.g. ``"333 123 4567"``, ``"+39 333-1234567"``
+    and ``"0039 3331234567"`` all give ``"+393331234567"`` ("" when not a phone number)."""
+    digits = phone_digits(contact)
+    if len(digits) < PHONE_MIN_DIGITS:
+        return ""
+    if contact.lstrip().startswith("+"):
+        return f"+{digits}"
+    if digits.startswith("00"):
+        return f"+{digits[2:]}"
+    if len(digits) > PHONE_NATIONAL_MAX_DIGITS and digits.startswith(PHONE_COUNTRY_CODE):
+        return f"+{digits}"
+    return f"+{PHONE_COUNTRY_CODE}{digits}"
+
+
+def search_tokens(customer: dict) -> set[str]:
+    """Searchable tokens of a customer: folded name/contact words plus the phone digits."""
+    tokens = set(fold_text(customer["name"]).split())
+    contact = customer.get("contact", "")
+    tokens.update(fold_text(contact).split())
+    digits = phone_digits(contact)
+    if digits:
+        tokens.add(digits)
+    return tokens
+
+
+def trigrams(token: str) -> set[str]:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class _TrieNode:
+    __slots__ = ("children", "ids", "ends")
+
+    def __init__(self):
+        self.children: dict[str, _TrieNode] = {}
+        self.ids: set[int] = set()  # customers with a token under this prefix
+        self.ends: set[int] = set()  # customers with a token equal to this prefix
+
+
+class CustomerIndex:
+    """Rubrica customers keyed by ID, with an incremental search index.
+
+    Iterates like the customer list it replaces (insertion order). Every
+    customer's tokens (``search_tokens``) go into a prefix trie whose nodes
+    hold the IDs below them, and into trigram postings for matches inside a
+    token (surname parts, the middle of a phone number). ``upsert``/``remove``
+    patch both structures for one customer, so the index is never rebuilt
+    while the till is open.
+    """
+
+    def __init__(self, customers=()):
+        self._by_id: dict[int, dict] = {}
+        self._tokens: dict[int, set[str]] = {}
+        self._rank: dict[int, tuple[int, str]] = {}  # tie-break: shorter, then alphabetical name
+        self._trie = _TrieNode()
+        self._postings: dict[str, set[int]] = defaultdict(set)
+        self._by_phone: dict[str, set[int]] = defaultdict(set)  # phone_key → customer IDs
+        for customer in customers:
+            self.upsert(customer)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __contains__(self, customer_id: int) -> bool:
+        return customer_id in self._by_id
+
+    def get(self, customer_id: int) -> dict | None:
+        return self._by_id.get(customer_id)
+
+    def upsert(self, customer: dict) -> dict | None:
+        """Insert or replace a customer (keeping its place); returns the previous version, if any."""
+        customer_id = customer["id"]
+        previous = self._by_id.get(customer_id)
+        if previous is not None:
+            self._unindex(customer_id, previous)
+        self._by_id[customer_id] = customer
+        tokens = search_tokens(customer)
+        self._tokens[customer_id] = tokens
+        self._rank[customer_id] = (len(customer["name"]), customer["name"].casefold())
+        key = phone_key(customer.get("contact", ""))
+        if key:
+            self._by_phone[key].add(customer_id)
+        for token in tokens:
+            node = self._trie
+            for ch in token:
+                node = node.children.setdefault(ch, _TrieNode())
+                node.ids.add(customer_id)
+            node.ends.add(customer_id)
+            for gram in trigrams(token):
+                self._postings[gram].add(customer_id)
+        return previous
+
+    def remove(self, customer_id: int) -> dict | None:
+        """Drop a customer from the index; returns it, or None if it was not indexed."""
+        customer = self._by_id.pop(customer_id, None)
+        if customer is not None:
+            self._unindex(customer_id, customer)
+        return customer
+
+    def _unindex(self, customer_id: int, customer: dict) -> None:
+        del self._rank[customer_id]
+        key = phone_key(customer.get("contact", ""))
+        if key:
+            self._by_phone[key].discard(customer_id)
+            if not self._by_phone[key]:
+                del self._by_phone[key]
+        for token in self._tokens.pop(customer_id):
+            path = [self._trie]
+            for ch in token:
+                node = path[-1].children.get(ch)
+                if node is None:
+                    break
+                node.ids.discard(customer_id)
+                path.append(node)
+            path[-1].ends.discard(customer_id)
+            for parent, ch in zip(reversed(path[:-1]), reversed(token[:len(path) - 1])):
+                if parent.children[ch].ids:
+                    break
+                del parent.children[ch]
+            for gram in trigrams(token):
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.discard(customer_id)
+                    if not postings:
+                        del self._postings[gram]
+
+    def same_phone(self, contact: str, exclude: int | None = None) -> list[dict]:
+        """Customers whose phone normalizes to the same key as ``contact`` (one hash lookup)."""
+        key = phone_key(contact)
+        if not key:
+            return []
+        return [self._by_id[cid] for cid in sorted(self._by_phone.get(key, ())) if cid != exclude]
+
+    def match(self, name: str, contact: str) -> int | None:
+        """ID of the one customer with this name and contact (accent/case-insensitive), else None."""
+        folded_name = fold_text(name)
+        digits = phone_digits(contact)
+        same = [
+            customer["id"]
+            for customer in self.search(name)
+            if fold_text(customer["name"]) == folded_name
+            and (phone_digits(customer["contact"]) == digits if digits else fold_text(customer["contact"]) == fold_text(contact))
+        ]
+        return same[0] if len(same) == 1 else None
+
+    def _prefix_node(self, prefix: str) -> _TrieNode | None:
+        node = self._trie
+        for ch in prefix:
+            node = node.children.get(ch)
+            if node is None:
+                return None
+        return node
+
+    def _substring_ids(self, part: str, exclude: set[int]) -> set[int]:
+        """IDs with a token containing ``part`` (3+ chars), leaving out ``exclude``."""
+        grams = sorted(trigrams(part), key=lambda gram: len(self._postings.get(gram, ())))
+        ids = self._postings.get(grams[0], set()) - exclude
+        for gram in grams[1:]:
+            if not ids:
+                break
+            ids &= self._postings.get(gram, set())
+        return {cid for cid in ids if any(part in token for token in self._tokens[cid])}
+
+    def _part_scores(self, part: str) -> dict[int, int]:
+        node = self._prefix_node(part)
+        scores = {}
+        if node is not None:
+            scores = dict.fromkeys(node.ids, 2)
+            scores.update(dict.fromkeys(node.ends, 3))
+        if len(part) >= 3:
+            scores.update(dict.fromkeys(self._substring_ids(part, scores.keys()), 1))
+        return scores
+
+    def search(self, query: str, limit: int = SEARCH_RESULTS_LIMIT) -> list[dict]:
+        """Customers matching every word of ``query``, best first.
+
+        A word scores 3 on a token it equals, 2 on a token it starts and, from
+        three characters on, 1 on a token it appears in; a phone typed with
+        spaces or ``+39`` is searched as one run of digits. Ties go to the
+        shorter, then alphabetical name.
+        """
+        parts = fold_text(query).split()
+        digits = phone_digits(query)
+        if len(digits) >= 3 and not any(ch.isalpha() for ch in query):
+            parts = [digits]
+        if not parts:
+            return []
+        scores = self._part_scores(parts[0])
+        for part in parts[1:]:
+            if not scores:
+                break
+            part_scores = self._part_scores(part)
+            scores = {cid: score + part_scores[cid] for cid, score in scores.items() if cid in part_scores}
+        rank = self._rank
+        best = heapq.nsmallest(limit, scores, key=lambda cid: (-scores[cid], rank[cid]))
+        return [self._by_id[cid] for cid in best]
+
+
+@dataclass(frozen=True, slots=True)
+class CustomerStats:
+    orders: int = 0
+    last_order_at: str = ""  # ISO timestamp of the newest order ("" = none)
+    spend: float = 0.0  # estimated, see ``line_amounts``
+
+
+class CustomerOrdersIndex:
+    """Rubrica customer ID → linked order IDs, with running count and spend.
+
+    Patched with the order that changed, like ``OrderAggregates``: the
+    Rubrica reads each customer's stats with one dict lookup, and a renamed
+    customer keeps its orders because the join is on ``customer_id``, not
+    on the name typed in the order.
+    """
+
+    def __init__(self, orders=(), amounts: dict[int, float] | None = None):
+        self.by_customer: dict[int, dict[int, tuple[str, float]]] = defaultdict(dict)
+        self._stats: dict[int, CustomerStats] = {}
+        amounts = amounts or {}
+        for order in orders:
+            self.add_order(order, amounts.get(order["order_id"]))
+
+    def _refresh(self, customer_id: int) -> None:
+        linked = self.by_customer.get(customer_id)
+        if not linked:
+            self.by_customer.pop(customer_id, None)
+            self._stats.pop(customer_id, None)
+            return
+        self._stats[customer_id] = CustomerStats(
+            orders=len(linked),
+            last_order_at=max(created_at for created_at, _ in linked.values()),
+            spend=round(sum(amount for _, amount in linked.values()), 2),
+        )
+
+    def add_order(self, order: dict, amount: float | None = None) -> None:
+        customer_id = order.get("customer_id")
+        if customer_id is None:
+            return
+        if amount is None:
+            amount = estimate_items(order["items"])
+        self.by_customer[customer_id][order["order_id"]] = (order.get("created_at", ""), amount)
+        self._refresh(customer_id)
+
+    def remove_order(self, order: dict | None) -> None:
+        if order is None or order.get("customer_id") is None:
+            return
+        customer_id = order["customer_id"]
+        self.by_customer.get(customer_id, {}).pop(order["order_id"], None)
+        self._refresh(customer_id)
+
+    def replace_order(self, previous: dict | None, order: dict) -> None:
+        self.remove_order(previous)
+        self.add_order(order)
+
+    def stats(self, customer_id: int) -> CustomerStats:
+        return self._stats.get(customer_id, CustomerStats())
+
+    def order_ids(self, customer_id: int) -> list[int]:
+        return list(self.by_customer.get(customer_id, ()))
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# RUBRICA - DOPPIONI (blocking + punteggio di somiglianza)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+@dataclass(frozen=True, slots=True)
+class MergeProposal:
+    keep: int  # customer that survives (most orders, then fullest name, then oldest)
+    duplicates: tuple[int, ...]
+    score: float  # weakest link that joined the group
+
+
+def name_similarity(a: str, b: str) -> float:
+    """0-1 similarity of two names: shared words (``"rossi"`` is all of ``"Rossi"``
+    and half of ``"Mario Rossi"``) averaged with the edit ratio of the sorted words."""
+    words_a, words_b = set(fold_text(a).split()), set(fold_text(b).split())
+    if not words_a or not words_b:
+        return 0.0
+    overlap = len(words_a & words_b) / min(len(words_a), len(words_b))
+    ratio = SequenceMatcher(None, " ".join(sorted(words_a)), " ".join(sorted(words_b))).ratio()
+    return (overlap + ratio) / 2
+
+
+def duplicate_score(a: dict, b: dict) -> float:
+    """How likely two Rubrica entries are the same person (0-1).
+
+    The same phone is strong evidence on its own; two different phones make
+    a merge unlikely however close the names are.
+    """
+    names = name_similarity(a["name"], b["name"])
+    phone_a, phone_b = phone_key(a.get("contact", "")), phone_key(b.get("contact", ""))
+    if phone_a and phone_a == phone_b:
+        return 0.6 + 0.4 * names
+    if phone_a and phone_b:
+        return 0.5 * names
+    return 0.8 * names
+
+
+def dedupe_proposals(
+    customers,
+    order_counts: Callable[[int], int] | None = None,
+    threshold: float = DEDUPE_THRESHOLD,
+    max_block: int = DEDUPE_MAX_BLOCK,
+) -> list[MergeProposal]:
+    """Groups of Rubrica entries that look like one customer, for review.
+
+    Only customers sharing a block (same phone key, or a name word of 3+
+    letters) are compared, so the pass stays far from all-pairs; blocks
+    larger than ``max_block`` (a very common first name) are skipped. Pairs
+    scoring at least ``threshold`` are joined transitively (union-find), but
+    never into a group holding two different phone numbers.
+    """
+    by_id = {customer["id"]: customer for customer in customers}
+    blocks: dict[str, set[int]] = defaultdict(set)
+    for customer_id, customer in by_id.items():
+        key = phone_key(customer.get("contact", ""))
+        if key:
+            blocks[key].add(customer_id)
+        for word in fold_text(customer["name"]).split():
+            if len(word) >= 3:
+                blocks[word].add(customer_id)
+
+    parent = {customer_id: customer_id for customer_id in by_id}
+    weakest: dict[int, float] = {}
+    phones = {customer_id: {phone_key(c.get("contact", ""))} - {""} for customer_id, c in by_id.items()}
+
+    def find(customer_id: int) -> int:
+        while parent[customer_id] != customer_id:
+            parent[customer_id] = parent[parent[customer_id]]
+            customer_id = parent[customer_id]
+        return customer_id
+
+    compared: set[tuple[int, int]] = set()
+    for block in blocks.values():
+        if len(block) < 2 or len(block) > max_block:
+            continue
+        members = sorted(block)
+        for i, a in enumerate(members):
+            for b in members[i + 1:]:
+                if (a, b) in compared:
+                    continue
+                compared.add((a, b))
+                score = duplicate_score(by_id[a], by_id[b])
+                if score < threshold:
+                    continue
+                root_a, root_b = find(a), find(b)
+                if root_a == root_b or (phones[root_a] and phones[root_b] and phones[root_a] != phones[root_b]):
+                    continue  # already together, or the groups have different phones
+                parent[root_b] = root_a
+                phones[root_a] |= phones.pop(root_b)
+                weakest[root_a] = min(score, weakest.get(root_a, 1.0), weakest.pop(root_b, 1.0))
+
+    groups: dict[int, list[int]] = defaultdict(list)
+    for customer_id in by_id:
+        groups[find(customer_id)].append(customer_id)
+    counts = order_counts or (lambda customer_id: 0)
+    proposals = []
+    for root, members in groups.items():
+        if len(members) < 2:
+            continue
+        keep = min(members, key=lambda cid: (-counts(cid), -len(fold_text(by_id[cid]["name"]).split()), cid))
+        duplicates = tuple(sorted(cid for cid in members if cid != keep))
+        proposals.append(MergeProposal(keep, duplicates, round(weakest[root], 2)))
+    proposals.sort(key=lambda proposal: (-proposal.score, proposal.keep))
+    return proposals
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# RITIRI - FASCE DA 15 MINUTI CON CAPIENZA
+# ═══════════════════════════════════════════════════════════════════════════════
+
+WEEKDAYS_IT = ("Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom")
+PICK_LIST_COLUMNS = ["ritiro", "ordine", "cliente", "contatto", "vassoi", "coperti", "piatti", "note"]
+
+
+def pickup_calendar(days=PICKUP_DAYS, hours=PICKUP_HOURS, minutes: int = PICKUP_SLOT_MINUTES) -> tuple[str, ...]:
+    """Every pickup slot as ``"YYYY-MM-DD HH:MM"`` (sorts by time), in time order."""
+    slots = []
+    for day in days:
+        for open_at, close_at in hours:
+            start = datetime.fromisoformat(f"{day} {open_at}")
+            end = datetime.fromisoformat(f"{day} {close_at}")
+            while start < end:
+                slots.append(f"{start:%Y-%m-%d %H:%M}")
+                start += timedelta(minutes=minutes)
+    return tuple(slots)
+
+
+PICKUP_SLOTS = pickup_calendar()
+
+
+def format_pickup(slot: str) -> str:
+    """Short label of a slot, e.g. ``Mer 24/12 11:00`` (``—`` when unset)."""
+    if not slot:
+        return "—"
+    when = datetime.fromisoformat(slot)
+    return f"{WEEKDAYS_IT[when.weekday()]} {when:%d/%m %H:%M}"
+
+
+def slot_capacity(slot: str) -> tuple[int, int]:
+    """(vassoi, coperti) a slot can take."""
+    return PICKUP_CAPACITY_OVERRIDES.get(slot, PICKUP_CAPACITY)
+
+
+def order_load(order: dict | None) -> tuple[int, int]:
+    """(vassoi, coperti) of an order or cart."""
+    if not order:
+        return 0, 0
+    items = order["items"]
+    return sum(item["qty"] for item in items), sum(item["qty"] * item["portion"] for item in items)
+
+
+class PickupSlotIndex:
+    """Trays and covers booked per pickup slot, patched order by order.
+
+    Like ``OrderAggregates`` it is updated with the order that changed, so
+    ``load(slot)`` is a dict lookup the order form can afford on every rerun.
+    Booked slots are kept sorted (``bisect``) with their order IDs, so the
+    counter pick list walks them in time order without sorting any orders.
+    """
+
+    def __init__(self, orders=()):
+        self.trays: dict[str, int] = defaultdict(int)
+        self.covers: dict[str, int] = defaultdict(int)
+        self.orders_by_slot: dict[str, dict[int, None]] = {}
+        self._slots: list[str] = []
+        for order in orders:
+            self.add_order(order)
+
+    def _apply(self, order: dict, sign: int) -> None:
+        slot = order.get("pickup", "")
+        if not slot:
+            return
+        trays, covers = order_load(order)
+        self.trays[slot] += sign * trays
+        self.covers[slot] += sign * covers
+        booked = self.orders_by_slot.get(slot)
+        if sign > 0:
+            if booked is None:
+                booked = self.orders_by_slot[slot] = {}
+                bisect.insort(self._slots, slot)
+            booked[order["order_id"]] = None
+        elif booked is not None:
+            booked.pop(order["order_id"], None)
+            if not booked:
+                del self.orders_by_slot[slot]
+                del self._slots[bisect.bisect_left(self._slots, slot)]
+
+    def add_order(self, order: dict) -> None:
+        self._apply(order, 1)
+
+    def remove_order(self, order: dict | None) -> None:
+        if order is not None:
+            self._apply(order, -1)
+
+    def replace_order(self, previous: dict | None, order: dict) -> None:
+        self.remove_order(previous)
+        self.add_order(order)
+
+    def load(self, slot: str, exclude: dict | None = None) -> tuple[int, int]:
+        """(vassoi, coperti) booked in ``slot``, minus ``exclude`` (the order being edited)."""
+        trays, covers = self.trays.get(slot, 0), self.covers.get(slot, 0)
+        if exclude is not None and exclude.get("pickup") == slot:
+            own_trays, own_covers = order_load(exclude)
+            trays, covers = trays - own_trays, covers - own_covers
+        return trays, covers
+
+    def fits(self, slot: str, trays: int, covers: int, exclude: dict | None = None) -> bool:
+        booked_trays, booked_covers = self.load(slot, exclude)
+        max_trays, max_covers = slot_capacity(slot)
+        return booked_trays + trays <= max_trays and booked_covers + covers <= max_covers
+
+    def nearest_free(
+        self, desired: str, trays: int, covers: int, exclude: dict | None = None, slots: tuple[str, ...] = PICKUP_SLOTS
+    ) -> str | None:
+        """Closest slot to ``desired`` with room for the order (later wins a tie), or None."""
+        start = bisect.bisect_left(slots, desired)
+        for offset in range(len(slots) + 1):
+            for position in (start + offset, start - offset) if offset else (start,):
+                if 0 <= position < len(slots) and self.fits(slots[position], trays, covers, exclude):
+                    return slots[position]
+        return None
+
+    def pick_list(self, orders: "OrderIndex", day: str = ""):
+        """Yield ``(slot, order)`` in pickup order, optionally for one ``YYYY-MM-DD`` day."""
+        lo = bisect.bisect_left(self._slots, day) if day else 0
+        for slot in self._slots[lo:]:
+            if day and not slot.startswith(day):
+                break
+            for order_id in self.orders_by_slot[slot]:
+                order = orders.get(order_id)
+                if order is not None:
+                    yield slot, order
+
+
+def pick_list_frame(index: PickupSlotIndex, orders: "OrderIndex", day: str = "") -> pd.DataFrame:
+    """Counter pick list: one row per order, in pickup order."""
+    rows = []
+    for slot, order in index.pick_list(orders, day):
+        trays, covers = order_load(order)
+        rows.append((
+            format_pickup(slot),
+            order.get("order_number", order["order_id"]),
+            order["customer"],
+            order["contact"],
+            trays,
+            covers,
+            "; ".join(f"{item['qty']}× {item['dish']} (per {item['portion']})" for item in order["items"]),
+            order["note"],
+        ))
+    return pd.DataFrame(rows, columns=PICK_LIST_COLUMNS)
+
+
+def export_pick_list_excel(frame: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        frame.to_excel(writer, index=False, sheet_name="Ritiri")
+    return output.getvalue()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# JOURNAL EVENTI - append-only, snapshot e replay
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+def empty_journal_state() -> dict:
+    """State rebuilt from the journal: orders and customers keyed by ID."""
+    return {"orders": {}, "customers": {}}
+
+
+def apply_journal_event(state: dict, event: dict) -> None:
+    """Apply one journal event to a state dict in place."""
+    kind = event["kind"]
+    data = event["data"]
+    if kind == "order_saved":
+        order = state["orders"].setdefault(data["order_id"], {})
+        # Events written before the payloads carried timestamps fall back to
+        # the event time, so a restore keeps the original chronology
+        order.setdefault("created_at", data.get("created_at", event.get("ts", "")))
+        order["updated_at"] = data.get("updated_at", event.get("ts", ""))
+        order.update(data)
+    elif kind == "order_deleted":
+        state["orders"].pop(data["order_id"], None)
+    elif kind == "customer_saved":
+        state["customers"][data["id"]] = dict(data)
+    elif kind == "customer_deleted":
+        state["customers"].pop(data["id"], None)
+
+
+class OrderJournal:
+    """Append-only log of every order/customer mutation.
+
+    Events are JSON lines in numbered segments (``segment-000001.jsonl``...),
+    flushed to disk in batches of ``fsync_every`` events or after
+    ``fsync_interval`` seconds, whichever comes first. Every
+    ``snapshot_every`` events the current state is pickled as
+    ``snapshot-<n+1>.pickle`` and a new segment starts, so startup only loads
+    the latest snapshot and replays the short tail after it. Old segments are
+    kept: together with their snapshots they allow replaying to any point in
+    time (``state_at``). One writer process per journal directory.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        fsync_every: int = JOURNAL_FSYNC_EVERY,
+        fsync_interval: float = JOURNAL_FSYNC_INTERVAL,
+        snapshot_every: int = JOURNAL_SNAPSHOT_EVERY,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self._lock = threading.RLock()
+        self._file = None
+        self._pending = 0
+        self._timer: threading.Timer | None = None
+        self.segment, self.seq, self.state, self.segment_events = self._recover()
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Files
+    # ─────────────────────────────────────────────────────────────────────────
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.directory / f"segment-{segment:06d}.jsonl"
+
+    def _snapshot_path(self, segment: int) -> Path:
+        return self.directory / f"snapshot-{segment:06d}.pickle"
+
+    def _numbers(self, prefix: str) -> list[int]:
+        return sorted(int(p.stem.split("-")[1]) for p in self.directory.glob(f"{prefix}-*.*") if not p.name.endswith(".tmp"))
+
+    @staticmethod
+    def _scan_events(path: Path):
+        """Yield ``(event, end_offset)`` for each complete line, stopping at a torn one."""
+        if not path.exists():
+            return
+        with open(path, "rb") as fh:
+            offset = 0
+            for line in fh:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                offset += len(line)
+                yield event, offset
+
+    @classmethod
+    def _read_events(cls, path: Path):
+        """Yield events of a segment, ignoring a torn last line after a crash."""
+        for event, _ in cls._scan_events(path):
+            yield event
+
+    def has_history(self) -> bool:
+        """True once anything (an event or a snapshot) has been written."""
+        return bool(self._numbers("snapshot") or self._numbers("segment"))
+
+    def _load_snapshot(self, segment: int) -> dict:
+        with open(self._snapshot_path(segment), "rb") as fh:
+            return pickle.load(fh)
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Recovery
+    # ─────────────────────────────────────────────────────────────────────────
+
+    def _recover(self) -> tuple[int, int, dict, int]:
+        """Latest snapshot + replay of the segments written after it.
+
+        Also returns how many events the current segment already holds, so
+        compaction still happens every ``snapshot_every`` events across restarts.
+        """
+        snapshots = self._numbers("snapshot")
+        if snapshots:
+            snapshot = self._load_snapshot(snapshots[-1])
+            segment, seq, state = snapshot["segment"], snapshot["seq"], snapshot["state"]
+        else:
+            segment, seq, state = 1, 0, empty_journal_state()
+        segment_events = 0
+        for number in [n for n in self._numbers("segment") if n >= segment]:
+            path, end, segment_events = self._segment_path(number), 0, 0
+            for event, end in self._scan_events(path):
+                apply_journal_event(state, event)
+                seq = event["seq"]
+                segment_events += 1
+            if path.stat().st_size > end:
+                # Cut the torn tail, or new events would be glued onto it
+                with open(path, "r+b") as fh:
+                    fh.truncate(end)
+                    os.fsync(fh.fileno())
+            segment = number
+        return segment, seq, state, segment_events
+
+    def state_at(self, when: datetime) -> dict:
+        """Rebuild orders/customers as they were at ``when`` (audit trail)."""
+        cutoff = when.isoformat(timespec="microseconds")
+        with self._lock:
+            self.flush()
+            start, state = 1, empty_journal_state()
+            for number in self._numbers("snapshot"):
+                snapshot = self._load_snapshot(number)
+                if snapshot["ts"] > cutoff:
+                    break
+                start, state = number, snapshot["state"]
+            for number in [n for n in self._numbers("segment") if n >= start]:
+                for event in self._read_events(self._segment_path(number)):
+                    if event["ts"] > cutoff:
+                        return state
+                    apply_journal_event(state, event)
+        return state
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Writing
+    # ─────────────────────────────────────────────────────────────────────────
+
+    def append(self, kind: str, data: dict) -> None:
+        """Record one mutation; it reaches the disk with the next batch fsync."""
+        with self._lock:
+            self.seq += 1
+            event = {"seq": self.seq, "ts": _now_iso(), "kind": kind, "data": data}
+            if self._file is None:
+                self._file = open(self._segment_path(self.segment), "ab")
+            self._file.write(json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n")
+            apply_journal_event(self.state, event)
+            self._pending += 1
+            self.segment_events += 1
+            if self._pending >= self.fsync_every:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.fsync_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            if self.segment_events >= self.snapshot_every:
+                self.compact()
+
+    def flush(self) -> None:
+        """Write buffered events and fsync the current segment."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._file is not None and self._pending:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._pending = 0
+
+    def compact(self) -> None:
+        """Snapshot the current state and start a new segment."""
+        with self._lock:
+            self.flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            next_segment = self.segment + 1
+            path = self._snapshot_path(next_segment)
+            tmp = path.with_name(path.name + ".tmp")
+            with open(tmp, "wb") as fh:
+                pickle.dump(
+                    {"segment": next_segment, "seq": self.seq, "ts": _now_iso(), "state": self.state},
+                    fh,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, path)
+            self.segment = next_segment
+            self.segment_events = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# PERSISTENZA - ORDER STORE (SQLite WAL)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Reservation counters recomputed from the orders (season bucket + pickup day)
+RESERVATIONS_BACKFILL = """
+    INSERT INTO dish_reservations (category, dish, day, reserved)
+        SELECT category, dish, '', SUM(qty * portion) FROM order_items GROUP BY category, dish;
+    INSERT INTO dish_reservations (category, dish, day, reserved)
+        SELECT i.category, i.dish, substr(o.pickup_slot, 1, 10), SUM(i.qty * i.portion)
+        FROM order_items i JOIN orders o ON o.order_id = i.order_id
+        WHERE o.pickup_slot != ''
+        GROUP BY i.category, i.dish, substr(o.pickup_slot, 1, 10);
+"""
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version)
+STORE_MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS orders (
+        order_id INTEGER PRIMARY KEY,
+        customer TEXT NOT NULL DEFAULT '',
+        contact TEXT NOT NULL DEFAULT '',
+        note TEXT NOT NULL DEFAULT '',
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at, order_id);
+    CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders(customer);
+
+    CREATE TABLE IF NOT EXISTS order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL REFERENCES orders(order_id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        dish TEXT NOT NULL,
+        portion INTEGER NOT NULL,
+        qty INTEGER NOT NULL,
+        price REAL NOT NULL DEFAULT 0,
+        unit TEXT NOT NULL DEFAULT 'etto'
+    );
+    CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id, position);
+    CREATE INDEX IF NOT EXISTS idx_order_items_dish ON order_items(category, dish);
+
+    CREATE TABLE IF NOT EXISTS customers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        contact TEXT NOT NULL DEFAULT '',
+        note TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX IF NOT EXISTS idx_customers_name ON customers(name);
+
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', 0);
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS sequences (
+        name TEXT PRIMARY KEY,
+        next_value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO sequences (name, next_value)
+        SELECT 'orders', COALESCE(MAX(order_id) + 1, {FIRST_ORDER_ID}) FROM orders;
+    ALTER TABLE orders ADD COLUMN order_number TEXT NOT NULL DEFAULT '';
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS changes (
+        version INTEGER PRIMARY KEY,
+        entity TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        changed_at TEXT NOT NULL
+    );
+    """,
+    """
+    ALTER TABLE order_items ADD COLUMN dish_id INTEGER;
+    CREATE INDEX IF NOT EXISTS idx_order_items_dish_id ON order_items(dish_id);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS export_watermarks (
+        consumer TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        exported_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_changes_entity ON changes(entity, entity_id, version);
+    """,
+    """
+    ALTER TABLE orders ADD COLUMN pickup_slot TEXT NOT NULL DEFAULT '';
+    CREATE INDEX IF NOT EXISTS idx_orders_pickup ON orders(pickup_slot);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dish_caps (
+        category TEXT NOT NULL,
+        dish TEXT NOT NULL,
+        day TEXT NOT NULL DEFAULT '',
+        cap INTEGER NOT NULL,
+        PRIMARY KEY (category, dish, day)
+    );
+    CREATE TABLE IF NOT EXISTS dish_reservations (
+        category TEXT NOT NULL,
+        dish TEXT NOT NULL,
+        day TEXT NOT NULL DEFAULT '',
+        reserved INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (category, dish, day)
+    );
+    """ + RESERVATIONS_BACKFILL,
+    """
+    ALTER TABLE orders ADD COLUMN customer_id INTEGER REFERENCES customers(id) ON DELETE SET NULL;
+    UPDATE orders SET customer_id = COALESCE(
+        (SELECT MIN(c.id) FROM customers c WHERE c.name = orders.customer AND c.contact = orders.contact),
+        (SELECT MIN(c.id) FROM customers c WHERE c.name = orders.customer)
+    );
+    CREATE INDEX IF NOT EXISTS idx_orders_customer_id ON orders(customer_id);
+    """,
+    """
+    ALTER TABLE export_watermarks ADD COLUMN delivered_from INTEGER NOT NULL DEFAULT 0;
+    UPDATE export_watermarks SET delivered_from = version;
+    """,
+]
+
+
+def _now_iso() -> str:
+    """Current local time as ISO string (sortable, microsecond precision)."""
+    return datetime.now().isoformat(timespec="microseconds")
+
+
+def order_reservations(items: list[dict], pickup: str = "") -> dict[tuple[str, str, str], int]:
+    """Covers an order reserves per (category, dish, day).
+
+    Every line counts in the season bucket (day ``""``) and, when the order
+    has a pickup slot, in the bucket of its pickup day (``YYYY-MM-DD``).
+    """
+    reserved: dict[tuple[str, str, str], int] = defaultdict(int)
+    days = ("", pickup[:10]) if pickup else ("",)
+    for item in items:
+        for day in days:
+            reserved[(item["category"], item["dish"], day)] += int(item["qty"]) * int(item["portion"])
+    return dict(reserved)
+
+
+class SoldOutError(Exception):
+    """An order would exceed a dish cap; nothing was written.
+
+    ``shortages`` lists ``(category, dish, day, remaining)`` for every cap
+    that the order would break (``remaining`` = covers still available).
+    """
+
+    def __init__(self, shortages: list[tuple[str, str, str, int]]):
+        super().__init__(", ".join(f"{dish} ({day or 'stagione'}): {left} left" for _, dish, day, left in shortages))
+        self.shortages = shortages
+
+
+class ConnectionPool:
+    """Fixed-size pool of SQLite connections shared by all sessions of the process."""
+
+    def __init__(self, path: Path, size: int = DB_POOL_SIZE):
+        self.path = Path(path)
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            self._pool.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=10,
+            check_same_thread=False,
+            isolation_level=None,  # explicit BEGIN/COMMIT only
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for reads."""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def snapshot(self):
+        """Borrow a connection inside a read transaction: one consistent view for long reads."""
+        with self.connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                conn.execute("COMMIT")
+
+    @contextmanager
+    def transaction(self):
+        """Borrow a connection inside a write transaction (BEGIN IMMEDIATE)."""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self) -> None:
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+class OrderStore:
+    """Durable orders/customers store shared by every till.
+
+    Orders and customers are returned as the same dicts the UI has always used
+    (``order_id``/``customer``/``contact``/``note``/``items`` and
+    ``id``/``name``/``contact``/``note``). Every write bumps ``data_version`` so
+    sessions know when their cached copy is stale, and is recorded in the
+    optional ``OrderJournal`` just before its COMMIT.
+    """
+
+    # The store outlives script reruns (st.cache_resource) while the script's
+    # classes are redefined on each run: callers catch ``store.SoldOutError``.
+    SoldOutError = SoldOutError
+
+    def __init__(self, path: Path, pool_size: int = DB_POOL_SIZE, journal: OrderJournal | None = None):
+        self.pool = ConnectionPool(path, pool_size)
+        self.journal = journal
+        self._migrate()
+
+    def _migrate(self) -> None:
+        with self.pool.transaction() as conn:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            for version, script in enumerate(STORE_MIGRATIONS[current:], start=current + 1):
+                for statement in script.split(";"):
+                    if statement.strip():
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+
+    def close(self) -> None:
+        self.pool.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def _record(self, kind: str, data: dict) -> None:
+        """Journal a write from inside its transaction, ahead of the COMMIT.
+
+        A failed journal write rolls the change back, so the journal never
+        misses a committed write; at worst it holds the event of a write
+        whose COMMIT then failed. Events still waiting for the batch fsync
+        (``JOURNAL_FSYNC_EVERY``/``JOURNAL_FSYNC_INTERVAL``) can be lost on a
+        power cut, the same window as before.
+        """
+        if self.journal is not None:
+            self.journal.append(kind, data)
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Versioning
+    # ─────────────────────────────────────────────────────────────────────────
+
+    def data_version(self) -> int:
+        """Monotonic counter bumped by every committed write."""
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()
+        return int(row[0])
+
+    @staticmethod
+    def _bump_version(conn: sqlite3.Connection, entity: str, entity_id: int, kind: str) -> int:
+        """Bump ``data_version`` and log which row changed under the new version."""
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'data_version'")
+        version = int(conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0])
+        conn.execute(
+            "INSERT INTO changes (version, entity, entity_id, kind, changed_at) VALUES (?, ?, ?, ?, ?)",
+            (version, entity, entity_id, kind, _now_iso()),
+        )
+        return version
+
+    def changes_since(self, version: int) -> list[tuple[str, int, str]]:
+        """(entity, entity_id, kind) of every write after ``version``, oldest first.
+
+        ``entity`` is ``"order"``, ``"customer"`` or ``"all"`` (bulk restore);
+        ``kind`` is ``"saved"`` or ``"deleted"``.
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT entity, entity_id, kind FROM changes WHERE version > ? ORDER BY version",
+                (version,),
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Orders
+    # ─────────────────────────────────────────────────────────────────────────
+
+    @staticmethod
+    def _order_from_rows(order_row: sqlite3.Row, item_rows: list[sqlite3.Row]) -> dict:
+        return {
+            "order_id": order_row["order_id"],
+            "order_number": order_row["order_number"] or str(order_row["order_id"]),
+            "customer": order_row["customer"],
+            "contact": order_row["contact"],
+            "note": order_row["note"],
+            "pickup": order_row["pickup_slot"],
+            "customer_id": order_row["customer_id"],
+            "created_at": order_row["created_at"],
+            "updated_at": order_row["updated_at"],
+            "items": [
+                {
+                    "dish_id": item["dish_id"],
+                    "category": item["category"],
+                    "dish": item["dish"],
+                    "portion": item["portion"],
+                    "qty": item["qty"],
+                    "price": item["price"],
+                    "unit": item["unit"],
+                }
+                for item in item_rows
+            ],
+        }
+
+    def list_orders(self) -> list[dict]:
+        """All orders in creation order."""
+        with self.pool.connection() as conn:
+            order_rows = conn.execute(
+                "SELECT * FROM orders ORDER BY created_at, order_id"
+            ).fetchall()
+            item_rows = conn.execute(
+                "SELECT * FROM order_items ORDER BY order_id, position"
+            ).fetchall()
+        items_by_order = defaultdict(list)
+        for item in item_rows:
+            items_by_order[item["order_id"]].append(item)
+        return [self._order_from_rows(row, items_by_order[row["order_id"]]) for row in order_rows]
+
+    @staticmethod
+    def _items_by_order(conn: sqlite3.Connection, order_ids: list[int]) -> dict:
+        placeholders = ",".join("?" * len(order_ids))
+        items_by_order = defaultdict(list)
+        for item in conn.execute(
+            f"SELECT * FROM order_items WHERE order_id IN ({placeholders}) ORDER BY order_id, position",
+            order_ids,
+        ):
+            items_by_order[item["order_id"]].append(item)
+        return items_by_order
+
+    def iter_orders(self, batch_size: int = EXPORT_BATCH_SIZE):
+        """Stream orders in creation order, ``batch_size`` at a time, from one read snapshot."""
+        with self.pool.snapshot() as conn:
+            cursor = conn.execute("SELECT * FROM orders ORDER BY created_at, order_id")
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                items_by_order = self._items_by_order(conn, [row["order_id"] for row in batch])
+                for row in batch:
+                    yield self._order_from_rows(row, items_by_order[row["order_id"]])
+
+    def count_orders(self) -> int:
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def get_order(self, order_id: int) -> dict | None:
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            if row is None:
+                return None
+            items = conn.execute(
+                "SELECT * FROM order_items WHERE order_id = ? ORDER BY position", (order_id,)
+            ).fetchall()
+        return self._order_from_rows(row, items)
+
+    def reserve_block(self, sequence: str, size: int, start: int = 1) -> range:
+        """Atomically lease ``size`` consecutive numbers from a named sequence."""
+        with self.pool.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO sequences (name, next_value) VALUES (?, ?)",
+                (sequence, start),
+            )
+            first = int(
+                conn.execute("SELECT next_value FROM sequences WHERE name = ?", (sequence,)).fetchone()[0]
+            )
+            conn.execute(
+                "UPDATE sequences SET next_value = ? WHERE name = ?",
+                (first + size, sequence),
+            )
+        return range(first, first + size)
+
+    @staticmethod
+    def _write_items(conn: sqlite3.Connection, order_id: int, items: list[dict]) -> None:
+        conn.execute("DELETE FROM order_items WHERE order_id = ?", (order_id,))
+        conn.executemany(
+            """
+            INSERT INTO order_items (order_id, position, dish_id, category, dish, portion, qty, price, unit)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    order_id,
+                    position,
+                    item.get("dish_id"),
+                    item["category"],
+                    item["dish"],
+                    int(item["portion"]),
+                    int(item["qty"]),
+                    float(item.get("price", 0)),
+                    item.get("unit", "etto"),
+                )
+                for position, item in enumerate(items)
+            ],
+        )
+
+    def create_order(
+        self,
+        order_id: int,
+        customer: str,
+        contact: str,
+        note: str,
+        items: list[dict],
+        order_number: str = "",
+        pickup: str = "",
+        customer_id: int | None = None,
+    ) -> int:
+        """Insert a new order under a number handed out by ``OrderNumberAllocator``.
+
+        ``pickup`` is the ``"YYYY-MM-DD HH:MM"`` pickup slot ("" = not booked),
+        ``customer_id`` links the order to its Rubrica customer (None = walk-in).
+        """
+        now = _now_iso()
+        with self.pool.transaction() as conn:
+            conn.execute(
+                """
+                INSERT INTO orders (order_id, order_number, customer, contact, note, pickup_slot, customer_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (order_id, order_number, customer, contact, note, pickup, customer_id, now, now),
+            )
+            self._write_items(conn, order_id, items)
+            self._reserve(conn, {}, order_reservations(items, pickup))
+            self._bump_version(conn, "order", order_id, "saved")
+            self._record(
+                "order_saved",
+                {
+                    "order_id": order_id,
+                    "order_number": order_number or str(order_id),
+                    "customer": customer,
+                    "contact": contact,
+                    "note": note,
+                    "pickup": pickup,
+                    "customer_id": customer_id,
+                    "created_at": now,
+                    "updated_at": now,
+                    "items": [dict(item) for item in items],
+                },
+            )
+        return order_id
+
+    def update_order(
+        self,
+        order_id: int,
+        customer: str,
+        contact: str,
+        note: str,
+        items: list[dict],
+        pickup: str = "",
+        customer_id: int | None = None,
+    ) -> bool:
+        """Replace header and items of an existing order. Returns False if it no longer exists."""
+        now = _now_iso()
+        with self.pool.transaction() as conn:
+            previous = self._stored_reservations(conn, order_id)
+            cursor = conn.execute(
+                """
+                UPDATE orders SET customer = ?, contact = ?, note = ?, pickup_slot = ?, customer_id = ?, updated_at = ?
+                WHERE order_id = ?
+                """,
+                (customer, contact, note, pickup, customer_id, now, order_id),
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._write_items(conn, order_id, items)
+            self._reserve(conn, previous, order_reservations(items, pickup))
+            self._bump_version(conn, "order", order_id, "saved")
+            self._record(
+                "order_saved",
+                {
+                    "order_id": order_id,
+                    "customer": customer,
+                    "contact": contact,
+                    "note": note,
+                    "pickup": pickup,
+                    "customer_id": customer_id,
+                    "updated_at": now,
+                    "items": [dict(item) for item in items],
+                },
+            )
+        return True
+
+    def delete_order(self, order_id: int) -> bool:
+        with self.pool.transaction() as conn:
+            previous = self._stored_reservations(conn, order_id)
+            cursor = conn.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
+            if cursor.rowcount == 0:
+                return False
+            self._reserve(conn, previous, {})
+            self._bump_version(conn, "order", order_id, "deleted")
+            self._record("order_deleted", {"order_id": order_id})
+        return True
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Dish caps (limiti di produzione) and reservation counters
+    # ─────────────────────────────────────────────────────────────────────────
+
+    @staticmethod
+    def _stored_reservations(conn: sqlite3.Connection, order_id: int) -> dict[tuple[str, str, str], int]:
+        row = conn.execute("SELECT pickup_slot FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        if row is None:
+            return {}
+        items = conn.execute("SELECT category, dish, portion, qty FROM order_items WHERE order_id = ?", (order_id,))
+        return order_reservations([dict(item) for item in items], row["pickup_slot"])
+
+    @staticmethod
+    def _reserve(conn: sqlite3.Connection, before: dict, after: dict) -> None:
+        """Move the reservation counters from ``before`` to ``after`` inside the caller's transaction.
+
+        Raises ``SoldOutError`` (rolling the whole write back) when a counter
+        that grows ends up above its cap.
+        """
+        delta = {key: after.get(key, 0) - before.get(key, 0) for key in before.keys() | after.keys()}
+        delta = {key: change for key, change in delta.items() if change}
+        if not delta:
+            return
+        conn.executemany(
+            """
+            INSERT INTO dish_reservations (category, dish, day, reserved) VALUES (?, ?, ?, ?)
+            ON CONFLICT(category, dish, day) DO UPDATE SET reserved = reserved + excluded.reserved
+            """,
+            [(*key, change) for key, change in delta.items()],
+        )
+        shortages = []
+        for key, change in delta.items():
+            if change < 0:
+                continue
+            row = conn.execute(
+                """
+                SELECT c.cap, r.reserved FROM dish_caps c
+                JOIN dish_reservations r USING (category, dish, day)
+                WHERE c.category = ? AND c.dish = ? AND c.day = ?
+                """,
+                key,
+            ).fetchone()
+            if row is not None and row["reserved"] > row["cap"]:
+                shortages.append((*key, max(row["cap"] - row["reserved"] + change, 0)))
+        if shortages:
+            raise SoldOutError(shortages)
+
+    @staticmethod
+    def _rebuild_reservations(conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM dish_reservations")
+        for statement in RESERVATIONS_BACKFILL.split(";"):
+            if statement.strip():
+                conn.execute(statement)
+
+    def availability(self, category: str, dish: str, day: str = "") -> dict[str, int]:
+        """Covers still available per capped bucket of a dish (``{}`` = no cap).
+
+        Keys are ``""`` (season cap) and ``day`` when that day has its own cap;
+        one primary-key lookup per bucket, no order is re-read.
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT c.day, c.cap - COALESCE(r.reserved, 0) AS remaining FROM dish_caps c
+                LEFT JOIN dish_reservations r USING (category, dish, day)
+                WHERE c.category = ? AND c.dish = ? AND c.day IN ('', ?)
+                """,
+                (category, dish, day),
+            ).fetchall()
+        return {row["day"]: row["remaining"] for row in rows}
+
+    def availability_map(self, day: str = "") -> dict[tuple[str, str], int]:
+        """(category, dish) → covers still available (tightest of season and ``day`` caps)."""
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT c.category, c.dish, MIN(c.cap - COALESCE(r.reserved, 0)) AS remaining FROM dish_caps c
+                LEFT JOIN dish_reservations r USING (category, dish, day)
+                WHERE c.day IN ('', ?)
+                GROUP BY c.category, c.dish
+                """,
+                (day,),
+            ).fetchall()
+        return {(row["category"], row["dish"]): row["remaining"] for row in rows}
+
+    def list_dish_caps(self) -> list[dict]:
+        """Every cap with its reserved covers, in menu-independent (category, dish, day) order."""
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT c.category, c.dish, c.day, c.cap, COALESCE(r.reserved, 0) AS reserved FROM dish_caps c
+                LEFT JOIN dish_reservations r USING (category, dish, day)
+                ORDER BY c.category, c.dish, c.day
+                """
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def replace_dish_caps(self, caps: list[dict]) -> None:
+        """Swap the whole cap table for ``caps`` (dicts with category, dish, day, cap)."""
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM dish_caps")
+            conn.executemany(
+                "INSERT OR REPLACE INTO dish_caps (category, dish, day, cap) VALUES (?, ?, ?, ?)",
+                [(cap["category"], cap["dish"], cap.get("day", ""), int(cap["cap"])) for cap in caps],
+            )
+            self._bump_version(conn, "caps", 0, "saved")
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Customers (Rubrica)
+    # ─────────────────────────────────────────────────────────────────────────
+
+    def list_customers(self) -> list[dict]:
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT id, name, contact, note FROM customers ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    def get_customer(self, customer_id: int) -> dict | None:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT id, name, contact, note FROM customers WHERE id = ?", (customer_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def create_customer(self, name: str, contact: str, note: str) -> int:
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO customers (name, contact, note) VALUES (?, ?, ?)",
+                (name, contact, note),
+            )
+            customer_id = int(cursor.lastrowid)
+            self._bump_version(conn, "customer", customer_id, "saved")
+            self._record("customer_saved", {"id": customer_id, "name": name, "contact": contact, "note": note})
+        return customer_id
+
+    def update_customer(self, customer_id: int, name: str, contact: str, note: str) -> bool:
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE customers SET name = ?, contact = ?, note = ? WHERE id = ?",
+                (name, contact, note, customer_id),
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._bump_version(conn, "customer", customer_id, "saved")
+            self._record("customer_saved", {"id": customer_id, "name": name, "contact": contact, "note": note})
+        return True
+
+    def delete_customer(self, customer_id: int) -> bool:
+        now = _now_iso()
+        with self.pool.transaction() as conn:
+            # ON DELETE SET NULL unlinks these orders: log them so sessions re-read them
+            unlinked = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT order_id FROM orders WHERE customer_id = ? ORDER BY order_id", (customer_id,)
+                )
+            ]
+            cursor = conn.execute("DELETE FROM customers WHERE id = ?", (customer_id,))
+            if cursor.rowcount == 0:
+                return False
+            placeholders = ",".join("?" * len(unlinked))
+            conn.execute(f"UPDATE orders SET updated_at = ? WHERE order_id IN ({placeholders})", [now, *unlinked])
+            for order_id in unlinked:
+                self._bump_version(conn, "order", order_id, "saved")
+            self._bump_version(conn, "customer", customer_id, "deleted")
+            for order_id in unlinked:
+                self._record("order_saved", {"order_id": order_id, "customer_id": None, "updated_at": now})
+            self._record("customer_deleted", {"id": customer_id})
+        return True
+
+    def merge_customers(self, keep_id: int, duplicate_ids) -> int:
+        """Fold duplicate Rubrica entries into ``keep_id`` and re-point their orders.
+
+        The kept entry takes a missing contact and the other notes from the
+        duplicates; returns how many orders moved (0 if ``keep_id`` is gone).
+        """
+        duplicate_ids = [cid for cid in duplicate_ids if cid != keep_id]
+        now = _now_iso()
+        with self.pool.transaction() as conn:
+            keep = conn.execute("SELECT id, name, contact, note FROM customers WHERE id = ?", (keep_id,)).fetchone()
+            if keep is None:
+                return 0
+            placeholders = ",".join("?" * len(duplicate_ids))
+            duplicates = conn.execute(
+                f"SELECT id, name, contact, note FROM customers WHERE id IN ({placeholders}) ORDER BY id",
+                duplicate_ids,
+            ).fetchall()
+            contact = keep["contact"] or next((row["contact"] for row in duplicates if row["contact"]), "")
+            notes = [keep["note"]] + [row["note"] for row in duplicates]
+            note = "; ".join(dict.fromkeys(n.strip() for n in notes if n.strip()))
+            conn.execute("UPDATE customers SET contact = ?, note = ? WHERE id = ?", (contact, note, keep_id))
+            moved = [
+                row[0]
+                for row in conn.execute(
+                    f"SELECT order_id FROM orders WHERE customer_id IN ({placeholders}) ORDER BY order_id",
+                    duplicate_ids,
+                )
+            ]
+            conn.execute(
+                f"UPDATE orders SET customer_id = ?, updated_at = ? WHERE customer_id IN ({placeholders})",
+                [keep_id, now, *duplicate_ids],
+            )
+            conn.execute(f"DELETE FROM customers WHERE id IN ({placeholders})", duplicate_ids)
+            for order_id in moved:
+                self._bump_version(conn, "order", order_id, "saved")
+            for row in duplicates:
+                self._bump_version(conn, "customer", row["id"], "deleted")
+            self._bump_version(conn, "customer", keep_id, "saved")
+            for order_id in moved:
+                self._record("order_saved", {"order_id": order_id, "customer_id": keep_id, "updated_at": now})
+            for row in duplicates:
+                self._record("customer_deleted", {"id": row["id"]})
+            self._record("customer_saved", {"id": keep_id, "name": keep["name"], "contact": contact, "note": note})
+        return len(moved)
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Journal snapshot / restore
+    # ─────────────────────────────────────────────────────────────────────────
+
+    def is_empty(self) -> bool:
+        with self.pool.connection() as conn:
+            return (
+                conn.execute("SELECT 1 FROM orders LIMIT 1").fetchone() is None
+                and conn.execute("SELECT 1 FROM customers LIMIT 1").fetchone() is None
+            )
+
+    def export_state(self) -> dict:
+        """Whole archive in the journal state format."""
+        return {
+            "orders": {order["order_id"]: order for order in self.list_orders()},
+            "customers": {cust["id"]: cust for cust in self.list_customers()},
+        }
+
+    # ─────────────────────────────────────────────────────────────────────────
+    # Export delta (watermark per destinatario)
+    # ─────────────────────────────────────────────────────────────────────────
+
+    def get_watermark(self, consumer: str) -> int:
+        """Data version already delivered to ``consumer`` (0 = nothing yet)."""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT version FROM export_watermarks WHERE consumer = ?", (consumer,)
+            ).fetchone()
+        return int(row[0]) if row else 0
+
+    def set_watermark(self, consumer: str, version: int) -> None:
+        """Move ``consumer``'s watermark by hand (no delivery to download again)."""
+        with self.pool.transaction() as conn:
+            self._write_watermark(conn, consumer, version, version)
+
+    @staticmethod
+    def _write_watermark(conn: sqlite3.Connection, consumer: str, version: int, delivered_from: int) -> None:
+        conn.execute(
+            """
+            INSERT INTO export_watermarks (consumer, version, delivered_from, exported_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(consumer) DO UPDATE SET
+                version = excluded.version, delivered_from = excluded.delivered_from, exported_at = excluded.exported_at
+            """,
+            (consumer, version, delivered_from, _now_iso()),
+        )
+
+    def last_delivery(self, consumer: str) -> tuple[int, int] | None:
+        """``(since, version)`` window of the last delta taken by ``consumer``, if any."""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT delivered_from, version FROM export_watermarks WHERE consumer = ?", (consumer,)
+            ).fetchone()
+        if row is None or row["delivered_from"] >= row["version"]:
+            return None
+        return int(row["delivered_from"]), int(row["version"])
+
+    def pending_changes(self, consumer: str) -> int:
+        """Orders touched since ``consumer``'s watermark (upper bound of the next delta).
+
+        A restore (``'all'`` row) counts as a change to every order in the archive.
+        """
+        with self.pool.connection() as conn:
+            return conn.execute(
+                """
+                WITH mark AS (
+                    SELECT COALESCE((SELECT version FROM export_watermarks WHERE consumer = ?), 0) AS version
+                )
+                SELECT COUNT(*) FROM (
+                    SELECT entity_id FROM changes, mark
+                    WHERE changes.entity = 'order' AND changes.version > mark.version
+                    UNION
+                    SELECT order_id FROM orders WHERE EXISTS (
+                        SELECT 1 FROM changes, mark
+                        WHERE changes.entity = 'all' AND changes.version > mark.version
+                    )
+                )
+                """,
+                (consumer,),
+            ).fetchone()[0]
+
+    def take_order_delta(self, consumer: str) -> tuple[int, list[dict]]:
+        """``order_delta`` since ``consumer``'s watermark, advancing it in the same transaction.
+
+        The write lock is held from reading the watermark to moving it, so two
+        clicks for the same consumer never ship the same batch twice. The
+        window is remembered: ``last_order_delta`` builds it again if the
+        download got lost.
+        """
+        with self.pool.transaction() as conn:
+            row = conn.execute("SELECT version FROM export_watermarks WHERE consumer = ?", (consumer,)).fetchone()
+            since = int(row[0]) if row else 0
+            version, changes = self._order_delta(conn, since)
+            self._write_watermark(conn, consumer, version, since)
+        return version, changes
+
+    def last_order_delta(self, consumer: str) -> tuple[int, list[dict]]:
+        """The window of the last ``take_order_delta`` again, without moving the watermark.
+
+        Orders show their current content; one deleted since then is listed as deleted.
+        """
+        window = self.last_delivery(consumer)
+        if window is None:
+            return self.get_watermark(consumer), []
+        return self.order_delta(*window)
+
+    def order_delta(self, since: int, until: int | None = None) -> tuple[int, list[dict]]:
+        """Net order changes after data version ``since`` (up to ``until``), read from one snapshot.
+
+        Only the change log rows after ``since`` and the orders they name are
+        read. Returns ``(version, changes)``; each change is a dict with
+        ``order_id``, ``change`` (``"created"``, ``"updated"`` or
+        ``"deleted"``), ``changed_at`` and ``order`` (``None`` once deleted).
+        Orders created and deleted inside the window are left out.
+        """
+        with self.pool.snapshot() as conn:
+            return self._order_delta(conn, since, until)
+
+    def _order_delta(self, conn: sqlite3.Connection, since: int, until: int | None = None) -> tuple[int, list[dict]]:
+        version = until if until is not None else int(
+            conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]
+        )
+        since_row = conn.execute("SELECT changed_at FROM changes WHERE version = ?", (since,)).fetchone()
+        since_at = since_row[0] if since_row else ""
+        last: dict[int, tuple[str, str]] = {}
+        for row in conn.execute(
+            "SELECT entity, entity_id, kind, changed_at FROM changes "
+            "WHERE version > ? AND version <= ? AND entity IN ('order', 'all') ORDER BY version",
+            (since, version),
+        ):
+            if row["entity"] == "all":
+                for (order_id,) in conn.execute("SELECT order_id FROM orders"):
+                    last[order_id] = ("saved", row["changed_at"])
+            else:
+                last[row["entity_id"]] = (row["kind"], row["changed_at"])
+
+        saved_ids = [order_id for order_id, (kind, _) in last.items() if kind == "saved"]
+        orders, created_at = {}, {}
+        for start in range(0, len(saved_ids), EXPORT_BATCH_SIZE):
+            batch = saved_ids[start:start + EXPORT_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(f"SELECT * FROM orders WHERE order_id IN ({placeholders})", batch).fetchall()
+            items_by_order = self._items_by_order(conn, batch)
+            for row in rows:
+                orders[row["order_id"]] = self._order_from_rows(row, items_by_order[row["order_id"]])
+                created_at[row["order_id"]] = row["created_at"]
+
+        restored_before = since > 0 and conn.execute(
+            "SELECT 1 FROM changes WHERE entity = 'all' AND version <= ? LIMIT 1", (since,)
+        ).fetchone() is not None
+        changes = []
+        for order_id, (kind, changed_at) in last.items():
+            if kind == "saved" and order_id not in orders:
+                kind = "deleted"  # window in the past: the order is gone by now
+            if kind == "saved":
+                change = "updated" if since_at and created_at[order_id] <= since_at else "created"
+            else:
+                existed = restored_before or (since > 0 and conn.execute(
+                    "SELECT 1 FROM changes WHERE entity = 'order' AND entity_id = ? AND version <= ? LIMIT 1",
+                    (order_id, since),
+                ).fetchone() is not None)
+                if not existed:
+                    continue
+                change = "deleted"
+            changes.append({
+                "order_id": order_id,
+                "change": change,
+                "changed_at": changed_at,
+                "order": orders.get(order_id),
+            })
+        return version, changes
+
+    def restore(self, state: dict) -> None:
+        """Load a journal state into an empty archive (e.g. after losing the DB file)."""
+        now = _now_iso()
+        with self.pool.transaction() as conn:
+            # Customers first: restored orders reference them by ID
+            conn.executemany(
+                "INSERT INTO customers (id, name, contact, note) VALUES (?, ?, ?, ?)",
+                [(c["id"], c["name"], c["contact"], c["note"]) for c in state["customers"].values()],
+            )
+            for order in state["orders"].values():
+                conn.execute(
+                    """
+                    INSERT INTO orders (order_id, order_number, customer, contact, note, pickup_slot, customer_id, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        order["order_id"],
+                        order.get("order_number", ""),
+                        order["customer"],
+                        order["contact"],
+                        order["note"],
+                        order.get("pickup", ""),
+                        order.get("customer_id") if order.get("customer_id") in state["customers"] else None,
+                        order.get("created_at") or now,
+                        order.get("updated_at") or order.get("created_at") or now,
+                    ),
+                )
+                self._write_items(conn, order["order_id"], order["items"])
+            self._rebuild_reservations(conn)
+            # Never hand out a number that is already in the restored archive
+            conn.execute(
+                "UPDATE sequences SET next_value = MAX(next_value, (SELECT COALESCE(MAX(order_id), 0) + 1 FROM orders)) WHERE name = 'orders'"
+            )
+            # ...nor a day-prefixed number ("DD-NNN") already used on its creation day
+            conn.execute(
+                """
+                INSERT INTO sequences (name, next_value)
+                    SELECT 'orders-' || replace(substr(created_at, 1, 10), '-', ''),
+                           MAX(CAST(substr(order_number, 4) AS INTEGER)) + 1
+                    FROM orders
+                    WHERE order_number GLOB '[0-9][0-9]-[0-9]*' AND substr(order_number, 1, 2) = substr(created_at, 9, 2)
+                    GROUP BY 1
+                ON CONFLICT(name) DO UPDATE SET next_value = MAX(next_value, excluded.next_value)
+                """
+            )
+            self._bump_version(conn, "all", 0, "saved")
+
+
+def format_order_number(day: datetime, seq: int) -> str:
+    """Day-prefixed order number, e.g. ``24-007``."""
+    return f"{day:%d}-{seq:03d}"
+
+
+class OrderNumberAllocator:
+    """Per-session order number allocator backed by block leases.
+
+    Each till leases ``block_size`` numbers at a time from the shared store, so
+    handing out a number is a local pop with no database lock. Numbers of a
+    lease that is never used (closed tab, restart) are simply skipped: order
+    numbers are unique and increasing per till, but may have gaps.
+    """
+
+    def __init__(self, store: OrderStore, block_size: int = ORDER_ID_BLOCK_SIZE, day_prefix: bool = ORDER_NUMBER_DAY_PREFIX):
+        self.store = store
+        self.block_size = block_size
+        self.day_prefix = day_prefix
+        self._ids: range = range(0)
+        self._day_seqs: range = range(0)
+        self._day_key = ""
+
+    def _ensure_lease(self) -> None:
+        if not self._ids:
+            self._ids = self.store.reserve_block("orders", self.block_size, start=FIRST_ORDER_ID)
+        if self.day_prefix:
+            day_key = f"{datetime.now():%Y%m%d}"
+            if day_key != self._day_key:
+                # A new day restarts the daily counter: drop yesterday's lease
+                self._day_key = day_key
+                self._day_seqs = range(0)
+            if not self._day_seqs:
+                self._day_seqs = self.store.reserve_block(f"orders-{day_key}", self.block_size, start=1)
+
+    def peek(self) -> tuple[int, str]:
+        """Next (order_id, order_number) without consuming it."""
+        self._ensure_lease()
+        order_id = self._ids[0]
+        if self.day_prefix:
+            return order_id, format_order_number(datetime.now(), self._day_seqs[0])
+        return order_id, str(order_id)
+
+    def allocate(self) -> tuple[int, str]:
+        """Consume and return the next (order_id, order_number)."""
+        order_id, order_number = self.peek()
+        self._ids = self._ids[1:]
+        if self.day_prefix:
+            self._day_seqs = self._day_seqs[1:]
+        return order_id, order_number
+
+
+@st.cache_resource
+def get_order_store() -> OrderStore:
+    """Process-wide order store, created once and shared by every session."""
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    journal = OrderJournal(JOURNAL_DIR)
+    store = OrderStore(ORDERS_DB_FILE, journal=journal)
+    if store.is_empty() and (journal.state["orders"] or journal.state["customers"]):
+        # Database file lost or recreated: rebuild it from snapshot + journal tail
+        store.restore(journal.state)
+    elif not journal.has_history() and not store.is_empty():
+        # Archive predates the journal: start it from a snapshot of the current data
+        journal.state = store.export_state()
+        journal.compact()
+    return store
+
+
+def sync_state_from_store(store: OrderStore) -> None:
+    """Refresh the session copy of orders/customers when any till wrote.
+
+    The first run loads everything; later runs only re-read the orders and
+    customers listed in the store change log since the version this session
+    last saw, patching the session indexes one row at a time.
+    """
+    version = store.data_version()
+    last_version = st.session_state.get("store_version")
+    if last_version == version:
+        return
+    changes = store.changes_since(last_version) if last_version is not None else None
+    if changes is None or any(entity == "all" for entity, _, _ in changes):
+        st.session_state.orders = OrderIndex(store.list_orders())
+        st.session_state.aggregates = OrderAggregates(st.session_state.orders)
+        st.session_state.order_cube = None
+        st.session_state.orders_table = OrdersTable(st.session_state.orders)
+        st.session_state.pickup_index = PickupSlotIndex(st.session_state.orders)
+        st.session_state.customer_orders = CustomerOrdersIndex(st.session_state.orders, current_revenue().by_order)
+        st.session_state.customers = CustomerIndex(store.list_customers())
+    else:
+        # Last change wins when an order was touched more than once
+        latest = {(entity, entity_id): kind for entity, entity_id, kind in changes}
+        orders = st.session_state.orders
+        aggregates = st.session_state.aggregates
+        order_cube = st.session_state.order_cube
+        orders_table = st.session_state.orders_table
+        pickup_index = st.session_state.pickup_index
+        customer_orders = st.session_state.customer_orders
+        customers = st.session_state.customers
+        for (entity, entity_id), kind in latest.items():
+            if entity == "customer":
+                customer = store.get_customer(entity_id) if kind == "saved" else None
+                if customer is None:
+                    customers.remove(entity_id)
+                else:
+                    customers.upsert(customer)
+                continue
+            if entity != "order":
+                continue
+            order = store.get_order(entity_id) if kind == "saved" else None
+            if order is None:
+                previous = orders.remove(entity_id)
+                aggregates.remove_order(previous)
+                if order_cube is not None:
+                    order_cube.remove_order(previous)
+                pickup_index.remove_order(previous)
+                customer_orders.remove_order(previous)
+                orders_table.remove_order(entity_id)
+            else:
+                previous = orders.upsert(order)
+                aggregates.replace_order(previous, order)
+                if order_cube is not None:
+                    order_cube.replace_order(previous, order)
+                pickup_index.replace_order(previous, order)
+                customer_orders.replace_order(previous, order)
+                orders_table.upsert_order(order)
+    st.session_state.store_version = version
+
+
+def get_order_allocator() -> OrderNumberAllocator:
+    """This session's order number allocator (leases numbers on first use)."""
+    if "order_allocator" not in st.session_state:
+        st.session_state.order_allocator = OrderNumberAllocator(get_order_store())
+    return st.session_state.order_allocator
+
+
+def current_order_label() -> str:
+    """Number shown for the order in the form: the edited one or the next free one."""
+    editing_order_id = st.session_state.editing_order_id
+    if editing_order_id is not None:
+        order = get_order_store().get_order(editing_order_id)
+        return order["order_number"] if order else str(editing_order_id)
+    return get_order_allocator().peek()[1]
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# COMPONENTS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+def render_header():
+    """Render compact Swiss-style header."""
+    st.markdown(
+        """
+        <div style="
+            display: flex;
+            align-items: center;
+            justify-content: space-between;
+            padding: 0.5rem 0;
+            border-bottom: 2px solid #0A0A0A;
+            margin-bottom: 0.5rem;
+        ">
+            <div style="display: flex; align-items: baseline; gap: 0.5rem;">
+                <span style="font-size: 1.5rem; font-weight: 800; letter-spacing: -0.03em; color: #0A0A0A;">MARE MIO</span>
+                <span style="font-size: 0.7rem; letter-spacing: 0.1em; text-transform: uppercase; color: #C41E3A;">Gastronomia di Mare</span>
+            </div>
+            <span style="font-size: 1.2rem; font-weight: 300; color: #D4D4D4; letter-spacing: -0.02em;">2025</span>
+        </div>
+        """,
+        unsafe_allow_html=True,
+    )
+
+
+def render_kpis(orders_df: pd.DataFrame, num_orders: int):
+    """Render KPI metrics."""
+    col1, col2, col3 = st.columns(3)
+    
+    with col1:
+        st.metric(
+            label="Ordini",
+            value=num_orders,
+        )
+    
+    with col2:
+        st.metric(
+            label="Vassoi",
+            value=int(orders_df["vassoi"].sum()) if not orders_df.empty else 0,
+        )
+    
+    with col3:
+        st.metric(
+            label="Coperti",
+            value=int(orders_df["coperti"].sum()) if not orders_df.empty else 0,
+        )
+
+
+def render_section_header(title: str, badge: str = None):
+    """Render a section header."""
+    badge_html = f'<span class="section-badge">{badge}</span>' if badge else ""
+    st.markdown(
+        f"""
+        <div class="section-header">
+            <h3 class="section-title">{title}</h3>
+            {badge_html}
+        </div>
+        """,
+        unsafe_allow_html=True,
+    )
+
+
+def render_sidebar(menu: dict) -> str:
+    """Render the sidebar with navigation and contextual information. Returns selected category."""
+    with st.sidebar:
+        # Brand/Logo compact
+        st.markdown(
+            """
+            <div style="text-align: center; padding: 0.5rem 0; border-bottom: 1px solid #404040; margin-bottom: 0.75rem;">
+                <span style="font-size: 1.5rem;">🎄</span>
+                <span style="font-size: 0.9rem; font-weight: 800; letter-spacing: -0.02em; color: white; margin-left: 0.5rem;">MARE MIO</span>
+                <span style="font-size: 0.55rem; letter-spacing: 0.1em; color: #C41E3A; margin-left: 0.5rem;">2025</span>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+        
+        # ─────────────────────────────────────────────────────────────────
+        # NAVIGAZIONE PRINCIPALE - option_menu
         # ─────────────────────────────────────────────────────────────────
         
         # Initialize selected_page if not exists
@@ -1120,193 +4429,318 @@ def render_sidebar(orders_df: pd.DataFrame, orders_count: int, menu: dict) -> st
         
         st.markdown("<div style='height: 0.75rem;'></div>", unsafe_allow_html=True)
         
-        # ─────────────────────────────────────────────────────────────────
-        # STATISTICHE LIVE (compatte)
-        # ─────────────────────────────────────────────────────────────────
-        st.markdown('<div class="sidebar-section">📊 Stats</div>', unsafe_allow_html=True)
+        render_sidebar_stats()
+        render_sidebar_actions()
         
-        total_vassoi = int(orders_df["vassoi"].sum()) if not orders_df.empty else 0
-        total_coperti = int(orders_df["coperti"].sum()) if not orders_df.empty else 0
-        
-        # Compact stats row
+        # Footer compact
         st.markdown(
-            f"""
-            <div style="display: flex; gap: 0.5rem; margin-bottom: 0.5rem;">
-                <div style="flex: 1; background: #1F2937; padding: 0.5rem; border-left: 2px solid #C41E3A;">
-                    <div style="font-size: 0.5rem; color: #6B7280; text-transform: uppercase; letter-spacing: 0.1em;">Ordini</div>
-                    <div style="font-size: 1.1rem; font-weight: 800; color: white;">{orders_count}</div>
-                </div>
-                <div style="flex: 1; background: #1F2937; padding: 0.5rem; border-left: 2px solid #22C55E;">
-                    <div style="font-size: 0.5rem; color: #6B7280; text-transform: uppercase; letter-spacing: 0.1em;">Vassoi</div>
-                    <div style="font-size: 1.1rem; font-weight: 800; color: white;">{total_vassoi}</div>
+            """
+            <div style="
+                margin-top: 1rem;
+                padding-top: 0.5rem;
+                border-top: 1px solid #333;
+                text-align: center;
+            ">
+                <div style="font-size: 0.5rem; color: #404040;">
+                    v2.0 · Swiss Design
                 </div>
             </div>
-            <div style="background: #1F2937; padding: 0.5rem; border-left: 2px solid #3B82F6; margin-bottom: 0.75rem;">
-                <div style="font-size: 0.5rem; color: #6B7280; text-transform: uppercase; letter-spacing: 0.1em;">Coperti</div>
-                <div style="font-size: 1.1rem; font-weight: 800; color: white;">{total_coperti}</div>
-            </div>
             """,
             unsafe_allow_html=True
         )
-        
-        # ─────────────────────────────────────────────────────────────────
-        # STATO ORDINE CORRENTE - BEN VISIBILE
-        # ─────────────────────────────────────────────────────────────────
-        st.markdown('<div class="sidebar-section">📝 Ordine Corrente</div>', unsafe_allow_html=True)
-        
-        is_editing = st.session_state.editing_order_id is not None
-        current_order_id = st.session_state.editing_order_id if is_editing else st.session_state.next_order_id
-        cart_items = len(st.session_state.current_items)
-        customer = st.session_state.get("form_customer", "")
-        contact = st.session_state.get("form_contact", "")
-        
-        if is_editing:
-            status_color = "#D97706"
-            status_text = "MODIFICA"
-            status_bg = "linear-gradient(135deg, #78350F 0%, #451A03 100%)"
-        elif cart_items > 0:
-            status_color = "#22C55E"
-            status_text = "IN CORSO"
-            status_bg = "linear-gradient(135deg, #14532D 0%, #052E16 100%)"
-        else:
-            status_color = "#C41E3A"
-            status_text = "NUOVO"
-            status_bg = "linear-gradient(135deg, #262626 0%, #171717 100%)"
-        
-        # NUMERO ORDINE - Grande e prominente
+    
+    return selected_page, selected_category
+
+
+@st.fragment(key="sidebar_stats")
+def render_sidebar_stats():
+    """Live stats, current order and top dishes; reruns on cart, customer and order signals."""
+    # ─────────────────────────────────────────────────────────────────
+    # STATISTICHE LIVE (compatte)
+    # ─────────────────────────────────────────────────────────────────
+    st.markdown('<div class="sidebar-section">📊 Stats</div>', unsafe_allow_html=True)
+    
+    sync_state_from_store(get_order_store())
+    aggregates = st.session_state.aggregates
+    orders_count = len(st.session_state.orders)
+    total_vassoi = aggregates.total_vassoi
+    total_coperti = aggregates.total_coperti
+    
+    # Compact stats row
+    st.markdown(
+        f"""
+        <div style="display: flex; gap: 0.5rem; margin-bottom: 0.5rem;">
+            <div style="flex: 1; background: #1F2937; padding: 0.5rem; border-left: 2px solid #C41E3A;">
+                <div style="font-size: 0.5rem; color: #6B7280; text-transform: uppercase; letter-spacing: 0.1em;">Ordini</div>
+                <div style="font-size: 1.1rem; font-weight: 800; color: white;">{orders_count}</div>
+            </div>
+            <div style="flex: 1; background: #1F2937; padding: 0.5rem; border-left: 2px solid #22C55E;">
+                <div style="font-size: 0.5rem; color: #6B7280; text-transform: uppercase; letter-spacing: 0.1em;">Vassoi</div>
+                <div style="font-size: 1.1rem; font-weight: 800; color: white;">{total_vassoi}</div>
+            </div>
+        </div>
+        <div style="background: #1F2937; padding: 0.5rem; border-left: 2px solid #3B82F6; margin-bottom: 0.75rem;">
+            <div style="font-size: 0.5rem; color: #6B7280; text-transform: uppercase; letter-spacing: 0.1em;">Coperti</div>
+            <div style="font-size: 1.1rem; font-weight: 800; color: white;">{total_coperti}</div>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+    
+    # ─────────────────────────────────────────────────────────────────
+    # STATO ORDINE CORRENTE - BEN VISIBILE
+    # ─────────────────────────────────────────────────────────────────
+    st.markdown('<div class="sidebar-section">📝 Ordine Corrente</div>', unsafe_allow_html=True)
+    
+    is_editing = st.session_state.editing_order_id is not None
+    current_order_id = current_order_label()
+    cart_items = len(st.session_state.current_items)
+    customer = st.session_state.get("form_customer", "")
+    contact = st.session_state.get("form_contact", "")
+    
+    if is_editing:
+        status_color = "#D97706"
+        status_text = "MODIFICA"
+        status_bg = "linear-gradient(135deg, #78350F 0%, #451A03 100%)"
+    elif cart_items > 0:
+        status_color = "#22C55E"
+        status_text = "IN CORSO"
+        status_bg = "linear-gradient(135deg, #14532D 0%, #052E16 100%)"
+    else:
+        status_color = "#C41E3A"
+        status_text = "NUOVO"
+        status_bg = "linear-gradient(135deg, #262626 0%, #171717 100%)"
+    
+    # NUMERO ORDINE - Grande e prominente
+    st.markdown(
+        f"""
+        <div style="
+            background: {status_bg};
+            border: 2px solid {status_color};
+            padding: 1.618rem 1rem;
+            margin-bottom: 1rem;
+            text-align: center;
+        ">
+            <div style="font-size: 0.6rem; font-weight: 600; letter-spacing: 0.2em; text-transform: uppercase; color: {status_color}; margin-bottom: 0.382rem;">{status_text}</div>
+            <div style="font-size: 3rem; font-weight: 800; color: white; line-height: 1; letter-spacing: -0.03em;">#{current_order_id}</div>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+    
+    # NOME CLIENTE - Grande e chiaro
+    if customer:
         st.markdown(
             f"""
             <div style="
-                background: {status_bg};
-                border: 2px solid {status_color};
-                padding: 1.618rem 1rem;
-                margin-bottom: 1rem;
-                text-align: center;
+                background: #1F2937;
+                border-left: 4px solid #C41E3A;
+                padding: 1rem;
+                margin-bottom: 0.618rem;
+            ">
+                <div style="font-size: 0.55rem; font-weight: 600; letter-spacing: 0.15em; text-transform: uppercase; color: #6B7280; margin-bottom: 0.25rem;">CLIENTE</div>
+                <div style="font-size: 1.25rem; font-weight: 700; color: white; line-height: 1.2;">{customer}</div>
+                <div style="font-size: 0.75rem; color: #9CA3AF; margin-top: 0.25rem;">{contact if contact else '—'}</div>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+    else:
+        st.markdown(
+            """
+            <div style="
+                background: #1F2937;
+                border-left: 4px solid #4B5563;
+                padding: 1rem;
+                margin-bottom: 0.618rem;
             ">
-                <div style="font-size: 0.6rem; font-weight: 600; letter-spacing: 0.2em; text-transform: uppercase; color: {status_color}; margin-bottom: 0.382rem;">{status_text}</div>
-                <div style="font-size: 3rem; font-weight: 800; color: white; line-height: 1; letter-spacing: -0.03em;">#{current_order_id}</div>
+                <div style="font-size: 0.55rem; font-weight: 600; letter-spacing: 0.15em; text-transform: uppercase; color: #6B7280; margin-bottom: 0.25rem;">CLIENTE</div>
+                <div style="font-size: 1rem; color: #6B7280; font-style: italic;">Non inserito</div>
             </div>
             """,
             unsafe_allow_html=True
         )
+    
+    # Carrello info
+    st.markdown(
+        f"""
+        <div style="
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            padding: 0.75rem 1rem;
+            background: #111827;
+            margin-bottom: 0.5rem;
+        ">
+            <span style="font-size: 0.7rem; color: #9CA3AF;">🛒 Piatti nel carrello</span>
+            <span style="font-size: 1.2rem; font-weight: 800; color: {'#22C55E' if cart_items > 0 else '#6B7280'};">{cart_items}</span>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+    
+    # ─────────────────────────────────────────────────────────────────
+    # TOP PIATTI (se ci sono ordini)
+    # ─────────────────────────────────────────────────────────────────
+    top_dishes = aggregates.top_dishes(5)
+    if top_dishes:
+        st.markdown('<div class="sidebar-section">🏆 Top Piatti</div>', unsafe_allow_html=True)
         
-        # NOME CLIENTE - Grande e chiaro
-        if customer:
+        # Top 5 dishes by quantity
+        for i, (dish, qty) in enumerate(top_dishes, 1):
+            # Truncate long names
+            catalog_dish = MENU_CATALOG.by_name(dish)
+            display_name = catalog_dish.short_name if catalog_dish else truncate_label(dish, 20, 22)
             st.markdown(
                 f"""
                 <div style="
-                    background: #1F2937;
-                    border-left: 4px solid #C41E3A;
-                    padding: 1rem;
-                    margin-bottom: 0.618rem;
-                ">
-                    <div style="font-size: 0.55rem; font-weight: 600; letter-spacing: 0.15em; text-transform: uppercase; color: #6B7280; margin-bottom: 0.25rem;">CLIENTE</div>
-                    <div style="font-size: 1.25rem; font-weight: 700; color: white; line-height: 1.2;">{customer}</div>
-                    <div style="font-size: 0.75rem; color: #9CA3AF; margin-top: 0.25rem;">{contact if contact else '—'}</div>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
-        else:
-            st.markdown(
-                """
-                <div style="
-                    background: #1F2937;
-                    border-left: 4px solid #4B5563;
-                    padding: 1rem;
-                    margin-bottom: 0.618rem;
+                    display: flex;
+                    justify-content: space-between;
+                    align-items: center;
+                    padding: 0.4rem 0;
+                    border-bottom: 1px solid #333;
                 ">
-                    <div style="font-size: 0.55rem; font-weight: 600; letter-spacing: 0.15em; text-transform: uppercase; color: #6B7280; margin-bottom: 0.25rem;">CLIENTE</div>
-                    <div style="font-size: 1rem; color: #6B7280; font-style: italic;">Non inserito</div>
+                    <span style="font-size: 0.7rem; color: #A3A3A3;">
+                        <span style="color: #C41E3A; font-weight: 700;">{i}.</span> {display_name}
+                    </span>
+                    <span style="font-size: 0.75rem; font-weight: 700; color: white;">{int(qty)}</span>
                 </div>
                 """,
                 unsafe_allow_html=True
             )
-        
-        # Carrello info
-        st.markdown(
-            f"""
-            <div style="
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-                padding: 0.75rem 1rem;
-                background: #111827;
-                margin-bottom: 0.5rem;
-            ">
-                <span style="font-size: 0.7rem; color: #9CA3AF;">🛒 Piatti nel carrello</span>
-                <span style="font-size: 1.2rem; font-weight: 800; color: {'#22C55E' if cart_items > 0 else '#6B7280'};">{cart_items}</span>
-            </div>
-            """,
-            unsafe_allow_html=True
+
+
+@st.fragment(key="sidebar_actions")
+def render_sidebar_actions():
+    """Quick actions (export); reruns only when the orders change."""
+    # ─────────────────────────────────────────────────────────────────
+    # AZIONI RAPIDE
+    # ─────────────────────────────────────────────────────────────────
+    st.markdown('<div class="sidebar-section">⚡ Azioni</div>', unsafe_allow_html=True)
+    
+    # Export button in sidebar
+    sync_state_from_store(get_order_store())
+    if st.session_state.orders:
+        st.download_button(
+            "⬇️ ESPORTA",
+            data=lazy_season_export(get_order_store()),
+            file_name="ordini_natale_2025.xlsx",
+            mime=XLSX_MIME,
+            use_container_width=True,
+            key="sidebar_export"
         )
         
-        # ─────────────────────────────────────────────────────────────────
-        # TOP PIATTI (se ci sono ordini)
-        # ─────────────────────────────────────────────────────────────────
-        if not orders_df.empty:
-            st.markdown('<div class="sidebar-section">🏆 Top Piatti</div>', unsafe_allow_html=True)
-            
-            # Top 5 dishes by quantity
-            top_dishes = orders_df.groupby("piatto")["vassoi"].sum().nlargest(5)
-            
-            for i, (dish, qty) in enumerate(top_dishes.items(), 1):
-                # Truncate long names
-                display_name = dish[:20] + "…" if len(dish) > 22 else dish
-                st.markdown(
-                    f"""
-                    <div style="
-                        display: flex;
-                        justify-content: space-between;
-                        align-items: center;
-                        padding: 0.4rem 0;
-                        border-bottom: 1px solid #333;
-                    ">
-                        <span style="font-size: 0.7rem; color: #A3A3A3;">
-                            <span style="color: #C41E3A; font-weight: 700;">{i}.</span> {display_name}
-                        </span>
-                        <span style="font-size: 0.75rem; font-weight: 700; color: white;">{int(qty)}</span>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-        
-        # ─────────────────────────────────────────────────────────────────
-        # AZIONI RAPIDE
-        # ─────────────────────────────────────────────────────────────────
-        st.markdown('<div class="sidebar-section">⚡ Azioni</div>', unsafe_allow_html=True)
-        
-        # Export button in sidebar
-        if orders_count > 0:
-            totals_df, freq_df = build_totals(st.session_state.orders)
-            excel_data = export_excel(orders_df, totals_df, freq_df)
+        # Solo le modifiche dall'ultimo export della cucina
+        pending = get_order_store().pending_changes(DELTA_CONSUMER)
+        if pending:
+            st.download_button(
+                f"⬇ Modifiche cucina ({pending})",
+                data=lazy_delta_export(get_order_store()),
+                file_name=f"ordini_modifiche_{datetime.now():%Y%m%d-%H%M}.xlsx",
+                mime=XLSX_MIME,
+                use_container_width=True,
+                key="sidebar_delta_export",
+            )
+        else:
+            st.caption("✓ Cucina aggiornata: nessuna modifica dall'ultimo export")
+        if get_order_store().last_delivery(DELTA_CONSUMER) is not None:
+            # Download perso o interrotto: stesso intervallo, il watermark non si muove
             st.download_button(
-                "⬇️ ESPORTA",
-                data=excel_data,
-                file_name="ordini_natale_2025.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                "↺ Riscarica ultimo invio cucina",
+                data=lazy_delta_export(get_order_store(), repeat=True),
+                file_name=f"ordini_modifiche_ripetuto_{datetime.now():%Y%m%d-%H%M}.xlsx",
+                mime=XLSX_MIME,
                 use_container_width=True,
-                key="sidebar_export"
+                key="sidebar_delta_repeat",
             )
         
-        # Footer compact
-        st.markdown(
-            """
-            <div style="
-                margin-top: 1rem;
-                padding-top: 0.5rem;
-                border-top: 1px solid #333;
-                text-align: center;
-            ">
-                <div style="font-size: 0.5rem; color: #404040;">
-                    v2.0 · Swiss Design
-                </div>
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
+        # Export pesanti in background: la cassa continua a prendere ordini
+        job_cols = st.columns(len(EXPORT_JOB_KINDS))
+        for col, (kind, (label, *_)) in zip(job_cols, EXPORT_JOB_KINDS.items()):
+            with col:
+                st.button(f"⚙️ {label}", key=f"export_job_{kind}", use_container_width=True,
+                          on_click=start_export_job_callback, args=(kind,))
     
-    return selected_page, selected_category
+    get_export_jobs().evict_expired()
+    if any(job.active for job in session_export_jobs()):
+        render_export_jobs_live()
+    else:
+        render_export_job_rows(session_export_jobs())
+
+
+def session_export_jobs() -> list:
+    """Background export jobs started by this session that still exist."""
+    manager = get_export_jobs()
+    jobs = [job for job in map(manager.get, st.session_state.export_jobs) if job is not None]
+    st.session_state.export_jobs = [job.job_id for job in jobs]
+    return jobs
+
+
+@st.fragment(run_every=1)
+def render_export_jobs_live():
+    """Polls running jobs once a second; a full rerun stops polling when they end."""
+    jobs = session_export_jobs()
+    render_export_job_rows(jobs)
+    if not any(job.active for job in jobs):
+        st.rerun()
+
+
+def render_export_job_rows(jobs: list):
+    """Progress + cancel for running jobs, download for finished ones (newest first)."""
+    for job in reversed(jobs):
+        if job.active:
+            jc1, jc2 = st.columns([5, 1])
+            with jc1:
+                st.progress(job.progress, text=f"{job.label} · {job.progress:.0%}")
+            with jc2:
+                st.button("✕", key=f"export_cancel_{job.job_id}", help="Annulla export",
+                          on_click=get_export_jobs().cancel, args=(job.job_id,))
+        elif job.status == "done" and job.path.exists():
+            st.download_button(
+                f"⬇ {job.label}",
+                data=job.path.read_bytes,
+                file_name=job.file_name,
+                mime=job.mime,
+                use_container_width=True,
+                key=f"export_dl_{job.job_id}",
+            )
+            st.caption(f"{job.stats.rows} righe · {job.stats.rows_per_sec:,.0f} righe/s")
+        elif job.status == "failed":
+            st.caption(f"⚠ {job.label}: errore ({job.error})")
+        elif job.status == "cancelled":
+            st.caption(f"✕ {job.label}: annullato")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# SEGNALI - RERUN DEI FRAMMENTI
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Dato modificato → frammenti che lo mostrano (gli altri non vengono rieseguiti)
+FRAGMENT_SIGNALS = {
+    "portion": ("portion_picker",),
+    "cart": ("cart", "sidebar_stats"),
+    # dish_grid: "rimasti"/"ESAURITO" badges follow saved orders and the pickup day
+    "customer": ("customer_form", "cart", "sidebar_stats", "dish_grid"),
+    "editing": ("customer_form", "cart", "order_list", "sidebar_stats", "dish_grid"),
+    "orders": ("order_list", "sidebar_stats", "sidebar_actions", "dish_grid"),
+}
+
+
+def fragments_for(*signals: str) -> list:
+    """Fragment keys to rerun for ``signals``, in first-seen order."""
+    keys = []
+    for signal in signals:
+        keys.extend(key for key in FRAGMENT_SIGNALS[signal] if key not in keys)
+    return keys
+
+
+def notify(*signals: str) -> None:
+    """Signal that ``signals`` changed and rerun only the dependent fragments.
+
+    Only valid from a widget callback on the Ordini page, where all the keyed
+    fragments are rendered.
+    """
+    st.rerun(fragments_for(*signals))
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1319,7 +4753,10 @@ def reset_form_callback():
     st.session_state.form_customer = ""
     st.session_state.form_contact = ""
     st.session_state.form_note = ""
+    st.session_state.form_pickup = ""
+    st.session_state.form_customer_id = None
     st.session_state.current_items = []
+    notify("customer", "cart")
 
 
 def cancel_edit_callback():
@@ -1328,7 +4765,10 @@ def cancel_edit_callback():
     st.session_state.form_customer = ""
     st.session_state.form_contact = ""
     st.session_state.form_note = ""
+    st.session_state.form_pickup = ""
+    st.session_state.form_customer_id = None
     st.session_state.current_items = []
+    notify("editing")
 
 
 def save_order_callback():
@@ -1336,64 +4776,170 @@ def save_order_callback():
     customer = st.session_state.form_customer
     contact = st.session_state.form_contact
     note = st.session_state.form_note
+    pickup = st.session_state.form_pickup
+    store = get_order_store()
+    # Another till may have deleted the linked customer since the form was filled
+    sync_state_from_store(store)
+    customer_id = st.session_state.form_customer_id
+    if customer_id not in st.session_state.customers:
+        customer_id = st.session_state.customers.match(customer, contact)
     is_editing = st.session_state.editing_order_id is not None
     
-    if is_editing:
-        # Update existing
-        for idx, order in enumerate(st.session_state.orders):
-            if order["order_id"] == st.session_state.editing_order_id:
-                st.session_state.orders[idx] = {
-                    "order_id": st.session_state.editing_order_id,
-                    "customer": customer.strip(),
-                    "contact": contact.strip(),
-                    "note": note.strip(),
-                    "items": list(st.session_state.current_items),
-                }
-                break
-        st.session_state.editing_order_id = None
-    else:
-        # Create new
-        st.session_state.orders.append({
-            "order_id": int(st.session_state.next_order_id),
-            "customer": customer.strip(),
-            "contact": contact.strip(),
-            "note": note.strip(),
-            "items": list(st.session_state.current_items),
-        })
-        st.session_state.next_order_id += 1
+    try:
+        if is_editing:
+            # Update existing
+            store.update_order(
+                st.session_state.editing_order_id,
+                customer.strip(),
+                contact.strip(),
+                note.strip(),
+                list(st.session_state.current_items),
+                pickup=pickup,
+                customer_id=customer_id,
+            )
+            st.session_state.editing_order_id = None
+        else:
+            # Create new
+            order_id, order_number = get_order_allocator().allocate()
+            store.create_order(
+                order_id,
+                customer.strip(),
+                contact.strip(),
+                note.strip(),
+                list(st.session_state.current_items),
+                order_number=order_number,
+                pickup=pickup,
+                customer_id=customer_id,
+            )
+    except store.SoldOutError as exc:
+        # Another till took the last covers: keep the form, nothing was saved
+        st.session_state.cart_error = "Esaurito: " + ", ".join(
+            f"{dish} (ancora {left} coperti{' il ' + day if day else ''})" for _, dish, day, left in exc.shortages
+        )
+        notify("cart")
+        return
+    st.session_state.cart_error = ""
     # Clear form after save
     st.session_state.current_items = []
     st.session_state.form_customer = ""
     st.session_state.form_contact = ""
     st.session_state.form_note = ""
+    st.session_state.form_pickup = ""
+    st.session_state.form_customer_id = None
+    notify("orders", "editing")
 
 
 def clear_cart_callback():
     """Clear cart items."""
     st.session_state.current_items = []
+    st.session_state.cart_error = ""
+    notify("cart")
+
+
+def current_portion() -> int:
+    """Portion applied to the next dish: the custom value if numeric, else the preset."""
+    custom = st.session_state.custom_portion
+    return int(custom) if custom.isdigit() else st.session_state.selected_portion
+
+
+def select_portion_callback(portion: int):
+    """Pick a preset portion and clear the custom field."""
+    st.session_state.selected_portion = portion
+    st.session_state.custom_portion = ""
+    st.session_state.custom_portion_input = ""
+    notify("portion")
+
+
+def custom_portion_callback():
+    """Use the custom portion typed by the operator."""
+    st.session_state.custom_portion = st.session_state.custom_portion_input.strip()
+    notify("portion")
+
+
+def dish_remaining(dish: Dish) -> int | None:
+    """Covers of ``dish`` still free for this cart (None = no cap).
+
+    Reads the shared counters (season and pickup-day caps) and takes off
+    what the cart already holds; when editing, the order's own reservation
+    is given back first.
+    """
+    day = st.session_state.form_pickup[:10]
+    remaining = get_order_store().availability(dish.category, dish.name, day)
+    if not remaining:
+        return None
+    editing = st.session_state.orders.get(st.session_state.editing_order_id)
+    own = order_reservations(editing["items"], editing.get("pickup", "")) if editing else {}
+    in_cart = sum(
+        item["qty"] * item["portion"]
+        for item in st.session_state.current_items
+        if (item["category"], item["dish"]) == (dish.category, dish.name)
+    )
+    return min(left + own.get((dish.category, dish.name, bucket), 0) for bucket, left in remaining.items()) - in_cart
+
+
+def add_dish_callback(dish_id: int):
+    """Add one tray of a dish to the cart with the current portion, if its cap allows it."""
+    dish = MENU_CATALOG.get(dish_id)
+    portion = current_portion()
+    remaining = dish_remaining(dish)
+    if remaining is not None and remaining < portion:
+        st.session_state.cart_error = f"Esaurito: {dish.name} (ancora {max(remaining, 0)} coperti)"
+        notify("cart")
+        return
+    st.session_state.cart_error = ""
+    st.session_state.current_items.append({
+        "dish_id": dish.dish_id,
+        "category": dish.category,
+        "dish": dish.name,
+        "portion": portion,
+        "qty": 1,
+        "price": dish.price,
+        "unit": dish.unit,
+    })
+    notify("cart")
+
+
+def remove_cart_item_callback(index: int):
+    """Remove one line from the cart."""
+    if index < len(st.session_state.current_items):
+        st.session_state.current_items.pop(index)
+    notify("cart")
 
 
 def load_order_for_edit(order_id: int):
     """Load an order into the form for editing."""
-    for order in st.session_state.orders:
-        if order["order_id"] == order_id:
-            st.session_state.editing_order_id = order_id
-            st.session_state.form_customer = order['customer']
-            st.session_state.form_contact = order['contact']
-            st.session_state.form_note = order['note']
-            st.session_state.current_items = list(order['items'])
-            break
+    order = get_order_store().get_order(order_id)
+    if order is not None:
+        st.session_state.editing_order_id = order_id
+        st.session_state.form_customer = order['customer']
+        st.session_state.form_contact = order['contact']
+        st.session_state.form_note = order['note']
+        st.session_state.form_pickup = order.get('pickup', '')
+        st.session_state.form_customer_id = order.get('customer_id')
+        st.session_state.current_items = list(order['items'])
+    notify("editing")
 
 
 def delete_order_callback(order_id: int):
     """Delete an order."""
-    st.session_state.orders = [o for o in st.session_state.orders if o['order_id'] != order_id]
+    get_order_store().delete_order(order_id)
+    signals = ["orders"]
     if st.session_state.editing_order_id == order_id:
         st.session_state.editing_order_id = None
         st.session_state.form_customer = ""
         st.session_state.form_contact = ""
         st.session_state.form_note = ""
+        st.session_state.form_pickup = ""
+        st.session_state.form_customer_id = None
         st.session_state.current_items = []
+        signals.append("editing")
+    notify(*signals)
+
+
+def start_export_job_callback(kind: str):
+    """Queue a background export and remember it for this session's sidebar."""
+    job = get_export_jobs().submit(kind, get_order_store())
+    st.session_state.export_jobs.append(job.job_id)
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1410,27 +4956,16 @@ def save_customer_callback():
     if not name:
         return
     
+    store = get_order_store()
     if st.session_state.editing_customer_id is not None:
         # Update existing
-        for idx, cust in enumerate(st.session_state.customers):
-            if cust["id"] == st.session_state.editing_customer_id:
-                st.session_state.customers[idx] = {
-                    "id": st.session_state.editing_customer_id,
-                    "name": name,
-                    "contact": contact,
-                    "note": note,
-                }
-                break
+        store.update_customer(st.session_state.editing_customer_id, name, contact, note)
         st.session_state.editing_customer_id = None
     else:
         # Create new
-        st.session_state.customers.append({
-            "id": st.session_state.next_customer_id,
-            "name": name,
-            "contact": contact,
-            "note": note,
-        })
-        st.session_state.next_customer_id += 1
+        store.create_customer(name, contact, note)
+    # Patch the search index with just this customer
+    sync_state_from_store(store)
     
     # Clear form
     st.session_state.customer_form_name = ""
@@ -1440,7 +4975,9 @@ def save_customer_callback():
 
 def delete_customer_callback(customer_id: int):
     """Delete a customer from rubrica."""
-    st.session_state.customers = [c for c in st.session_state.customers if c["id"] != customer_id]
+    store = get_order_store()
+    store.delete_customer(customer_id)
+    sync_state_from_store(store)
     if st.session_state.editing_customer_id == customer_id:
         st.session_state.editing_customer_id = None
         st.session_state.customer_form_name = ""
@@ -1448,34 +4985,658 @@ def delete_customer_callback(customer_id: int):
         st.session_state.customer_form_note = ""
 
 
-def load_customer_for_edit(customer_id: int):
-    """Load customer into form for editing."""
-    for cust in st.session_state.customers:
-        if cust["id"] == customer_id:
-            st.session_state.editing_customer_id = customer_id
-            st.session_state.customer_form_name = cust["name"]
-            st.session_state.customer_form_contact = cust["contact"]
-            st.session_state.customer_form_note = cust.get("note", "")
-            break
+def scan_duplicates_callback():
+    """Batch pass over the whole rubrica: propose groups of duplicate entries."""
+    customer_orders = st.session_state.customer_orders
+    st.session_state.dedupe_proposals = dedupe_proposals(
+        st.session_state.customers, order_counts=lambda customer_id: customer_orders.stats(customer_id).orders
+    )
+
+
+def merge_customers_callback(keep_id: int, duplicate_ids: tuple[int, ...]):
+    """Merge a proposed group into one customer and move their orders to it."""
+    store = get_order_store()
+    store.merge_customers(keep_id, duplicate_ids)
+    sync_state_from_store(store)
+    merged = {keep_id, *duplicate_ids}
+    if st.session_state.editing_customer_id in merged:
+        cancel_customer_edit_callback()
+    if st.session_state.form_customer_id in duplicate_ids:
+        st.session_state.form_customer_id = keep_id
+    st.session_state.dedupe_proposals = [
+        proposal for proposal in st.session_state.dedupe_proposals or ()
+        if proposal.keep not in merged and not merged.intersection(proposal.duplicates)
+    ]
+
+
+def dismiss_duplicates_callback(keep_id: int):
+    """Leave a proposed group as it is."""
+    st.session_state.dedupe_proposals = [
+        proposal for proposal in st.session_state.dedupe_proposals or () if proposal.keep != keep_id
+    ]
+
+
+def load_customer_for_edit(customer_id: int):
+    """Load customer into form for editing."""
+    cust = get_order_store().get_customer(customer_id)
+    if cust is not None:
+        st.session_state.editing_customer_id = customer_id
+        st.session_state.customer_form_name = cust["name"]
+        st.session_state.customer_form_contact = cust["contact"]
+        st.session_state.customer_form_note = cust.get("note", "")
+
+
+def cancel_customer_edit_callback():
+    """Cancel customer editing."""
+    st.session_state.editing_customer_id = None
+    st.session_state.customer_form_name = ""
+    st.session_state.customer_form_contact = ""
+    st.session_state.customer_form_note = ""
+
+
+def select_customer_for_order(customer_id: int):
+    """Select a customer from rubrica for the current order."""
+    cust = get_order_store().get_customer(customer_id)
+    if cust is not None:
+        st.session_state.form_customer = cust["name"]
+        st.session_state.form_contact = cust["contact"]
+        st.session_state.form_customer_id = customer_id
+        if cust.get("note") and not st.session_state.form_note:
+            st.session_state.form_note = cust["note"]
+
+
+def customer_field_callback():
+    """Name/contact typed by hand: drop the Rubrica link once they no longer match it."""
+    linked = st.session_state.customers.get(st.session_state.form_customer_id)
+    if linked is not None and (
+        fold_text(linked["name"]) != fold_text(st.session_state.form_customer)
+        or fold_text(linked["contact"]) != fold_text(st.session_state.form_contact)
+    ):
+        st.session_state.form_customer_id = None
+    notify("customer")
+
+
+def use_pickup_slot_callback(slot: str):
+    """Move the order to a suggested pickup slot."""
+    st.session_state.form_pickup = slot
+    notify("customer")
+
+
+def pick_rubrica_customer_callback(customer_id: int):
+    """Fill the order form from a rubrica suggestion and clear the search."""
+    select_customer_for_order(customer_id)
+    st.session_state.rubrica_query = ""
+    notify("customer")
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# FRAMMENTI PAGINA ORDINI
+# ═══════════════════════════════════════════════════════════════════════════════
+
+
+@st.fragment(key="customer_form")
+def render_customer_form():
+    """Customer, contact and note fields with the form actions."""
+    sync_state_from_store(get_order_store())
+    
+    # Determine mode
+    is_editing = st.session_state.editing_order_id is not None
+    
+    # ─────────────────────────────────────────────────────────────────
+    # FORM DATI CLIENTE (sempre visibile per input)
+    # ─────────────────────────────────────────────────────────────────
+    
+    st.markdown(
+        """
+        <div style="
+            background: white;
+            border: 1px solid #E5E5E5;
+            padding: 1rem;
+            margin: 0.5rem 0 1rem 0;
+        ">
+        """,
+        unsafe_allow_html=True
+    )
+    
+    # Customer and Contact fields - SEMPRE VISIBILI
+    cust_col1, cust_col2 = st.columns(2)
+    
+    with cust_col1:
+        st.markdown(
+            "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.25rem;'>CLIENTE <span style='color: #C41E3A;'>*</span></p>",
+            unsafe_allow_html=True
+        )
+        st.text_input(
+            "Cliente",
+            placeholder="Nome / Cognome",
+            key="form_customer",
+            label_visibility="collapsed",
+            on_change=customer_field_callback,
+        )
+        
+        # Quick select from rubrica: top matches from the search index, picked by ID
+        if st.session_state.customers:
+            rubrica_query = st.text_input(
+                "Rubrica",
+                placeholder="🔍 Cerca in rubrica: nome o telefono",
+                key="rubrica_query",
+                label_visibility="collapsed",
+                on_change=notify,
+                args=("customer",),
+            )
+            if rubrica_query.strip():
+                suggestions = st.session_state.customers.search(rubrica_query, limit=RUBRICA_SUGGESTIONS)
+                if not suggestions:
+                    st.caption("Nessun cliente trovato")
+                for cust in suggestions:
+                    st.button(
+                        f"{cust['name']} · {cust['contact'] or '—'}",
+                        key=f"suggest_cust_{cust['id']}",
+                        use_container_width=True,
+                        on_click=pick_rubrica_customer_callback,
+                        args=(cust["id"],),
+                    )
+    
+    with cust_col2:
+        st.markdown(
+            "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.25rem;'>CONTATTO <span style='color: #C41E3A;'>*</span></p>",
+            unsafe_allow_html=True
+        )
+        st.text_input(
+            "Contatto",
+            placeholder="Telefono / Email",
+            key="form_contact",
+            label_visibility="collapsed",
+            on_change=customer_field_callback,
+        )
+    
+    # Notes field
+    st.markdown(
+        "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.25rem; margin-top: 0.5rem;'>NOTE / ALLERGIE</p>",
+        unsafe_allow_html=True
+    )
+    st.text_input(
+        "Note",
+        placeholder="Eventuali richieste speciali... (opzionale)",
+        key="form_note",
+        label_visibility="collapsed"
+    )
+    
+    # Pickup slot - each option shows the load already booked in that slot
+    st.markdown(
+        "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.25rem; margin-top: 0.5rem;'>RITIRO</p>",
+        unsafe_allow_html=True
+    )
+    pickup_index = st.session_state.pickup_index
+    editing_order = st.session_state.orders.get(st.session_state.editing_order_id)
+    
+    def pickup_label(slot: str) -> str:
+        if not slot:
+            return "— Da definire —"
+        trays, _ = pickup_index.load(slot, exclude=editing_order)
+        return f"{format_pickup(slot)} · {trays}/{slot_capacity(slot)[0]} vassoi"
+    
+    pickup_options = ("", *PICKUP_SLOTS)
+    if st.session_state.form_pickup not in pickup_options:
+        pickup_options += (st.session_state.form_pickup,)  # slot no longer in the calendar
+    st.selectbox(
+        "Ritiro",
+        pickup_options,
+        format_func=pickup_label,
+        key="form_pickup",
+        label_visibility="collapsed",
+        on_change=notify,
+        args=("customer",),
+    )
+    
+    st.markdown("</div>", unsafe_allow_html=True)
+    
+    # ─────────────────────────────────────────────────────────────────
+    # BOTTONI AZIONE
+    # ─────────────────────────────────────────────────────────────────
+    
+    btn_col1, btn_col2 = st.columns([1, 1])
+    with btn_col1:
+        if is_editing:
+            st.button("✕ ANNULLA MODIFICA", use_container_width=True, key="cancel_edit_btn", on_click=cancel_edit_callback)
+    with btn_col2:
+        st.button("🔄 RESET FORM", use_container_width=True, key="reset_form_btn", on_click=reset_form_callback)
+
+
+@st.fragment(key="portion_picker")
+def render_portion_picker():
+    """Preset and custom portion selector."""
+    # PORZIONI - 5 radio button orizzontali + custom
+    st.markdown(
+        "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.5rem;'>PORZIONI</p>",
+        unsafe_allow_html=True
+    )
+    
+    # Radio buttons per porzioni predefinite
+    porz_cols = st.columns([1, 1, 1, 1, 1, 0.8, 1])
+    
+    preset_portions = [1, 2, 3, 4, 5]
+    
+    for i, portion_val in enumerate(preset_portions):
+        with porz_cols[i]:
+            is_selected = st.session_state.selected_portion == portion_val and not st.session_state.custom_portion
+            btn_style = "primary" if is_selected else "secondary"
+            st.button(
+                str(portion_val), 
+                key=f"porz_{portion_val}",
+                use_container_width=True,
+                type=btn_style if is_selected else "secondary",
+                on_click=select_portion_callback,
+                args=(portion_val,),
+            )
+    
+    # Custom portion input
+    with porz_cols[5]:
+        st.markdown("<div style='text-align: center; font-size: 0.7rem; color: #737373; padding-top: 0.5rem;'>o</div>", unsafe_allow_html=True)
+    
+    with porz_cols[6]:
+        st.text_input(
+            "Custom",
+            placeholder="N°",
+            key="custom_portion_input",
+            label_visibility="collapsed",
+            on_change=custom_portion_callback,
+        )
+    
+    # Determine final portion value
+    dish_portion = current_portion()
+    
+    # Show current selection
+    st.markdown(
+        f"<p style='font-size: 0.75rem; color: #059669; margin: 0.25rem 0 0.618rem 0;'>✓ Selezionato: <b>{dish_portion}</b> {'porzione' if dish_portion == 1 else 'porzioni'}</p>",
+        unsafe_allow_html=True
+    )
+
+
+@st.fragment(key="dish_grid")
+def render_dish_grid(cat_name: str):
+    """Dish buttons for one category; a click only reruns the cart."""
+    # ─────────────────────────────────────────────────────────────────
+    # PIATTI DELLA CATEGORIA SELEZIONATA (da sidebar)
+    # ─────────────────────────────────────────────────────────────────
+    
+    # Category header
+    st.markdown(
+        f"""
+        <div style="
+            background: #0A0A0A;
+            color: white;
+            padding: 0.5rem 1rem;
+            margin-bottom: 0.5rem;
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+        ">
+            <span style="font-size: 0.9rem; font-weight: 700; letter-spacing: 0.05em; text-transform: uppercase;">{cat_name}</span>
+            <span style="font-size: 0.65rem; color: #A3A3A3;">← Cambia categoria dalla sidebar</span>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+    
+    # Show category note/preparation instructions
+    cat_note = get_category_note(cat_name)
+    if cat_note:
+        st.markdown(
+            f"""
+            <div style="
+                background: #F0FDF4;
+                border-left: 3px solid #22C55E;
+                padding: 0.5rem 0.75rem;
+                margin-bottom: 0.75rem;
+                font-size: 0.7rem;
+                color: #166534;
+            ">
+                💡 {cat_note}
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+    
+    # Precomputed dishes for this category (labels, prices, IDs)
+    dishes = MENU_CATALOG.category_dishes(cat_name)
+    # Capped dishes → covers left (read from the shared counters, checked again on click)
+    availability = get_order_store().availability_map(st.session_state.form_pickup[:10])
+    
+    # Create button grid - 3 buttons per row (larger to show price)
+    cols_per_row = 3
+    for row_start in range(0, len(dishes), cols_per_row):
+        row_items = dishes[row_start:row_start + cols_per_row]
+        cols = st.columns(cols_per_row)
+        
+        for item_idx, dish in enumerate(row_items):
+            with cols[item_idx]:
+                btn_key = f"dish_{cat_name}_{row_start + item_idx}"
+                remaining = availability.get((dish.category, dish.name))
+                if remaining is None:
+                    badge = dish.price_label
+                elif remaining > 0:
+                    badge = f"{dish.price_label} · rimasti {remaining}"
+                else:
+                    badge = "ESAURITO"
+                
+                # Button with price badge
+                st.markdown(
+                    f"""
+                    <div style="
+                        font-size: 0.65rem;
+                        color: #C41E3A;
+                        font-weight: 700;
+                        text-align: right;
+                        margin-bottom: -0.25rem;
+                    ">{badge}</div>
+                    """,
+                    unsafe_allow_html=True
+                )
+                
+                st.button(dish.display_name, key=btn_key, use_container_width=True, help=dish.desc or None,
+                          disabled=remaining is not None and remaining <= 0,
+                          on_click=add_dish_callback, args=(dish.dish_id,))
+
+
+@st.fragment(key="cart")
+def render_cart():
+    """Cart lines, totals and the save button."""
+    # ─────────────────────────────────────────────────────────────────
+    # SEZIONE 3: CARRELLO
+    # ─────────────────────────────────────────────────────────────────
+    
+    st.markdown(
+        f"""
+        <div style="
+            background: #FEF3C7;
+            border-left: 4px solid #D97706;
+            padding: 0.618rem 1rem;
+            margin-bottom: 1rem;
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+        ">
+            <span style="font-size: 0.7rem; font-weight: 700; letter-spacing: 0.15em; text-transform: uppercase; color: #92400E;">③ CARRELLO</span>
+            <span style="font-size: 1.2rem; font-weight: 800; color: #92400E;">{len(st.session_state.current_items)} piatti</span>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+    
+    if st.session_state.cart_error:
+        st.error(st.session_state.cart_error)
+    
+    if st.session_state.current_items:
+        # Items list
+        for i, item in enumerate(st.session_state.current_items):
+            ic1, ic2 = st.columns([5, 1])
+            with ic1:
+                # Get price info
+                dish = MENU_CATALOG.resolve(item)
+                if dish is not None:
+                    price_display = dish.price_label if dish.price > 0 else ""
+                else:
+                    item_price = item.get('price', 0)
+                    price_display = format_price(item_price, item.get('unit', 'etto')) if item_price > 0 else ""
+                
+                st.markdown(
+                    f"""
+                    <div style="
+                        background: white;
+                        border: 1px solid #E5E5E5;
+                        padding: 0.618rem;
+                        margin-bottom: 0.382rem;
+                        display: flex;
+                        justify-content: space-between;
+                        align-items: flex-start;
+                    ">
+                        <div>
+                            <div style="font-weight: 600; font-size: 0.85rem; color: #0A0A0A;">{item['dish']}</div>
+                            <div style="font-size: 0.7rem; color: #737373;">{item['category']} · per {item['portion']} · {item['qty']} vassoi</div>
+                        </div>
+                        <div style="font-size: 0.75rem; font-weight: 700; color: #C41E3A;">{price_display}</div>
+                    </div>
+                    """,
+                    unsafe_allow_html=True
+                )
+            with ic2:
+                st.button("✕", key=f"del_item_{i}", on_click=remove_cart_item_callback, args=(i,))
+        
+        # Totals
+        total_vassoi = sum(it['qty'] for it in st.session_state.current_items)
+        total_coperti = sum(it['qty'] * it['portion'] for it in st.session_state.current_items)
+        # Estimated price with unit semantics (etto → weight, pezzo → pieces, ...)
+        total_stima = estimate_items(st.session_state.current_items)
+        
+        st.markdown(
+            f"""
+            <div style="
+                text-align: right;
+                padding: 1rem 0;
+                border-top: 2px solid #E5E5E5;
+                margin-top: 0.618rem;
+            ">
+                <div style="font-size: 0.7rem; color: #737373; text-transform: uppercase; letter-spacing: 0.1em;">Totale</div>
+                <div style="font-size: 1.618rem; font-weight: 800; color: #0A0A0A;">{total_vassoi} vassoi · {total_coperti} coperti</div>
+                <div style="font-size: 0.8rem; color: #C41E3A; font-weight: 600; margin-top: 0.25rem;">Stima: {format_euro(total_stima)}</div>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+        
+        # Pickup slot capacity (load of the slot without this order when editing)
+        pickup = st.session_state.form_pickup
+        if pickup:
+            editing_order = st.session_state.orders.get(st.session_state.editing_order_id)
+            pickup_index = st.session_state.pickup_index
+            if pickup_index.fits(pickup, total_vassoi, total_coperti, exclude=editing_order):
+                st.caption(f"🕒 Ritiro {format_pickup(pickup)}")
+            else:
+                booked_trays, booked_covers = pickup_index.load(pickup, exclude=editing_order)
+                max_trays, max_covers = slot_capacity(pickup)
+                st.warning(
+                    f"Fascia {format_pickup(pickup)} piena: {booked_trays}/{max_trays} vassoi, "
+                    f"{booked_covers}/{max_covers} coperti già prenotati."
+                )
+                suggestion = pickup_index.nearest_free(pickup, total_vassoi, total_coperti, exclude=editing_order)
+                if suggestion:
+                    st.button(
+                        f"🕒 Sposta a {format_pickup(suggestion)}",
+                        key="use_pickup_btn",
+                        use_container_width=True,
+                        on_click=use_pickup_slot_callback,
+                        args=(suggestion,),
+                    )
+        
+        st.markdown("<div style='height: 0.618rem;'></div>", unsafe_allow_html=True)
+        
+        # Save button - check validation
+        is_editing = st.session_state.editing_order_id is not None
+        can_save = bool(
+            st.session_state.form_customer.strip()
+            and st.session_state.form_contact.strip()
+            and st.session_state.current_items
+        )
+        
+        save_col1, save_col2 = st.columns([2, 1])
+        with save_col1:
+            save_label = "✓ AGGIORNA ORDINE" if is_editing else "✓ SALVA ORDINE"
+            st.button(save_label, use_container_width=True, type="primary", key="save_order_btn", 
+                      disabled=not can_save, on_click=save_order_callback)
+        
+        with save_col2:
+            st.button("🗑 SVUOTA", use_container_width=True, key="clear_cart_btn", 
+                      on_click=clear_cart_callback)
+        
+        if not can_save:
+            st.markdown(
+                "<p style='font-size: 0.7rem; color: #C41E3A; text-align: center; margin-top: 0.5rem;'>⚠ Compila Cliente e Contatto per salvare</p>",
+                unsafe_allow_html=True
+            )
+    
+    else:
+        st.markdown(
+            """
+            <div style="
+                text-align: center;
+                padding: 2.618rem 1rem;
+                color: #A3A3A3;
+            ">
+                <div style="font-size: 2rem; margin-bottom: 0.618rem;">🛒</div>
+                <div style="font-size: 0.8rem;">Aggiungi piatti per iniziare</div>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+
+
+@st.fragment(key="order_list")
+def render_order_list():
+    """Saved orders with edit/delete actions and the Excel export."""
+    sync_state_from_store(get_order_store())
+    
+    st.markdown(
+        f"""
+        <div style="
+            background: #ECFDF5;
+            border-left: 4px solid #059669;
+            padding: 0.618rem 1rem;
+            margin-bottom: 1.618rem;
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+        ">
+            <span style="font-size: 0.7rem; font-weight: 700; letter-spacing: 0.15em; text-transform: uppercase; color: #065F46;">ORDINI SALVATI</span>
+            <span style="font-size: 1.2rem; font-weight: 800; color: #065F46;">{len(st.session_state.orders)}</span>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+    
+    if not st.session_state.orders:
+        st.markdown(
+            """
+            <div style="
+                text-align: center;
+                padding: 2.618rem 1rem;
+                color: #A3A3A3;
+            ">
+                <div style="font-size: 2rem; margin-bottom: 0.618rem;">📋</div>
+                <div style="font-size: 0.8rem;">Nessun ordine salvato</div>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+    else:
+        # Orders list (all orders, scrollable)
+        revenue = current_revenue()
+        for order in reversed(st.session_state.orders):
+            order_id = order['order_id']
+            items_count = len(order['items'])
+            vassoi = sum(i['qty'] for i in order['items'])
+            importo = revenue.by_order.get(order_id, 0.0)
+            is_selected = st.session_state.editing_order_id == order_id
+            
+            border_style = "2px solid #D97706" if is_selected else "1px solid #E5E5E5"
+            bg_color = "#FFFBEB" if is_selected else "white"
+            
+            st.markdown(
+                f"""
+                <div style="
+                    background: {bg_color};
+                    border: {border_style};
+                    padding: 0.618rem;
+                    margin-bottom: 0.618rem;
+                ">
+                    <div style="display: flex; justify-content: space-between; align-items: center;">
+                        <span style="font-weight: 800; font-size: 1rem; color: #0A0A0A;">#{order['order_number']}</span>
+                        <span style="font-size: 0.7rem; color: #737373;">{vassoi} vassoi · {format_euro(importo)}</span>
+                    </div>
+                    <div style="font-size: 0.85rem; font-weight: 600; color: #525252; margin-top: 0.25rem;">{order['customer'] or '—'}</div>
+                    <div style="font-size: 0.7rem; color: #A3A3A3;">{order['contact'] or '—'} · {items_count} piatti · ritiro {format_pickup(order.get('pickup', ''))}</div>
+                </div>
+                """,
+                unsafe_allow_html=True
+            )
+            
+            # Action buttons
+            ob1, ob2 = st.columns(2)
+            with ob1:
+                st.button("✏️ Modifica", key=f"edit_{order_id}", use_container_width=True, 
+                          on_click=load_order_for_edit, args=(order_id,))
+            with ob2:
+                st.button("🗑️ Elimina", key=f"del_{order_id}", use_container_width=True,
+                          on_click=delete_order_callback, args=(order_id,))
+            
+            st.markdown("<div style='height: 0.382rem;'></div>", unsafe_allow_html=True)
+        
+        # Export button
+        st.markdown("<div style='height: 1rem;'></div>", unsafe_allow_html=True)
+        st.download_button(
+            "⬇ ESPORTA EXCEL",
+            data=lazy_season_export(get_order_store()),
+            file_name="ordini_natale_2025.xlsx",
+            mime=XLSX_MIME,
+            use_container_width=True,
+        )
+
+
+def dish_caps_frame(caps: list[dict]) -> pd.DataFrame:
+    """Caps for the editor: one row per (dish, day) with reserved and remaining covers."""
+    return pd.DataFrame(
+        [
+            {
+                "piatto": cap["dish"],
+                "giorno": cap["day"],
+                "limite": cap["cap"],
+                "prenotati": cap["reserved"],
+                "rimasti": cap["cap"] - cap["reserved"],
+            }
+            for cap in caps
+        ],
+        columns=["piatto", "giorno", "limite", "prenotati", "rimasti"],
+    )
 
 
-def cancel_customer_edit_callback():
-    """Cancel customer editing."""
-    st.session_state.editing_customer_id = None
-    st.session_state.customer_form_name = ""
-    st.session_state.customer_form_contact = ""
-    st.session_state.customer_form_note = ""
+def caps_from_editor(frame: pd.DataFrame) -> list[dict]:
+    """Rows of the caps editor back to store caps; incomplete rows are dropped."""
+    caps = []
+    for row in frame.itertuples(index=False):
+        dish = MENU_CATALOG.by_name(row.piatto) if isinstance(row.piatto, str) else None
+        if dish is None or pd.isna(row.limite):
+            continue
+        day = row.giorno if isinstance(row.giorno, str) else ""
+        caps.append({"category": dish.category, "dish": dish.name, "day": day, "cap": int(row.limite)})
+    return caps
 
 
-def select_customer_for_order(customer_id: int):
-    """Select a customer from rubrica for the current order."""
-    for cust in st.session_state.customers:
-        if cust["id"] == customer_id:
-            st.session_state.form_customer = cust["name"]
-            st.session_state.form_contact = cust["contact"]
-            if cust.get("note") and not st.session_state.form_note:
-                st.session_state.form_note = cust["note"]
-            break
+def render_dish_caps_editor():
+    """Per-dish production caps (whole season or one pickup day), in covers."""
+    store = get_order_store()
+    revision = st.session_state.setdefault("dish_caps_revision", 0)
+    edited = st.data_editor(
+        dish_caps_frame(store.list_dish_caps()),
+        num_rows="dynamic",
+        hide_index=True,
+        use_container_width=True,
+        key=f"dish_caps_editor_{revision}",
+        column_config={
+            "piatto": st.column_config.SelectboxColumn(
+                "Piatto", options=[dish.name for dish in MENU_CATALOG.dishes], required=True
+            ),
+            "giorno": st.column_config.SelectboxColumn(
+                "Giorno", options=["", *PICKUP_DAYS], help="Vuoto = tutta la stagione"
+            ),
+            "limite": st.column_config.NumberColumn("Limite (coperti)", min_value=0, step=1, required=True),
+            "prenotati": st.column_config.NumberColumn("Prenotati", disabled=True),
+            "rimasti": st.column_config.NumberColumn("Rimasti", disabled=True),
+        },
+    )
+    if st.button("✓ Salva limiti", key="save_dish_caps"):
+        store.replace_dish_caps(caps_from_editor(edited))
+        st.session_state.dish_caps_revision = revision + 1  # fresh editor over the saved caps
+        st.rerun()
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1492,10 +5653,10 @@ def main() -> None:
     # Initialize
     menu = build_menu()
     ensure_state(menu)
-    orders_df = build_orders_dataframe(st.session_state.orders)
+    sync_state_from_store(get_order_store())
     
     # Sidebar with navigation - returns selected page and category
-    selected_page, selected_category = render_sidebar(orders_df, len(st.session_state.orders), menu)
+    selected_page, selected_category = render_sidebar(menu)
     
     # ═══════════════════════════════════════════════════════════════════════════
     # PAGE: ORDINI
@@ -1510,96 +5671,7 @@ def main() -> None:
         # ═══════════════════════════════════════════════════════════════════════
         
         with col_form:
-            # Determine mode
-            is_editing = st.session_state.editing_order_id is not None
-            current_order_id = st.session_state.editing_order_id if is_editing else st.session_state.next_order_id
-            
-            # ─────────────────────────────────────────────────────────────────
-            # FORM DATI CLIENTE (sempre visibile per input)
-            # ─────────────────────────────────────────────────────────────────
-            
-            st.markdown(
-                """
-                <div style="
-                    background: white;
-                    border: 1px solid #E5E5E5;
-                    padding: 1rem;
-                    margin: 0.5rem 0 1rem 0;
-                ">
-                """,
-                unsafe_allow_html=True
-            )
-            
-            # Customer and Contact fields - SEMPRE VISIBILI
-            cust_col1, cust_col2 = st.columns(2)
-            
-            with cust_col1:
-                st.markdown(
-                    "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.25rem;'>CLIENTE <span style='color: #C41E3A;'>*</span></p>",
-                    unsafe_allow_html=True
-                )
-                customer = st.text_input(
-                    "Cliente",
-                    placeholder="Nome / Cognome",
-                    key="form_customer",
-                    label_visibility="collapsed"
-                )
-                
-                # Quick select from rubrica
-                if st.session_state.customers:
-                    customer_options = ["— Seleziona dalla rubrica —"] + [c["name"] for c in st.session_state.customers]
-                    selected_rubrica = st.selectbox(
-                        "Rubrica",
-                        customer_options,
-                        key="rubrica_select",
-                        label_visibility="collapsed"
-                    )
-                    if selected_rubrica != "— Seleziona dalla rubrica —":
-                        # Find and load customer
-                        for cust in st.session_state.customers:
-                            if cust["name"] == selected_rubrica:
-                                if st.session_state.form_customer != cust["name"]:
-                                    select_customer_for_order(cust["id"])
-                                    st.rerun()
-                                break
-            
-            with cust_col2:
-                st.markdown(
-                    "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.25rem;'>CONTATTO <span style='color: #C41E3A;'>*</span></p>",
-                    unsafe_allow_html=True
-                )
-                contact = st.text_input(
-                    "Contatto",
-                    placeholder="Telefono / Email",
-                    key="form_contact",
-                    label_visibility="collapsed"
-                )
-            
-            # Notes field
-            st.markdown(
-                "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.25rem; margin-top: 0.5rem;'>NOTE / ALLERGIE</p>",
-                unsafe_allow_html=True
-            )
-            note = st.text_input(
-                "Note",
-                placeholder="Eventuali richieste speciali... (opzionale)",
-                key="form_note",
-                label_visibility="collapsed"
-            )
-            
-            st.markdown("</div>", unsafe_allow_html=True)
-            
-            # ─────────────────────────────────────────────────────────────────
-            # BOTTONI AZIONE
-            # ─────────────────────────────────────────────────────────────────
-            
-            btn_col1, btn_col2 = st.columns([1, 1])
-            with btn_col1:
-                if is_editing:
-                    st.button("✕ ANNULLA MODIFICA", use_container_width=True, key="cancel_edit_btn", on_click=cancel_edit_callback)
-            with btn_col2:
-                st.button("🔄 RESET FORM", use_container_width=True, key="reset_form_btn", on_click=reset_form_callback)
-            
+            render_customer_form()
             st.markdown("<div style='height: 0.5rem;'></div>", unsafe_allow_html=True)
             
             # ─────────────────────────────────────────────────────────────────
@@ -1621,367 +5693,18 @@ def main() -> None:
                 """,
                 unsafe_allow_html=True
             )
-            
-            # PORZIONI - 5 radio button orizzontali + custom
-            st.markdown(
-                "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.5rem;'>PORZIONI</p>",
-                unsafe_allow_html=True
-            )
-            
-            # Radio buttons per porzioni predefinite
-            porz_cols = st.columns([1, 1, 1, 1, 1, 0.8, 1])
-            
-            # Initialize portion state if needed
-            if "selected_portion" not in st.session_state:
-                st.session_state.selected_portion = 1
-            if "custom_portion" not in st.session_state:
-                st.session_state.custom_portion = ""
-            
-            preset_portions = [1, 2, 3, 4, 5]
-            
-            for i, portion_val in enumerate(preset_portions):
-                with porz_cols[i]:
-                    is_selected = st.session_state.selected_portion == portion_val and not st.session_state.custom_portion
-                    btn_style = "primary" if is_selected else "secondary"
-                    if st.button(
-                        str(portion_val), 
-                        key=f"porz_{portion_val}",
-                        use_container_width=True,
-                        type=btn_style if is_selected else "secondary"
-                    ):
-                        st.session_state.selected_portion = portion_val
-                        st.session_state.custom_portion = ""
-                        st.rerun()
-            
-            # Custom portion input
-            with porz_cols[5]:
-                st.markdown("<div style='text-align: center; font-size: 0.7rem; color: #737373; padding-top: 0.5rem;'>o</div>", unsafe_allow_html=True)
-            
-            with porz_cols[6]:
-                custom_val = st.text_input(
-                    "Custom",
-                    value=st.session_state.custom_portion,
-                    placeholder="N°",
-                    key="custom_portion_input",
-                    label_visibility="collapsed"
-                )
-                if custom_val != st.session_state.custom_portion:
-                    st.session_state.custom_portion = custom_val
-                    st.rerun()
-            
-            # Determine final portion value
-            if st.session_state.custom_portion and st.session_state.custom_portion.isdigit():
-                dish_portion = int(st.session_state.custom_portion)
-            else:
-                dish_portion = st.session_state.selected_portion
-            
-            # Show current selection
-            st.markdown(
-                f"<p style='font-size: 0.75rem; color: #059669; margin: 0.25rem 0 0.618rem 0;'>✓ Selezionato: <b>{dish_portion}</b> {'porzione' if dish_portion == 1 else 'porzioni'}</p>",
-                unsafe_allow_html=True
-            )
-            
+            render_portion_picker()
             st.markdown("<div style='height: 0.382rem;'></div>", unsafe_allow_html=True)
-            
-            # ─────────────────────────────────────────────────────────────────
-            # PIATTI DELLA CATEGORIA SELEZIONATA (da sidebar)
-            # ─────────────────────────────────────────────────────────────────
-            
-            cat_name = selected_category if selected_category else list(menu.keys())[0]
-            
-            # Category header
-            st.markdown(
-                f"""
-                <div style="
-                    background: #0A0A0A;
-                    color: white;
-                    padding: 0.5rem 1rem;
-                    margin-bottom: 0.5rem;
-                    display: flex;
-                    justify-content: space-between;
-                    align-items: center;
-                ">
-                    <span style="font-size: 0.9rem; font-weight: 700; letter-spacing: 0.05em; text-transform: uppercase;">{cat_name}</span>
-                    <span style="font-size: 0.65rem; color: #A3A3A3;">← Cambia categoria dalla sidebar</span>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
-            
-            # Show category note/preparation instructions
-            cat_note = get_category_note(cat_name)
-            if cat_note:
-                st.markdown(
-                    f"""
-                    <div style="
-                        background: #F0FDF4;
-                        border-left: 3px solid #22C55E;
-                        padding: 0.5rem 0.75rem;
-                        margin-bottom: 0.75rem;
-                        font-size: 0.7rem;
-                        color: #166534;
-                    ">
-                        💡 {cat_note}
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-            
-            # Get full menu data for this category
-            if cat_name in MENU_2025:
-                items_data = MENU_2025[cat_name]["items"]
-            else:
-                items_data = [{"name": d, "price": 0, "unit": "etto"} for d in menu.get(cat_name, [])]
-            
-            # Create button grid - 3 buttons per row (larger to show price)
-            cols_per_row = 3
-            for row_start in range(0, len(items_data), cols_per_row):
-                row_items = items_data[row_start:row_start + cols_per_row]
-                cols = st.columns(cols_per_row)
-                
-                for item_idx, item_data in enumerate(row_items):
-                    with cols[item_idx]:
-                        dish_name = item_data["name"]
-                        price = item_data.get("price", 0)
-                        unit = item_data.get("unit", "etto")
-                        desc = item_data.get("desc", "")
-                        
-                        # Format display
-                        display_name = dish_name[:22] + "…" if len(dish_name) > 24 else dish_name
-                        price_label = format_price(price, unit)
-                        btn_key = f"dish_{cat_name}_{row_start + item_idx}"
-                        
-                        # Button with price badge
-                        st.markdown(
-                            f"""
-                            <div style="
-                                font-size: 0.65rem;
-                                color: #C41E3A;
-                                font-weight: 700;
-                                text-align: right;
-                                margin-bottom: -0.25rem;
-                            ">{price_label}</div>
-                            """,
-                            unsafe_allow_html=True
-                        )
-                        
-                        if st.button(display_name, key=btn_key, use_container_width=True, help=desc if desc else None):
-                            st.session_state.current_items.append({
-                                "category": cat_name,
-                                "dish": dish_name,
-                                "portion": int(dish_portion),
-                                "qty": 1,
-                                "price": price,
-                                "unit": unit,
-                            })
-                            st.rerun()
-            
+            render_dish_grid(selected_category if selected_category else list(menu.keys())[0])
             st.markdown("<div style='height: 1.618rem;'></div>", unsafe_allow_html=True)
-            
-            # ─────────────────────────────────────────────────────────────────
-            # SEZIONE 3: CARRELLO
-            # ─────────────────────────────────────────────────────────────────
-            
-            st.markdown(
-                f"""
-                <div style="
-                    background: #FEF3C7;
-                    border-left: 4px solid #D97706;
-                    padding: 0.618rem 1rem;
-                    margin-bottom: 1rem;
-                    display: flex;
-                    justify-content: space-between;
-                    align-items: center;
-                ">
-                    <span style="font-size: 0.7rem; font-weight: 700; letter-spacing: 0.15em; text-transform: uppercase; color: #92400E;">③ CARRELLO</span>
-                    <span style="font-size: 1.2rem; font-weight: 800; color: #92400E;">{len(st.session_state.current_items)} piatti</span>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
-            
-            if st.session_state.current_items:
-                # Items list
-                for i, item in enumerate(st.session_state.current_items):
-                    ic1, ic2 = st.columns([5, 1])
-                    with ic1:
-                        # Get price info
-                        item_price = item.get('price', 0)
-                        item_unit = item.get('unit', 'etto')
-                        price_display = format_price(item_price, item_unit) if item_price > 0 else ""
-                        
-                        st.markdown(
-                            f"""
-                            <div style="
-                                background: white;
-                                border: 1px solid #E5E5E5;
-                                padding: 0.618rem;
-                                margin-bottom: 0.382rem;
-                                display: flex;
-                                justify-content: space-between;
-                                align-items: flex-start;
-                            ">
-                                <div>
-                                    <div style="font-weight: 600; font-size: 0.85rem; color: #0A0A0A;">{item['dish']}</div>
-                                    <div style="font-size: 0.7rem; color: #737373;">{item['category']} · per {item['portion']} · {item['qty']} vassoi</div>
-                                </div>
-                                <div style="font-size: 0.75rem; font-weight: 700; color: #C41E3A;">{price_display}</div>
-                            </div>
-                            """,
-                            unsafe_allow_html=True
-                        )
-                    with ic2:
-                        if st.button("✕", key=f"del_item_{i}"):
-                            st.session_state.current_items.pop(i)
-                            st.rerun()
-                
-                # Totals
-                total_vassoi = sum(it['qty'] for it in st.session_state.current_items)
-                total_coperti = sum(it['qty'] * it['portion'] for it in st.session_state.current_items)
-                # Estimated price (price * qty, note: this is per unit, not exact total)
-                total_stima = sum(it.get('price', 0) * it['qty'] for it in st.session_state.current_items)
-                
-                st.markdown(
-                    f"""
-                    <div style="
-                        text-align: right;
-                        padding: 1rem 0;
-                        border-top: 2px solid #E5E5E5;
-                        margin-top: 0.618rem;
-                    ">
-                        <div style="font-size: 0.7rem; color: #737373; text-transform: uppercase; letter-spacing: 0.1em;">Totale</div>
-                        <div style="font-size: 1.618rem; font-weight: 800; color: #0A0A0A;">{total_vassoi} vassoi · {total_coperti} coperti</div>
-                        <div style="font-size: 0.8rem; color: #C41E3A; font-weight: 600; margin-top: 0.25rem;">Stima: €{total_stima:.2f}</div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-                
-                st.markdown("<div style='height: 0.618rem;'></div>", unsafe_allow_html=True)
-                
-                # Save button - check validation
-                can_save = bool(customer.strip() and contact.strip() and st.session_state.current_items)
-                
-                save_col1, save_col2 = st.columns([2, 1])
-                with save_col1:
-                    save_label = "✓ AGGIORNA ORDINE" if is_editing else "✓ SALVA ORDINE"
-                    st.button(save_label, use_container_width=True, type="primary", key="save_order_btn", 
-                              disabled=not can_save, on_click=save_order_callback)
-                
-                with save_col2:
-                    st.button("🗑 SVUOTA", use_container_width=True, key="clear_cart_btn", 
-                              on_click=clear_cart_callback)
-                
-                if not can_save:
-                    st.markdown(
-                        "<p style='font-size: 0.7rem; color: #C41E3A; text-align: center; margin-top: 0.5rem;'>⚠ Compila Cliente e Contatto per salvare</p>",
-                        unsafe_allow_html=True
-                    )
-            
-            else:
-                st.markdown(
-                    """
-                    <div style="
-                        text-align: center;
-                        padding: 2.618rem 1rem;
-                        color: #A3A3A3;
-                    ">
-                        <div style="font-size: 2rem; margin-bottom: 0.618rem;">🛒</div>
-                        <div style="font-size: 0.8rem;">Aggiungi piatti per iniziare</div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
+            render_cart()
         
         # ═══════════════════════════════════════════════════════════════════════
         # COLONNA DESTRA: LISTA ORDINI
         # ═══════════════════════════════════════════════════════════════════════
         
         with col_orders:
-            st.markdown(
-                f"""
-                <div style="
-                    background: #ECFDF5;
-                    border-left: 4px solid #059669;
-                    padding: 0.618rem 1rem;
-                    margin-bottom: 1.618rem;
-                    display: flex;
-                    justify-content: space-between;
-                    align-items: center;
-                ">
-                    <span style="font-size: 0.7rem; font-weight: 700; letter-spacing: 0.15em; text-transform: uppercase; color: #065F46;">ORDINI SALVATI</span>
-                    <span style="font-size: 1.2rem; font-weight: 800; color: #065F46;">{len(st.session_state.orders)}</span>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
-            
-            if not st.session_state.orders:
-                st.markdown(
-                    """
-                    <div style="
-                        text-align: center;
-                        padding: 2.618rem 1rem;
-                        color: #A3A3A3;
-                    ">
-                        <div style="font-size: 2rem; margin-bottom: 0.618rem;">📋</div>
-                        <div style="font-size: 0.8rem;">Nessun ordine salvato</div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-            else:
-                # Orders list (all orders, scrollable)
-                for order in reversed(st.session_state.orders):
-                    order_id = order['order_id']
-                    items_count = len(order['items'])
-                    vassoi = sum(i['qty'] for i in order['items'])
-                    is_selected = st.session_state.editing_order_id == order_id
-                    
-                    border_style = "2px solid #D97706" if is_selected else "1px solid #E5E5E5"
-                    bg_color = "#FFFBEB" if is_selected else "white"
-                    
-                    st.markdown(
-                        f"""
-                        <div style="
-                            background: {bg_color};
-                            border: {border_style};
-                            padding: 0.618rem;
-                            margin-bottom: 0.618rem;
-                        ">
-                            <div style="display: flex; justify-content: space-between; align-items: center;">
-                                <span style="font-weight: 800; font-size: 1rem; color: #0A0A0A;">#{order_id}</span>
-                                <span style="font-size: 0.7rem; color: #737373;">{vassoi} vassoi</span>
-                            </div>
-                            <div style="font-size: 0.85rem; font-weight: 600; color: #525252; margin-top: 0.25rem;">{order['customer'] or '—'}</div>
-                            <div style="font-size: 0.7rem; color: #A3A3A3;">{order['contact'] or '—'} · {items_count} piatti</div>
-                        </div>
-                        """,
-                        unsafe_allow_html=True
-                    )
-                    
-                    # Action buttons
-                    ob1, ob2 = st.columns(2)
-                    with ob1:
-                        st.button("✏️ Modifica", key=f"edit_{order_id}", use_container_width=True, 
-                                  on_click=load_order_for_edit, args=(order_id,))
-                    with ob2:
-                        st.button("🗑️ Elimina", key=f"del_{order_id}", use_container_width=True,
-                                  on_click=delete_order_callback, args=(order_id,))
-                    
-                    st.markdown("<div style='height: 0.382rem;'></div>", unsafe_allow_html=True)
-                
-                # Export button
-                st.markdown("<div style='height: 1rem;'></div>", unsafe_allow_html=True)
-                totals_df, freq_df = build_totals(st.session_state.orders)
-                excel_data = export_excel(orders_df, totals_df, freq_df)
-                st.download_button(
-                    "⬇ ESPORTA EXCEL",
-                    data=excel_data,
-                    file_name="ordini_natale_2025.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    use_container_width=True,
-                )
+            render_order_list()
     
     # ═══════════════════════════════════════════════════════════════════════════
     # PAGE: RUBRICA CLIENTI
@@ -2049,6 +5772,24 @@ def main() -> None:
                 label_visibility="collapsed"
             )
             
+            # Same phone already in rubrica (normalized key, one hash lookup)
+            same_phone = st.session_state.customers.same_phone(
+                st.session_state.customer_form_contact, exclude=st.session_state.editing_customer_id
+            )
+            if same_phone:
+                st.warning(
+                    f"Numero già in rubrica: {', '.join(c['name'] for c in same_phone)}",
+                    icon="⚠️",
+                )
+                for cust in same_phone[:3]:
+                    st.button(
+                        f"✏️ Apri {cust['name']}",
+                        key=f"open_same_phone_{cust['id']}",
+                        use_container_width=True,
+                        on_click=load_customer_for_edit,
+                        args=(cust["id"],),
+                    )
+            
             st.markdown(
                 "<p style='font-size: 0.7rem; font-weight: 600; letter-spacing: 0.1em; text-transform: uppercase; color: #525252; margin-bottom: 0.25rem; margin-top: 0.5rem;'>NOTE</p>",
                 unsafe_allow_html=True
@@ -2082,6 +5823,44 @@ def main() -> None:
                         use_container_width=True,
                         on_click=cancel_customer_edit_callback
                     )
+            
+            # ─────────────────────────────────────────────────────────────────
+            # DOPPIONI IN RUBRICA
+            # ─────────────────────────────────────────────────────────────────
+            st.markdown("<div style='height: 1rem;'></div>", unsafe_allow_html=True)
+            with st.expander("🧹 Doppioni in rubrica"):
+                st.caption("Stesso telefono o nomi molto simili: unendo le schede, gli ordini passano al cliente che resta.")
+                st.button("🔍 CERCA DOPPIONI", use_container_width=True, on_click=scan_duplicates_callback)
+                proposals = st.session_state.dedupe_proposals
+                if proposals is not None and not proposals:
+                    st.success("Nessun doppione trovato")
+                for proposal in proposals or ():
+                    keep = st.session_state.customers.get(proposal.keep)
+                    duplicates = [st.session_state.customers.get(cid) for cid in proposal.duplicates]
+                    if keep is None or None in duplicates:
+                        continue
+                    st.markdown(
+                        f"**{keep['name']}** ({keep['contact'] or '—'}) ← "
+                        + ", ".join(f"{c['name']} ({c['contact'] or '—'})" for c in duplicates)
+                        + f" · somiglianza {proposal.score:.0%}"
+                    )
+                    dup_c1, dup_c2 = st.columns(2)
+                    with dup_c1:
+                        st.button(
+                            "🔗 Unisci",
+                            key=f"merge_cust_{proposal.keep}",
+                            use_container_width=True,
+                            on_click=merge_customers_callback,
+                            args=(proposal.keep, proposal.duplicates),
+                        )
+                    with dup_c2:
+                        st.button(
+                            "Ignora",
+                            key=f"dismiss_dup_{proposal.keep}",
+                            use_container_width=True,
+                            on_click=dismiss_duplicates_callback,
+                            args=(proposal.keep,),
+                        )
         
         # ─────────────────────────────────────────────────────────────────
         # LISTA CLIENTI
@@ -2130,14 +5909,10 @@ def main() -> None:
                     key="customer_search"
                 )
                 
-                # Filter customers
+                # Filter customers (ranked matches from the search index)
                 filtered_customers = st.session_state.customers
                 if search_query:
-                    search_lower = search_query.lower()
-                    filtered_customers = [
-                        c for c in st.session_state.customers
-                        if search_lower in c["name"].lower() or search_lower in c.get("contact", "").lower()
-                    ]
+                    filtered_customers = st.session_state.customers.search(search_query)
                 
                 st.markdown("<div style='height: 0.5rem;'></div>", unsafe_allow_html=True)
                 
@@ -2149,8 +5924,10 @@ def main() -> None:
                     border_style = "2px solid #D97706" if is_selected else "1px solid #E5E5E5"
                     bg_color = "#FFFBEB" if is_selected else "white"
                     
-                    # Count orders for this customer
-                    orders_count = sum(1 for o in st.session_state.orders if o["customer"] == cust["name"])
+                    # Linked orders by customer ID (O(1), survives renames)
+                    cust_stats = st.session_state.customer_orders.stats(cust_id)
+                    orders_count = cust_stats.orders
+                    last_order = f" · ultimo {datetime.fromisoformat(cust_stats.last_order_at):%d/%m}" if cust_stats.last_order_at else ""
                     
                     st.markdown(
                         f"""
@@ -2172,7 +5949,7 @@ def main() -> None:
                                     padding: 0.25rem 0.5rem;
                                     font-size: 0.65rem;
                                     font-weight: 700;
-                                ">{orders_count} ordini</div>
+                                ">{orders_count} ordini · {format_euro(cust_stats.spend)}{last_order}</div>
                             </div>
                         </div>
                         """,
@@ -2214,6 +5991,8 @@ def main() -> None:
     # ═══════════════════════════════════════════════════════════════════════════
     
     elif selected_page == "Dashboard":
+        # Materialised only here, and only when the table changed since last time
+        orders_df = st.session_state.orders_table.to_frame()
         if orders_df.empty:
             st.info("Nessun ordine da visualizzare. Vai su 'Ordini' per iniziare a raccogliere ordini.")
         else:
@@ -2222,9 +6001,11 @@ def main() -> None:
             # Filter row
             filter_col1, filter_col2, filter_col3 = st.columns(3)
             
-            clienti = ["Tutti"] + sorted([c for c in orders_df["cliente"].dropna().unique() if c])
-            categorie = ["Tutte"] + sorted(orders_df["categoria"].dropna().unique())
-            piatti = ["Tutti"] + sorted(orders_df["piatto"].dropna().unique())
+            # Option lists and value bitmaps cached per data version
+            filters = current_filter_index()
+            clienti = ["Tutti"] + filters.options["cliente"]
+            categorie = ["Tutte"] + filters.options["categoria"]
+            piatti = ["Tutti"] + filters.options["piatto"]
             
             with filter_col1:
                 cliente_sel = st.selectbox("Cliente", clienti)
@@ -2234,7 +6015,7 @@ def main() -> None:
                 piatto_sel = st.selectbox("Piatto", piatti)
             
             # Order range slider
-            min_order, max_order = int(orders_df["ordine"].min()), int(orders_df["ordine"].max())
+            min_order, max_order = filters.order_bounds
             if min_order < max_order:
                 order_range = st.slider(
                     "Intervallo ordini",
@@ -2245,68 +6026,132 @@ def main() -> None:
             else:
                 order_range = (min_order, max_order)
             
-            # Apply filters
-            df_filtered = orders_df.copy()
-            if cliente_sel != "Tutti":
-                df_filtered = df_filtered[df_filtered["cliente"] == cliente_sel]
-            if categoria_sel != "Tutte":
-                df_filtered = df_filtered[df_filtered["categoria"] == categoria_sel]
-            if piatto_sel != "Tutti":
-                df_filtered = df_filtered[df_filtered["piatto"] == piatto_sel]
-            df_filtered = df_filtered[
-                (df_filtered["ordine"] >= order_range[0]) & (df_filtered["ordine"] <= order_range[1])
-            ]
+            # Apply filters (bitmaps ANDed, order range by binary search, no frame copy)
+            selected = {"cliente": cliente_sel, "categoria": categoria_sel, "piatto": piatto_sel}
+            active_filters = {column: value for column, value in selected.items() if value not in ("Tutti", "Tutte")}
+            df_filtered = filters.select(active_filters, order_range)
+            # Totals, breakdowns and KPIs summed from the pre-aggregated cube
+            view = current_cube_view(active_filters, order_range)
             
             st.markdown("---")
             
             # Filtered KPIs
-            kpi_col1, kpi_col2, kpi_col3 = st.columns(3)
+            season = current_order_cube().query()
+            kpi_col1, kpi_col2, kpi_col3, kpi_col4 = st.columns(4)
             with kpi_col1:
-                st.metric("Ordini filtrati", df_filtered["ordine"].nunique() if not df_filtered.empty else 0)
+                st.metric("Ordini filtrati", view.ordini)
             with kpi_col2:
-                st.metric("Vassoi", int(df_filtered["vassoi"].sum()) if not df_filtered.empty else 0)
+                st.metric("Vassoi", view.vassoi)
             with kpi_col3:
-                st.metric("Coperti", int(df_filtered["coperti"].sum()) if not df_filtered.empty else 0)
+                st.metric("Coperti", view.coperti)
+            with kpi_col4:
+                st.metric("Incasso stimato", format_euro(view.importo), help=f"Totale stagione {format_euro(season.importo)}")
             
             st.markdown("---")
             
+            filter_signature = f"{cliente_sel}|{categoria_sel}|{piatto_sel}|{order_range[0]}-{order_range[1]}"
+            
             # Data tabs
-            data_tab1, data_tab2, data_tab3 = st.tabs(["ORDINI", "TOTALI", "PER CLIENTE"])
+            data_tab1, data_tab2, data_tab3, data_tab4, data_tab5 = st.tabs(
+                ["ORDINI", "TOTALI", "PER CLIENTE", "PRODUZIONE", "RITIRI"]
+            )
             
             with data_tab1:
                 st.dataframe(df_filtered, use_container_width=True, hide_index=True, height=400)
             
             with data_tab2:
-                totals_df, freq_df = totals_and_freq_from_df(df_filtered)
-                
                 st.markdown("**Totale per piatto e formato**")
-                st.dataframe(totals_df, use_container_width=True, hide_index=True)
+                st.dataframe(view.totals, use_container_width=True, hide_index=True)
                 
                 st.markdown("")
                 st.markdown("**Frequenza quantità**")
-                st.dataframe(freq_df, use_container_width=True, hide_index=True)
+                st.dataframe(view.freq, use_container_width=True, hide_index=True)
+                
+                st.markdown("")
+                st.markdown("**Incasso stimato per categoria**")
+                st.dataframe(view.by_category, use_container_width=True, hide_index=True)
+                
+                st.markdown("")
+                st.markdown("**Per giorno di ritiro**")
+                st.dataframe(
+                    view.by_day.assign(
+                        giorno=[format_pickup(f"{day} 00:00").rsplit(" ", 1)[0] if day else "Da definire" for day in view.by_day["giorno"]]
+                    ),
+                    use_container_width=True,
+                    hide_index=True,
+                )
             
             with data_tab3:
-                per_cliente = (
-                    df_filtered.groupby(["cliente", "contatto"], dropna=False)
-                    .agg({"ordine": pd.Series.nunique, "vassoi": "sum", "coperti": "sum"})
-                    .reset_index()
-                    .rename(columns={"ordine": "ordini"})
-                    .sort_values("ordini", ascending=False)
-                )
+                per_cliente = view.by_customer.sort_values("ordini", ascending=False)
                 st.dataframe(per_cliente, use_container_width=True, hide_index=True)
             
+            with data_tab4:
+                # Production yields are linear in the trays of a (dish, format): the cube totals suffice
+                plan_df = production_plan(view.totals)
+                
+                prod_col1, prod_col2, prod_col3 = st.columns(3)
+                with prod_col1:
+                    st.metric("Kg da preparare", f"{plan_df['kg'].sum():.1f}")
+                with prod_col2:
+                    st.metric("Pezzi", int(plan_df["pezzi"].sum()))
+                with prod_col3:
+                    st.metric("Contenitori", int(plan_df["contenitori"].sum()))
+                
+                st.dataframe(plan_df, use_container_width=True, hide_index=True)
+                st.caption(
+                    f"Peso per coperto dalle note del menu, altrimenti {PRODUCTION_GRAMS_PER_PORTION} g per i piatti a etto."
+                )
+                st.download_button(
+                    "⬇ Esporta piano di produzione",
+                    data=lazy_production_export(view.totals, st.session_state.store_version, filter_signature),
+                    file_name="piano_produzione.xlsx",
+                    mime=XLSX_MIME,
+                )
+            
+            with data_tab5:
+                # Pick list for the counter: every booked order, slot by slot (filters not applied)
+                pickup_day = st.selectbox(
+                    "Giorno di ritiro",
+                    ("", *PICKUP_DAYS),
+                    format_func=lambda day: format_pickup(f"{day} 00:00").rsplit(" ", 1)[0] if day else "Tutti i giorni",
+                    key="pick_list_day",
+                )
+                pick_df = pick_list_frame(st.session_state.pickup_index, st.session_state.orders, pickup_day)
+                unbooked = len(st.session_state.orders) - len(pick_df) if not pickup_day else 0
+                if unbooked:
+                    st.caption(f"{unbooked} ordini senza fascia di ritiro")
+                st.dataframe(pick_df, use_container_width=True, hide_index=True)
+                st.download_button(
+                    "⬇ Lista ritiri",
+                    data=lambda: export_pick_list_excel(pick_df),
+                    file_name=f"ritiri_{pickup_day or 'tutti'}.xlsx",
+                    mime=XLSX_MIME,
+                    key="pick_list_download",
+                )
+            
             st.markdown("---")
             
             # Export filtered
-            totals_df, freq_df = totals_and_freq_from_df(df_filtered)
-            excel_filtered = export_excel(df_filtered, totals_df, freq_df)
-            st.download_button(
-                "⬇ Esporta dati filtrati",
-                data=excel_filtered,
-                file_name="ordini_filtrati.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            )
+            exp_col1, exp_col2 = st.columns([1, 2])
+            with exp_col1:
+                export_format = st.selectbox(
+                    "Formato",
+                    list(EXPORTERS),
+                    format_func=lambda fmt: EXPORTERS[fmt].label,
+                    key="export_format",
+                    label_visibility="collapsed",
+                )
+            with exp_col2:
+                st.download_button(
+                    "⬇ Esporta dati filtrati",
+                    data=lazy_export(df_filtered, st.session_state.store_version, filter_signature, export_format),
+                    file_name=f"ordini_filtrati{EXPORTERS[export_format].suffix}",
+                    mime=EXPORTERS[export_format].mime,
+                )
+        
+        # Production caps are set before the first order too
+        with st.expander("📦 Limiti di produzione"):
+            render_dish_caps_editor()
     
     # ═══════════════════════════════════════════════════════════════════════════
     # HELP SECTION
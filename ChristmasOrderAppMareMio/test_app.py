@@ -6,9 +6,15 @@ Run with: pytest test_app.py -v
 """
 
 import pytest
+import sqlite3
+import threading
+import time
+import zipfile
 import pandas as pd
+import pyarrow as pa
 from pathlib import Path
 from collections import defaultdict
+from datetime import datetime
 from io import BytesIO
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -637,6 +643,1505 @@ class TestEdgeCases:
         assert buttons[0]["category"] == "HasItems"
 
 
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST CASES: ORDER STORE (SQLite)
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# The persistence layer has no UI, so it is imported from the app directly
+import app
+from app import (
+    ExportCancelled,
+    ExportJobManager,
+    ExportCache,
+    MENU_2025,
+    MENU_CATALOG,
+    OrderAggregates,
+    OrderIndex,
+    OrderJournal,
+    OrderNumberAllocator,
+    OrdersTable,
+    FrameFilterIndex,
+    OrderCube,
+    OrderStore,
+    delta_frame,
+    format_order_number,
+    fragments_for,
+    get_dish_info,
+    get_export_cache,
+    EXPORTERS,
+    export_tables,
+    lazy_delta_export,
+    lazy_export,
+    lazy_season_export,
+    minify_css,
+    font_css,
+    CustomerOrdersIndex,
+    phone_key,
+    dedupe_proposals,
+    CustomerIndex,
+    fold_text,
+    SoldOutError,
+    order_reservations,
+    PICKUP_SLOTS,
+    PickupSlotIndex,
+    pick_list_frame,
+    pickup_calendar,
+    PRODUCTION_SPECS,
+    production_plan,
+    estimate_items,
+    line_amounts,
+    revenue_breakdown,
+    revenue_report,
+    excel_sheet_title,
+    totals_and_freq_from_df,
+    write_excel_stream,
+    write_hashed_asset,
+)
+
+
+def _cells(df: pd.DataFrame) -> list[list[str]]:
+    """Frame contents as strings, to compare values regardless of dtypes."""
+    return df.astype(str).values.tolist()
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Fresh SQLite order store in a temp directory."""
+    order_store = OrderStore(tmp_path / "ordini.sqlite3")
+    yield order_store
+    order_store.close()
+
+
+class TestOrderStore:
+    """Tests for the shared SQLite order/customer store."""
+
+    def test_create_and_get_order(self, store, sample_order):
+        """Created orders round-trip their header and items."""
+        order_id = store.create_order(100, "Mario Rossi", "+39 333 1234567", "", sample_order["items"])
+
+        loaded = store.get_order(order_id)
+        assert loaded["order_number"] == "100"
+        assert loaded["customer"] == "Mario Rossi"
+        assert [i["dish"] for i in loaded["items"]] == [i["dish"] for i in sample_order["items"]]
+
+    def test_update_replaces_items(self, store, sample_order):
+        """Updating an order replaces its header and item list."""
+        order_id = store.create_order(100, "Mario", "1", "", sample_order["items"])
+        assert store.update_order(order_id, "Mario Rossi", "1", "No glutine", sample_order["items"][:1])
+
+        loaded = store.get_order(order_id)
+        assert loaded["customer"] == "Mario Rossi"
+        assert loaded["note"] == "No glutine"
+        assert len(loaded["items"]) == 1
+
+    def test_delete_order_cascades(self, store, sample_order):
+        """Deleting an order removes it and its items."""
+        order_id = store.create_order(100, "Mario", "1", "", sample_order["items"])
+        assert store.delete_order(order_id)
+        assert store.get_order(order_id) is None
+        assert store.list_orders() == []
+        assert not store.delete_order(order_id)
+
+    def test_data_version_bumps_on_write(self, store, sample_order):
+        """Every write bumps the data version used to refresh sessions."""
+        v0 = store.data_version()
+        order_id = store.create_order(100, "Mario", "1", "", sample_order["items"])
+        customer_id = store.create_customer("Mario", "1", "")
+        store.delete_order(order_id)
+        store.delete_customer(customer_id)
+        assert store.data_version() == v0 + 4
+
+    def test_customers_crud(self, store):
+        """Customers can be created, updated and deleted."""
+        customer_id = store.create_customer("Giulia", "333", "")
+        assert store.update_customer(customer_id, "Giulia Bianchi", "333", "vegetariana")
+        assert store.list_customers() == [
+            {"id": customer_id, "name": "Giulia Bianchi", "contact": "333", "note": "vegetariana"}
+        ]
+        assert store.delete_customer(customer_id)
+        assert store.get_customer(customer_id) is None
+
+    def test_change_log(self, store, sample_order):
+        """The change log lists what was written after a given version."""
+        store.create_order(100, "Mario", "1", "", sample_order["items"])
+        checkpoint = store.data_version()
+        store.update_order(100, "Mario Rossi", "1", "", sample_order["items"])
+        store.create_customer("Giulia", "2", "")
+        store.delete_order(100)
+
+        assert store.changes_since(checkpoint) == [
+            ("order", 100, "saved"),
+            ("customer", 1, "saved"),
+            ("order", 100, "deleted"),
+        ]
+
+    def test_store_is_shared_across_connections(self, tmp_path, sample_order):
+        """Two stores on the same file (two tills) see each other's orders."""
+        till_a = OrderStore(tmp_path / "shared.sqlite3")
+        till_b = OrderStore(tmp_path / "shared.sqlite3")
+        try:
+            till_a.create_order(100, "Mario", "1", "", sample_order["items"])
+            till_b.create_order(101, "Giulia", "2", "", sample_order["items"])
+            assert [o["customer"] for o in till_a.list_orders()] == ["Mario", "Giulia"]
+        finally:
+            till_a.close()
+            till_b.close()
+
+
+class TestOrderNumberAllocator:
+    """Tests for block-leased order numbers."""
+
+    def test_numbers_start_at_100_and_increase(self, store):
+        """A single till hands out 100, 101, 102..."""
+        allocator = OrderNumberAllocator(store, block_size=5)
+        assert [allocator.allocate()[0] for _ in range(7)] == [100, 101, 102, 103, 104, 105, 106]
+
+    def test_peek_does_not_consume(self, store):
+        """Peeking shows the next number without using it."""
+        allocator = OrderNumberAllocator(store, block_size=5)
+        assert allocator.peek() == (100, "100")
+        assert allocator.allocate() == (100, "100")
+
+    def test_tills_never_share_numbers(self, store):
+        """Two tills lease disjoint blocks."""
+        till_a = OrderNumberAllocator(store, block_size=3)
+        till_b = OrderNumberAllocator(store, block_size=3)
+        numbers = [till_a.allocate()[0], till_b.allocate()[0], till_a.allocate()[0], till_b.allocate()[0]]
+        assert numbers == [100, 103, 101, 104]
+        assert len(set(numbers)) == len(numbers)
+
+    def test_day_prefixed_numbers(self, store):
+        """With the day prefix, numbers restart from 001 each day."""
+        allocator = OrderNumberAllocator(store, block_size=5, day_prefix=True)
+        _, first = allocator.allocate()
+        _, second = allocator.allocate()
+        day = first.split("-")[0]
+        assert first == f"{day}-001"
+        assert second == f"{day}-002"
+
+    def test_format_order_number(self):
+        """Day-prefixed format is DD-XXX."""
+        assert format_order_number(datetime(2025, 12, 24), 7) == "24-007"
+
+    def test_sequence_seeded_from_existing_orders(self, tmp_path, sample_order, monkeypatch):
+        """Upgrading an existing archive continues numbering after its last order."""
+        path = tmp_path / "old.sqlite3"
+        monkeypatch.setattr(app, "STORE_MIGRATIONS", app.STORE_MIGRATIONS[:1])
+        old = OrderStore(path)
+        with old.pool.transaction() as conn:
+            conn.execute(
+                "INSERT INTO orders (order_id, customer, created_at, updated_at) VALUES (150, 'Mario', '', '')"
+            )
+        old.close()
+        monkeypatch.undo()
+
+        upgraded = OrderStore(path)
+        try:
+            assert OrderNumberAllocator(upgraded).allocate() == (151, "151")
+            assert upgraded.get_order(150)["order_number"] == "150"
+        finally:
+            upgraded.close()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST CASES: MENU CATALOG
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TestMenuCatalog:
+    """Tests for the precomputed menu catalog."""
+
+    def test_every_menu_dish_has_an_id(self):
+        """IDs are 1..N in menu order."""
+        names = [item["name"] for data in MENU_2025.values() for item in data["items"]]
+        assert [d.name for d in MENU_CATALOG.dishes] == names
+        assert [d.dish_id for d in MENU_CATALOG.dishes] == list(range(1, len(names) + 1))
+
+    def test_lookups_agree(self):
+        """By-ID, by-(category, name) and by-name lookups return the same record."""
+        dish = MENU_CATALOG.lookup("Crudi", "Tartare tonno 120gr")
+        assert dish is MENU_CATALOG.get(dish.dish_id)
+        assert dish is MENU_CATALOG.by_name("Tartare tonno 120gr")
+        assert dish is get_dish_info("Crudi", "Tartare tonno 120gr")
+        assert MENU_CATALOG.lookup("Antipasti", "Tartare tonno 120gr") is None
+        assert MENU_CATALOG.get(0) is None
+
+    def test_precomputed_labels(self):
+        """Price and button labels are computed once."""
+        dish = MENU_CATALOG.lookup("Antipasti", "Insalata di baccalà, carciofini, sedano e ceci")
+        assert dish.price_label == "€4.90/etto"
+        assert dish.display_name == "Insalata di baccalà, c…"
+
+    def test_resolve_item(self):
+        """Items resolve by dish ID, or by name for orders saved before IDs existed."""
+        dish = MENU_CATALOG.lookup("Sughi", "Ragù di gallinella")
+        assert MENU_CATALOG.resolve({"dish_id": dish.dish_id}) is dish
+        assert MENU_CATALOG.resolve({"category": "Sughi", "dish": "Ragù di gallinella"}) is dish
+
+    def test_records_are_frozen(self):
+        """Catalog records cannot be modified."""
+        dish = MENU_CATALOG.dishes[0]
+        with pytest.raises(AttributeError):
+            dish.price = 0
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST CASES: ORDER INDEX
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TestOrderIndex:
+    """Tests for the session order collection."""
+
+    def test_lookup_by_id(self, sample_orders):
+        """Orders are found by ID without scanning."""
+        index = OrderIndex(sample_orders)
+        assert len(index) == 3
+        assert index.get(101)["customer"] == "Giulia Bianchi"
+        assert index.get(999) is None
+        assert 102 in index
+
+    def test_newest_first_iteration(self, sample_orders):
+        """reversed() walks the orders newest-first for the order list."""
+        index = OrderIndex(sample_orders)
+        assert [o["order_id"] for o in reversed(index)] == [102, 101, 100]
+        assert [o["order_id"] for o in index] == [100, 101, 102]
+
+    def test_update_keeps_position(self, sample_orders):
+        """Editing an order replaces it in place."""
+        index = OrderIndex(sample_orders)
+        previous = index.upsert({**sample_orders[0], "customer": "Mario Rossi Updated"})
+        assert previous["customer"] == "Mario Rossi"
+        assert [o["customer"] for o in index][0] == "Mario Rossi Updated"
+
+    def test_remove(self, sample_orders):
+        """Removing an order drops it from lookups and iteration."""
+        index = OrderIndex(sample_orders)
+        assert index.remove(101)["order_id"] == 101
+        assert index.remove(101) is None
+        assert index.ids() == [100, 102]
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST CASES: INCREMENTAL AGGREGATES
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TestOrderAggregates:
+    """Tests for running totals and frequencies."""
+
+    def test_matches_full_recomputation(self, sample_orders):
+        """Counters give the same tables as grouping every row."""
+        totals_df, freq_df = OrderAggregates(sample_orders).frames()
+        expected_totals, expected_freq = totals_and_freq_from_df(OrdersTable(sample_orders).to_frame())
+        assert _cells(totals_df) == _cells(expected_totals)
+        assert _cells(freq_df) == _cells(expected_freq)
+
+    def test_kpis_and_top_dishes(self, sample_orders):
+        """Sidebar KPIs come straight from the counters."""
+        aggregates = OrderAggregates(sample_orders)
+        assert aggregates.total_vassoi == 8
+        assert aggregates.total_coperti == 1 * 2 + 2 * 1 + 1 * 1 + 3 * 2 + 1 * 3
+        assert aggregates.top_dishes(1) == [("Tartare di tonno", 3)]
+
+    def test_edit_applies_delta(self, sample_orders):
+        """Replacing an order patches only its items."""
+        aggregates = OrderAggregates(sample_orders)
+        edited = {**sample_orders[1], "items": [{"category": "Secondi", "dish": "Branzino", "portion": 3, "qty": 2}]}
+        aggregates.replace_order(sample_orders[1], edited)
+
+        totals_df, freq_df = aggregates.frames()
+        expected_totals, expected_freq = totals_and_freq_from_df(
+            OrdersTable([sample_orders[0], edited, sample_orders[2]]).to_frame()
+        )
+        assert _cells(totals_df) == _cells(expected_totals)
+        assert _cells(freq_df) == _cells(expected_freq)
+
+    def test_delete_to_empty(self, sample_orders):
+        """Removing every order empties the tables."""
+        aggregates = OrderAggregates(sample_orders)
+        for order in sample_orders:
+            aggregates.remove_order(order)
+        totals_df, freq_df = aggregates.frames()
+        assert totals_df.empty and freq_df.empty
+        assert aggregates.total_vassoi == 0
+        assert aggregates.top_dishes() == []
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST CASES: COLUMNAR ORDERS TABLE
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TestOrdersTable:
+    """Tests for the delta-patched orders table."""
+
+    def test_matches_full_rebuild(self, sample_orders):
+        """The table materialises the same rows as a full rebuild."""
+        frame = OrdersTable(sample_orders).to_frame()
+        expected = build_orders_dataframe(sample_orders)
+        expected["porzione"] = expected["porzione"].str.replace("per ", "").astype(int)
+        assert list(frame.columns) == list(expected.columns)
+        assert _cells(frame) == _cells(expected)
+
+    def test_compact_dtypes(self, sample_orders):
+        """Text columns are categoricals and numbers small integers."""
+        frame = OrdersTable(sample_orders).to_frame()
+        for column in ["cliente", "contatto", "categoria", "piatto", "note"]:
+            assert isinstance(frame[column].dtype, pd.CategoricalDtype), column
+        assert frame["porzione"].dtype == "int16"
+        assert frame["vassoi"].dtype == "int16"
+        # Categories are the whole menu, in menu order, so filters see every dish
+        assert list(frame["categoria"].cat.categories[:2]) == ["Antipasti", "Sughi"]
+
+    def test_compact_frame_is_smaller(self, sample_orders):
+        """Repeated strings are stored once per distinct value."""
+        orders = [{**order, "order_id": order["order_id"] + 10 * n} for n in range(200) for order in sample_orders]
+        compact = OrdersTable(orders).to_frame().memory_usage(deep=True).sum()
+        plain = build_orders_dataframe(orders).memory_usage(deep=True).sum()
+        assert compact * 3 < plain
+
+    def test_empty_table_has_columns(self):
+        """An empty table still has every column."""
+        frame = OrdersTable().to_frame()
+        assert frame.empty
+        assert list(frame.columns) == ["ordine", "cliente", "contatto", "categoria", "piatto",
+                                       "porzione", "vassoi", "coperti", "note"]
+
+    def test_frame_cached_until_change(self, sample_orders):
+        """to_frame() reuses the frame while the version is unchanged."""
+        table = OrdersTable(sample_orders)
+        first = table.to_frame()
+        assert table.to_frame() is first
+        table.remove_order(101)
+        assert table.to_frame() is not first
+
+    def test_edit_same_item_count_patches_in_place(self, sample_orders):
+        """Edits with the same number of items overwrite their rows."""
+        table = OrdersTable(sample_orders)
+        table.upsert_order({**sample_orders[0], "customer": "Mario Rossi Updated"})
+        frame = table.to_frame()
+        assert list(frame["cliente"]) == ["Mario Rossi Updated"] * 2 + ["Giulia Bianchi"] * 2 + ["Mario Rossi"]
+        assert table.dead_rows == 0
+
+    def test_edit_and_delete_mask_rows(self, sample_orders):
+        """Grown orders are re-appended and deleted ones masked out."""
+        table = OrdersTable(sample_orders)
+        grown = {**sample_orders[2], "items": sample_orders[2]["items"] * 2}
+        table.upsert_order(grown)
+        table.remove_order(100)
+
+        frame = table.to_frame()
+        assert len(frame) == len(table) == 4
+        assert sorted(frame["ordine"].unique()) == [101, 102]
+        assert frame["vassoi"].sum() == 1 + 3 + 1 + 1
+
+    def test_compaction_keeps_rows(self, sample_orders):
+        """Dropping masked rows keeps every live order addressable."""
+        table = OrdersTable(sample_orders)
+        table.remove_order(100)
+        table.remove_order(101)
+        assert table.dead_rows == 0  # compacted
+        table.upsert_order({**sample_orders[2], "note": "ritiro ore 11"})
+        assert list(table.to_frame()["note"]) == ["ritiro ore 11"]
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST CASES: ORDER JOURNAL
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TestOrderJournal:
+    """Tests for the append-only event journal."""
+
+    def test_store_mutations_are_journaled(self, tmp_path, sample_order):
+        """Every store write becomes a journal event and replays to the same state."""
+        journal = OrderJournal(tmp_path / "journal")
+        store = OrderStore(tmp_path / "ordini.sqlite3", journal=journal)
+        store.create_order(100, "Mario", "1", "", sample_order["items"])
+        store.update_order(100, "Mario Rossi", "1", "", sample_order["items"][:1])
+        store.create_order(101, "Giulia", "2", "", sample_order["items"])
+        store.delete_order(101)
+        store.create_customer("Giulia", "2", "")
+        store.close()
+
+        replayed = OrderJournal(tmp_path / "journal").state
+        assert list(replayed["orders"]) == [100]
+        assert replayed["orders"][100]["customer"] == "Mario Rossi"
+        assert replayed["orders"][100]["order_number"] == "100"
+        assert len(replayed["orders"][100]["items"]) == 1
+        assert [c["name"] for c in replayed["customers"].values()] == ["Giulia"]
+
+    def test_snapshot_compacts_and_replays_tail(self, tmp_path):
+        """After a snapshot, startup replays only the events written after it."""
+        journal = OrderJournal(tmp_path, snapshot_every=10)
+        for order_id in range(100, 125):
+            journal.append("order_saved", {"order_id": order_id, "customer": "X", "items": []})
+        journal.close()
+
+        assert sorted(p.name for p in tmp_path.glob("snapshot-*")) == ["snapshot-000002.pickle", "snapshot-000003.pickle"]
+        reopened = OrderJournal(tmp_path, snapshot_every=10)
+        assert reopened.seq == 25
+        assert reopened.segment == 3
+        assert len(reopened.state["orders"]) == 25
+
+    def test_torn_last_line_is_ignored(self, tmp_path):
+        """A half-written event from a crash does not break recovery."""
+        journal = OrderJournal(tmp_path)
+        journal.append("customer_saved", {"id": 1, "name": "Mario", "contact": "", "note": ""})
+        journal.close()
+        with open(tmp_path / "segment-000001.jsonl", "ab") as fh:
+            fh.write(b'{"seq": 2, "kind": "cust')
+
+        assert OrderJournal(tmp_path).state["customers"][1]["name"] == "Mario"
+
+    def test_appends_after_torn_line_survive_restart(self, tmp_path):
+        """The torn tail is cut on recovery, so later events are not lost."""
+        journal = OrderJournal(tmp_path)
+        journal.append("customer_saved", {"id": 1, "name": "Mario", "contact": "", "note": ""})
+        journal.close()
+        with open(tmp_path / "segment-000001.jsonl", "ab") as fh:
+            fh.write(b'{"seq": 2, "kind": "cust')
+
+        journal = OrderJournal(tmp_path)
+        for customer_id in (2, 3):
+            journal.append("customer_saved", {"id": customer_id, "name": "X", "contact": "", "note": ""})
+        journal.close()
+
+        reopened = OrderJournal(tmp_path)
+        assert sorted(reopened.state["customers"]) == [1, 2, 3]
+        assert reopened.seq == 3
+
+    def test_restart_keeps_counting_towards_snapshot(self, tmp_path):
+        """Events replayed at startup count towards the next compaction."""
+        journal = OrderJournal(tmp_path, snapshot_every=10)
+        for order_id in range(6):
+            journal.append("order_saved", {"order_id": order_id, "customer": "X", "items": []})
+        journal.close()
+
+        reopened = OrderJournal(tmp_path, snapshot_every=10)
+        assert reopened.segment_events == 6
+        for order_id in range(6, 10):
+            reopened.append("order_saved", {"order_id": order_id, "customer": "X", "items": []})
+        reopened.close()
+        assert reopened.segment == 2
+        assert (tmp_path / "snapshot-000002.pickle").exists()
+
+    def test_failed_journal_write_rolls_back_the_store(self, tmp_path, sample_order, monkeypatch):
+        """The event is written before COMMIT: no committed write escapes the journal."""
+        journal = OrderJournal(tmp_path / "journal")
+        store = OrderStore(tmp_path / "a.sqlite3", journal=journal)
+        try:
+            def broken_append(kind, data):
+                raise OSError("disk full")
+
+            monkeypatch.setattr(journal, "append", broken_append)
+            with pytest.raises(OSError):
+                store.create_order(140, "Mario", "1", "", sample_order["items"])
+            assert store.get_order(140) is None
+        finally:
+            store.close()
+
+    def test_state_at_point_in_time(self, tmp_path):
+        """The journal can rebuild the archive as it was at any moment."""
+        journal = OrderJournal(tmp_path, snapshot_every=2)
+        journal.append("order_saved", {"order_id": 100, "customer": "Mario", "items": []})
+        journal.append("order_saved", {"order_id": 101, "customer": "Giulia", "items": []})
+        checkpoint = datetime.now()
+        journal.append("order_deleted", {"order_id": 100})
+
+        assert sorted(journal.state_at(checkpoint)["orders"]) == [100, 101]
+        assert sorted(journal.state_at(datetime.now())["orders"]) == [101]
+        journal.close()
+
+    def test_restore_store_from_journal(self, tmp_path, sample_order):
+        """A lost database is rebuilt from the journal and numbering continues."""
+        journal = OrderJournal(tmp_path / "journal")
+        store = OrderStore(tmp_path / "a.sqlite3", journal=journal)
+        store.create_order(140, "Mario", "1", "", sample_order["items"])
+        store.close()
+
+        rebuilt = OrderStore(tmp_path / "b.sqlite3")
+        try:
+            rebuilt.restore(OrderJournal(tmp_path / "journal").state)
+            assert rebuilt.get_order(140)["customer"] == "Mario"
+            assert OrderNumberAllocator(rebuilt).allocate()[0] == 141
+        finally:
+            rebuilt.close()
+
+    def test_restore_continues_day_numbers(self, tmp_path, sample_order):
+        """Day-prefixed numbers after a restore continue from the restored ones."""
+        journal = OrderJournal(tmp_path / "journal")
+        store = OrderStore(tmp_path / "a.sqlite3", journal=journal)
+        for _ in range(3):
+            order_id, order_number = OrderNumberAllocator(store, day_prefix=True).allocate()
+            store.create_order(order_id, "Mario", "1", "", sample_order["items"], order_number=order_number)
+        store.close()
+
+        rebuilt = OrderStore(tmp_path / "b.sqlite3")
+        try:
+            rebuilt.restore(OrderJournal(tmp_path / "journal").state)
+            used = {order["order_number"] for order in rebuilt.list_orders()}
+            _, order_number = OrderNumberAllocator(rebuilt, day_prefix=True).allocate()
+            assert order_number not in used
+            assert order_number == format_order_number(datetime.now(), max(int(n[3:]) for n in used) + 1)
+        finally:
+            rebuilt.close()
+
+    def test_restore_keeps_customer_links(self, tmp_path, sample_order):
+        """Orders linked to a Rubrica customer restore under foreign keys."""
+        journal = OrderJournal(tmp_path / "journal")
+        store = OrderStore(tmp_path / "a.sqlite3", journal=journal)
+        customer_id = store.create_customer("Mario", "1", "")
+        store.create_order(140, "Mario", "1", "", sample_order["items"], customer_id=customer_id)
+        store.close()
+
+        rebuilt = OrderStore(tmp_path / "b.sqlite3")
+        try:
+            rebuilt.restore(OrderJournal(tmp_path / "journal").state)
+            assert rebuilt.get_order(140)["customer_id"] == customer_id
+            assert rebuilt.get_customer(customer_id)["name"] == "Mario"
+        finally:
+            rebuilt.close()
+
+    def test_restore_keeps_order_timestamps(self, tmp_path, sample_order):
+        """Restored orders keep their original created/updated times."""
+        journal = OrderJournal(tmp_path / "journal")
+        store = OrderStore(tmp_path / "a.sqlite3", journal=journal)
+        store.create_order(140, "Mario", "1", "", sample_order["items"])
+        store.update_order(140, "Mario", "2", "", sample_order["items"])
+        original = store.get_order(140)
+        # Legacy event: no timestamps in the payload, only the event time
+        journal.append("order_saved", {
+            "order_id": 141, "order_number": "141", "customer": "Anna", "contact": "",
+            "note": "", "items": sample_order["items"],
+        })
+        legacy_ts = journal.state["orders"][141]["created_at"]
+        store.close()
+
+        time.sleep(0.01)
+        rebuilt = OrderStore(tmp_path / "b.sqlite3")
+        try:
+            rebuilt.restore(OrderJournal(tmp_path / "journal").state)
+            restored = rebuilt.get_order(140)
+            assert restored["created_at"] == original["created_at"]
+            assert restored["updated_at"] == original["updated_at"]
+            assert rebuilt.get_order(141)["created_at"] == legacy_ts != ""
+        finally:
+            rebuilt.close()
+
+    def test_recovers_full_season(self, tmp_path, sample_order):
+        """A season of 5k orders is recovered from snapshot + tail."""
+        journal = OrderJournal(tmp_path, fsync_every=1000)
+        for order_id in range(5000):
+            journal.append("order_saved", {"order_id": order_id, "customer": "Cliente", "items": sample_order["items"]})
+        journal.close()
+
+        assert len(OrderJournal(tmp_path).state["orders"]) == 5000
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST BUNDLE CSS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TestStyleBundle:
+    """Test minified, content-hashed stylesheet bundle"""
+
+    def test_minify_keeps_rules(self):
+        css = """
+            /* comment */
+            .a  > .b:hover ,  .c {
+                color: red;
+                margin: 0 auto;
+            }
+        """
+        assert minify_css(css) == ".a > .b:hover,.c{color:red;margin:0 auto}"
+
+    def test_swiss_css_has_no_remote_import(self):
+        minified = minify_css(app.SWISS_CSS)
+        assert "@import" not in minified
+        assert "googleapis" not in minified
+        assert len(minified) < len(app.SWISS_CSS)
+
+    def test_font_never_loads_from_google(self):
+        """Without the self-hosted file the stack falls back to system fonts."""
+        assert font_css(None) == ""
+        local = font_css("inter.0123456789ab.woff2")
+        assert "@font-face" in local and "googleapis" not in local
+
+    def test_hashed_asset_is_content_addressed(self, tmp_path):
+        first = write_hashed_asset(b"body{}", "swiss", ".css", tmp_path)
+        assert write_hashed_asset(b"body{}", "swiss", ".css", tmp_path) == first
+
+        second = write_hashed_asset(b"body{color:red}", "swiss", ".css", tmp_path)
+        assert second != first
+        assert [f.name for f in tmp_path.glob("swiss.*.css")] == [second]
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST SEGNALI FRAMMENTI
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TestFragmentSignals:
+    """Test which fragments rerun for each data signal"""
+
+    def test_adding_dish_reruns_only_cart(self):
+        assert fragments_for("cart") == ["cart", "sidebar_stats"]
+
+    def test_signals_are_merged_without_duplicates(self):
+        keys = fragments_for("orders", "editing")
+        assert len(keys) == len(set(keys))
+        assert {"order_list", "customer_form", "cart", "sidebar_actions"} <= set(keys)
+
+    @pytest.mark.parametrize("signal", ["orders", "customer", "editing"])
+    def test_availability_changes_rerun_dish_grid(self, signal):
+        """Saves, deletes and pickup-day changes move the grid's remaining covers."""
+        assert "dish_grid" in fragments_for(signal)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# TEST EXPORT LAZY
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TestExportCache:
+    """Test lazy, version-keyed export cache"""
+
+    def test_builds_once_per_key(self):
+        cache = ExportCache()
+        calls = []
+        build = lambda: calls.append(1) or b"xlsx"
+        assert cache.get_or_build((1, "all"), build) == b"xlsx"
+        assert cache.get_or_build((1, "all"), build) == b"xlsx"
+        assert len(calls) == 1
+
+    def test_new_version_evicts_old_entries(self):
+        cache = ExportCache()
+        cache.get_or_build((1, "all"), lambda: b"a")
+        cache.get_or_build((1, "Mario"), lambda: b"b")
+        cache.get_or_build((2, "all"), lambda: b"c")
+        assert len(cache) == 1
+        assert (2, "all") in cache
+
+    def test_size_is_bounded(self):
+        cache = ExportCache(max_entries=2)
+        for signature in ["a", "b", "c"]:
+            cache.get_or_build((1, signature), lambda: b"x")
+        assert (1, "a") not in cache
+        assert len(cache) == 2
+
+    def test_different_keys_build_in_parallel(self):
+        """A slow build does not hold up another export."""
+        cache = ExportCache()
+        other_built = threading.Event()
+
+        def slow_build():
+            # Only finishes early if the other build ran meanwhile
+            return b"slow" if other_built.wait(timeout=2) else b"serialised"
+
+        results = []
+        worker = threading.Thread(target=lambda: results.append(cache.get_or_build((1, "slow"), slow_build)))
+        worker.start()
+        time.sleep(0.05)
+        assert cache.get_or_build((1, "fast"), lambda: other_built.set() or b"fast") == b"fast"
+        worker.join()
+        assert results == [b"slow"]
+
+    def test_same_key_builds_once_across_threads(self):
+        cache = ExportCache()
+        calls = []
+
+        def build():
+            calls.append(1)
+            time.sleep(0.05)
+            return b"xlsx"
+
+        threads = [threading.Thread(target=cache.get_or_build, args=((1, "all"), build)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+
+    def test_stale_version_is_not_stored(self):
+        cache = ExportCache()
+        cache.get_or_build((2, "all"), lambda: b"new")
+        assert cache.get_or_build((1, "all"), lambda: b"old") == b"old"
+        assert (1, "all") not in cache
+        assert (2, "all") in cache
+
+    def test_lazy_export_builds_workbook_on_call(self, sample_orders):
+        orders_df = OrdersTable(sample_orders).to_frame()
+        data = lazy_export(orders_df, version=-1, signature="test")
+        assert callable(data)
+        workbook = pd.read_excel(BytesIO(data()), sheet_name=None)
+        assert list(workbook) == ["Ordini", "Totali", "Frequenze"]
+        assert len(workbook["Ordini"]) == len(orders_df)
+
+    def test_season_export_streams_from_temp_file(self, store, sample_orders):
+        """The full-season workbook is handed over as a file, never cached."""
+        for order in sample_orders:
+            store.create_order(order["order_id"], order["customer"], order["contact"], order["note"], order["items"])
+        entries = len(get_export_cache())
+        with lazy_season_export(store)() as handle:
+            assert not isinstance(handle, (bytes, BytesIO))
+            workbook = pd.read_excel(handle, sheet_name=None)
+        assert len(workbook["Ordini"]) == sum(len(order["items"]) for order in sample_orders)
+        assert len(get_export_cache()) == entries
+
+
+class TestStreamingExport:
+    """Test write-only streaming XLSX export"""
+
+    def test_iter_orders_matches_list_orders(self, store, sample_orders):
+        for order in sample_orders:
+            store.create_order(order["order_id"], order["customer"], order["contact"], order["note"], order["items"])
+        assert list(store.iter_orders(batch_size=1)) == store.list_orders()
+
+    def test_writes_all_sheets_to_stream(self, sample_orders):
+        output = BytesIO()
+        stats = write_excel_stream(iter(sample_orders), output)
+
+        workbook = pd.read_excel(BytesIO(output.getvalue()), sheet_name=None)
+        assert list(workbook)[0] == "Ordini"
+        assert list(workbook)[-2:] == ["Totali", "Frequenze"]
+        assert len(workbook["Ordini"]) == sum(len(o["items"]) for o in sample_orders)
+        assert len(workbook["Antipasti"]) == sum(
+            1 for o in sample_orders for i in o["items"] if i["category"] == "Antipasti"
+        )
+        expected_totals, _ = totals_and_freq_from_df(OrdersTable(sample_orders).to_frame())
+        assert _cells(workbook["Totali"]) == _cells(expected_totals)
+        assert stats.rows > 0 and stats.rows_per_sec > 0
+
+    def test_writes_to_file(self, tmp_path, sample_orders):
+        target = tmp_path / "stagione.xlsx"
+        write_excel_stream(sample_orders, target, per_category=False)
+        assert list(pd.read_excel(target, sheet_name=None)) == ["Ordini", "Totali", "Frequenze"]
+
+    def test_sheet_title_is_sanitized(self):
+        assert excel_sheet_title("Crudi/Cotti [extra]") == "Crudi Cotti  extra "
+        assert len(excel_sheet_title("x" * 40)) == 31
+
+
+class TestExportJobs:
+    """Test background export jobs (pool, progress, cancel, TTL)"""
+
+    @pytest.fixture
+    def filled_store(self, store, sample_orders):
+        for order in sample_orders:
+            store.create_order(order["order_id"], order["customer"], order["contact"], order["note"], order["items"])
+        return store
+
+    def test_job_runs_in_background(self, tmp_path, filled_store):
+        manager = ExportJobManager(tmp_path / "exports")
+        job = manager.submit("csv", filled_store)
+        manager.shutdown()
+
+        assert job.status == "done"
+        assert job.progress == 1.0
+        assert job.path.read_bytes().decode("utf-8-sig").splitlines()[0].startswith("ordine,cliente")
+
+    def test_cancel_before_start(self, tmp_path, filled_store):
+        manager = ExportJobManager(tmp_path / "exports", workers=1)
+        release = threading.Event()
+        manager._executor.submit(release.wait)
+        job = manager.submit("xlsx", filled_store)
+        manager.cancel(job.job_id)
+        release.set()
+        manager.shutdown()
+
+        assert job.status == "cancelled"
+        assert not job.path.exists()
+
+    def test_report_raises_once_cancelled(self, tmp_path, filled_store):
+        manager = ExportJobManager(tmp_path / "exports")
+        job = manager.submit("csv", filled_store)
+        manager.shutdown()
+        job.cancel_event.set()
+        with pytest.raises(ExportCancelled):
+            job.report(0.5)
+
+    def test_unreadable_archive_fails_the_job(self, tmp_path, filled_store, monkeypatch):
+        def locked():
+            raise sqlite3.OperationalError("database is locked")
+
+        monkeypatch.setattr(filled_store, "count_orders", locked)
+        manager = ExportJobManager(tmp_path / "exports")
+        job = manager.submit("csv", filled_store)
+        manager.shutdown()
+
+        assert job.status == "failed"
+        assert "locked" in job.error
+        assert job.finished_at is not None
+
+    def test_finished_jobs_expire(self, tmp_path, filled_store):
+        manager = ExportJobManager(tmp_path / "exports", ttl=60)
+        job = manager.submit("csv", filled_store)
+        manager.shutdown()
+
+        manager.evict_expired(now=job.finished_at + 30)
+        assert manager.get(job.job_id) is job
+        manager.evict_expired(now=job.finished_at + 61)
+        assert manager.get(job.job_id) is None
+        assert not job.path.exists()
+
+
+class TestExporters:
+    """Test columnar export formats in the exporter registry"""
+
+    @pytest.fixture
+    def tables(self, sample_orders):
+        return export_tables(OrdersTable(sample_orders).to_frame())
+
+    @staticmethod
+    def _members(data: bytes) -> dict[str, bytes]:
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+
+    @pytest.mark.parametrize(
+        "fmt, reader",
+        [
+            ("csv.gz", lambda raw: pd.read_csv(BytesIO(raw), compression="gzip", keep_default_na=False)),
+            ("parquet", lambda raw: pd.read_parquet(BytesIO(raw))),
+            ("arrow", lambda raw: pa.ipc.open_file(BytesIO(raw)).read_pandas()),
+            ("ndjson", lambda raw: pd.read_json(BytesIO(raw), lines=True)),
+        ],
+    )
+    def test_bundle_round_trip(self, tables, fmt, reader):
+        members = self._members(EXPORTERS[fmt].build(tables))
+        assert len(members) == 3
+        ordini = reader(next(raw for name, raw in members.items() if name.startswith("ordini")))
+        assert _cells(ordini) == _cells(tables["ordini"])
+
+    def test_excel_keeps_three_sheets(self, tables):
+        workbook = pd.read_excel(BytesIO(EXPORTERS["xlsx"].build(tables)), sheet_name=None)
+        assert list(workbook) == ["Ordini", "Totali", "Frequenze"]
+
+    def test_parquet_keeps_categoricals(self, tables):
+        raw = self._members(EXPORTERS["parquet"].build(tables))["ordini.parquet"]
+        assert isinstance(pd.read_parquet(BytesIO(raw))["piatto"].dtype, pd.CategoricalDtype)
+
+
+class TestDeltaExport:
+    """Test incremental export from the change log"""
+
+    def _create(self, store, order_id, items):
+        store.create_order(order_id, f"Cliente {order_id}", "333", "", items)
+
+    def test_first_delta_has_every_order(self, store, sample_order):
+        self._create(store, 100, sample_order["items"])
+        self._create(store, 101, sample_order["items"])
+
+        version, changes = store.order_delta(store.get_watermark("cucina"))
+        assert version == store.data_version()
+        assert sorted((c["order_id"], c["change"]) for c in changes) == [(100, "created"), (101, "created")]
+
+    def test_delta_after_watermark(self, store, sample_order):
+        items = sample_order["items"]
+        for order_id in (100, 101):
+            self._create(store, order_id, items)
+        store.set_watermark("cucina", store.data_version())
+
+        store.update_order(100, "Mario", "333", "senza glutine", items)
+        store.delete_order(101)
+        self._create(store, 102, items)
+        self._create(store, 103, items)
+        store.delete_order(103)
+
+        assert store.pending_changes("cucina") == 4
+        _, changes = store.order_delta(store.get_watermark("cucina"))
+        by_id = {c["order_id"]: c for c in changes}
+        assert {order_id: c["change"] for order_id, c in by_id.items()} == {
+            100: "updated",
+            101: "deleted",
+            102: "created",
+        }
+        assert by_id[100]["order"]["note"] == "senza glutine"
+        assert by_id[101]["order"] is None
+
+    def test_delta_frame_rows(self, store, sample_order):
+        self._create(store, 100, sample_order["items"])
+        store.set_watermark("cucina", store.data_version())
+        store.delete_order(100)
+        self._create(store, 101, sample_order["items"])
+
+        frame = delta_frame(store.order_delta(store.get_watermark("cucina"))[1])
+        assert frame.columns[:2].tolist() == ["modifica", "modificato_il"]
+        assert frame["modifica"].value_counts().to_dict() == {"nuovo": len(sample_order["items"]), "eliminato": 1}
+
+    def test_watermarks_are_per_consumer(self, store, sample_order):
+        self._create(store, 100, sample_order["items"])
+        store.set_watermark("cucina", store.data_version())
+        assert store.pending_changes("cucina") == 0
+        assert store.pending_changes("backup") == 1
+
+    def test_pending_counts_restored_orders_not_the_restore(self, store, sample_order):
+        store.restore({
+            "orders": {
+                order_id: {"order_id": order_id, "customer": "Mario", "contact": "", "note": "",
+                           "items": sample_order["items"]}
+                for order_id in (100, 101)
+            },
+            "customers": {},
+        })
+        self._create(store, 102, sample_order["items"])
+        assert store.pending_changes("cucina") == 3
+
+    def test_last_delta_can_be_downloaded_again(self, store, sample_order):
+        self._create(store, 100, sample_order["items"])
+        store.set_watermark("cucina", store.data_version())
+        assert store.last_delivery("cucina") is None
+
+        self._create(store, 101, sample_order["items"])
+        store.update_order(100, "Mario", "333", "senza glutine", sample_order["items"])
+        version, taken = store.take_order_delta("cucina")
+        self._create(store, 102, sample_order["items"])
+        store.delete_order(101)
+
+        again_version, again = store.last_order_delta("cucina")
+        assert again_version == version
+        assert store.get_watermark("cucina") == version
+        assert {c["order_id"]: c["change"] for c in taken} == {100: "updated", 101: "created"}
+        assert {c["order_id"]: c["change"] for c in again} == {100: "updated"}
+        assert store.pending_changes("cucina") == 2
+
+    def test_repeat_export_keeps_watermark(self, store, sample_order):
+        self._create(store, 100, sample_order["items"])
+        first = lazy_delta_export(store, "cucina")()
+        again = lazy_delta_export(store, "cucina", repeat=True)()
+        frames = [pd.read_excel(BytesIO(data)) for data in (first, again)]
+        assert len(frames[0]) == len(frames[1]) == len(sample_order["items"])
+        assert len(pd.read_excel(BytesIO(lazy_delta_export(store, "cucina")()))) == 0
+
+    def test_take_delta_advances_watermark_once(self, store, sample_order):
+        self._create(store, 100, sample_order["items"])
+        self._create(store, 101, sample_order["items"])
+
+        barrier = threading.Barrier(2)
+        batches = []
+
+        def consume():
+            barrier.wait()
+            batches.append(store.take_order_delta("cucina")[1])
+
+        threads = [threading.Thread(target=consume) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(len(batch) for batch in batches) == [0, 2]
+        assert store.get_watermark("cucina") == store.data_version()
+        assert store.pending_changes("cucina") == 0
+
+
+class TestProductionPlan:
+    """Test the per-dish kitchen production sheet"""
+
+    def _plan(self, items):
+        order = {"order_id": 100, "customer": "Mario", "contact": "333", "note": "", "items": items}
+        plan = production_plan(OrdersTable([order]).to_frame())
+        return plan.set_index("piatto")
+
+    def test_specs_read_menu_text(self):
+        assert PRODUCTION_SPECS.loc[("Antipasti", "Insalata di mare"), "grammi"] == 200
+        assert PRODUCTION_SPECS.loc[("Antipasti", "Brioche spada affumicato"), "grammi"] == 0
+        assert PRODUCTION_SPECS.loc[("Antipasti", "Panettoncino gastronomico"), "persone"] == 4
+        assert PRODUCTION_SPECS.loc[("Crudi", "Tartare tonno 120gr"), "grammi"] == 120
+        assert PRODUCTION_SPECS.loc[("Primi", "Lasagne salmone e zafferano"), "porzioni_contenitore"] == 2
+
+    def test_lines_are_summed_per_dish(self):
+        plan = self._plan([
+            {"category": "Antipasti", "dish": "Insalata di mare", "portion": 2, "qty": 3},
+            {"category": "Antipasti", "dish": "Insalata di mare", "portion": 1, "qty": 1},
+        ])
+        row = plan.loc["Insalata di mare"]
+        assert (row["vassoi"], row["coperti"], row["kg"], row["contenitori"]) == (4, 7, 1.4, 4)
+
+    def test_units_convert_to_pieces_plates_and_containers(self):
+        plan = self._plan([
+            {"category": "Antipasti", "dish": "Panettoncino gastronomico", "portion": 6, "qty": 1},
+            {"category": "Primi", "dish": "Lasagne salmone e zafferano", "portion": 3, "qty": 2},
+            {"category": "Crudi", "dish": "Tartare tonno 120gr", "portion": 2, "qty": 1},
+        ])
+        assert plan.loc["Panettoncino gastronomico", "pezzi"] == 2
+        assert plan.loc["Lasagne salmone e zafferano", "contenitori"] == 4
+        assert plan.loc["Tartare tonno 120gr", "piatti"] == 2
+        assert plan.loc["Tartare tonno 120gr", "kg"] == 0.24
+
+    def test_unknown_dish_uses_default_weight(self):
+        plan = self._plan([{"category": "Extra", "dish": "Fuori menu", "portion": 1, "qty": 2}])
+        assert plan.loc["Fuori menu", "kg"] == 0.4
+
+    def test_empty_frame(self):
+        assert production_plan(pd.DataFrame()).empty
+
+
+class TestRevenue:
+    """Test unit-aware estimated amounts"""
+
+    ITEMS = [
+        {"category": "Antipasti", "dish": "Insalata di mare", "portion": 2, "qty": 1},  # 400 g × 5.90/etto
+        {"category": "Antipasti", "dish": "Panettoncino gastronomico", "portion": 4, "qty": 1},  # 1 pz × 26.00
+        {"category": "Crudi", "dish": "Tartare tonno 120gr", "portion": 2, "qty": 1},  # 2 porz × 16.00
+        {"category": "Extra", "dish": "Fuori menu", "portion": 1, "qty": 3},  # no price
+    ]
+
+    def _frame(self, *orders):
+        return OrdersTable(
+            [{"order_id": oid, "customer": name, "contact": "333", "note": "", "items": items} for oid, name, items in orders]
+        ).to_frame()
+
+    def test_line_amounts_follow_units(self):
+        amounts = line_amounts(self._frame((100, "Mario", self.ITEMS)))
+        assert amounts.tolist() == [23.6, 26.0, 32.0, 0.0]
+
+    def test_cart_estimate_matches_table(self):
+        assert estimate_items(self.ITEMS) == pytest.approx(81.6)
+        assert estimate_items([]) == 0.0
+
+    def test_report_per_order_and_filtered_view(self):
+        frame = self._frame((100, "Mario", self.ITEMS[:1]), (101, "Anna", self.ITEMS[1:]))
+        report = revenue_report(frame)
+        assert report.by_order == {100: 23.6, 101: 58.0}
+        assert report.total == pytest.approx(81.6)
+        assert report.amount(frame[frame["cliente"] == "Anna"]) == pytest.approx(58.0)
+
+    def test_stored_item_price_wins_over_menu(self):
+        """Past orders keep the price they were taken at, even for dishes since removed."""
+        items = [
+            {**self.ITEMS[0], "price": 5.00},  # menu now says 5.90/etto
+            {**self.ITEMS[3], "price": 2.00},  # no longer in the menu: 600 g × 2.00/etto
+            self.ITEMS[2],  # no stored price: current menu
+        ]
+        assert estimate_items(items) == pytest.approx(20.0 + 12.0 + 32.0)
+
+        table = OrdersTable([{"order_id": 100, "customer": "Mario", "contact": "", "note": "", "items": items}])
+        assert line_amounts(table.to_frame(), table.line_prices()).tolist() == [20.0, 12.0, 32.0]
+        assert revenue_report(table.to_frame(), table.line_prices()).by_order == {100: 64.0}
+
+    def test_line_prices_follow_edits_and_deletes(self):
+        priced = [{**self.ITEMS[0], "price": 5.00}]
+        table = OrdersTable([
+            {"order_id": 100, "customer": "Mario", "contact": "", "note": "", "items": priced},
+            {"order_id": 101, "customer": "Anna", "contact": "", "note": "", "items": self.ITEMS[:2]},
+        ])
+        table.upsert_order({"order_id": 101, "customer": "Anna", "contact": "", "note": "", "items": [{**self.ITEMS[2], "price": 15.0}]})
+        table.remove_order(100)
+        assert table.line_prices().tolist() == [15.0]
+        assert len(table.to_frame()) == 1
+
+    def test_breakdown_by_category(self):
+        frame = self._frame((100, "Mario", self.ITEMS), (101, "Anna", self.ITEMS[:1]))
+        table = revenue_breakdown(frame, line_amounts(frame), ["categoria"]).set_index("categoria")
+        assert table.loc["Antipasti", "importo"] == pytest.approx(73.2)
+        assert table.loc["Antipasti", "ordini"] == 2
+        assert table.loc["Crudi", "importo"] == pytest.approx(32.0)
+
+
+class TestPickupSlots:
+    """Test pickup slot calendar, capacity index and pick list"""
+
+    def _order(self, order_id, pickup, qty=1, portion=2):
+        return {
+            "order_id": order_id,
+            "order_number": str(order_id),
+            "customer": f"Cliente {order_id}",
+            "contact": "333",
+            "note": "",
+            "pickup": pickup,
+            "items": [{"category": "Antipasti", "dish": "Insalata di mare", "portion": portion, "qty": qty}],
+        }
+
+    def test_calendar_has_15_minute_windows(self):
+        slots = pickup_calendar(days=("2025-12-24",), hours=(("09:00", "10:00"),))
+        assert slots == ("2025-12-24 09:00", "2025-12-24 09:15", "2025-12-24 09:30", "2025-12-24 09:45")
+        assert list(PICKUP_SLOTS) == sorted(PICKUP_SLOTS)
+
+    def test_load_follows_edits_and_deletes(self):
+        first = self._order(100, "2025-12-24 11:00", qty=3)
+        index = PickupSlotIndex([first, self._order(101, "2025-12-24 11:00"), self._order(102, "")])
+        assert index.load("2025-12-24 11:00") == (4, 8)
+
+        moved = self._order(100, "2025-12-24 11:15", qty=3)
+        index.replace_order(first, moved)
+        assert index.load("2025-12-24 11:00") == (1, 2)
+        assert index.load("2025-12-24 11:15") == (3, 6)
+        assert index.load("2025-12-24 11:15", exclude=moved) == (0, 0)
+
+        index.remove_order(moved)
+        assert "2025-12-24 11:15" not in index.orders_by_slot
+
+    def test_nearest_free_slot(self):
+        index = PickupSlotIndex([self._order(100, "2025-12-24 11:00", qty=20)])
+        assert not index.fits("2025-12-24 11:00", 1, 2)
+        assert index.nearest_free("2025-12-24 11:00", 1, 2) == "2025-12-24 11:15"
+        assert index.nearest_free("2025-12-24 10:45", 1, 2) == "2025-12-24 10:45"
+        assert index.nearest_free("2025-12-24 11:00", 1, 2, slots=("2025-12-24 10:45", "2025-12-24 11:00")) == "2025-12-24 10:45"
+        assert index.nearest_free("2025-12-24 11:00", 21, 2) is None
+
+    def test_pick_list_in_slot_order(self):
+        orders = [
+            self._order(100, "2025-12-24 12:00"),
+            self._order(101, "2025-12-23 09:00"),
+            self._order(102, "2025-12-24 09:30"),
+            self._order(103, ""),
+        ]
+        index = PickupSlotIndex(orders)
+        order_index = OrderIndex(orders)
+        assert pick_list_frame(index, order_index)["ordine"].tolist() == ["101", "102", "100"]
+        assert pick_list_frame(index, order_index, "2025-12-24")["ordine"].tolist() == ["102", "100"]
+        assert pick_list_frame(index, order_index, "2025-12-31").empty
+
+    def test_store_keeps_pickup(self, store, sample_order):
+        store.create_order(100, "Mario", "333", "", sample_order["items"], pickup="2025-12-24 11:00")
+        assert store.get_order(100)["pickup"] == "2025-12-24 11:00"
+        store.update_order(100, "Mario", "333", "", sample_order["items"], pickup="2025-12-24 11:30")
+        assert store.list_orders()[0]["pickup"] == "2025-12-24 11:30"
+
+
+class TestDishCaps:
+    """Test per-dish caps and the shared reservation counters"""
+
+    DISH = ("Antipasti", "Insalata di mare")
+
+    def _items(self, qty, portion=2):
+        return [{"category": self.DISH[0], "dish": self.DISH[1], "portion": portion, "qty": qty}]
+
+    def test_reservations_count_season_and_pickup_day(self):
+        assert order_reservations(self._items(2), "2025-12-24 11:00") == {
+            (*self.DISH, ""): 4,
+            (*self.DISH, "2025-12-24"): 4,
+        }
+        assert order_reservations(self._items(1)) == {(*self.DISH, ""): 2}
+
+    def test_counters_follow_writes(self, store):
+        store.replace_dish_caps([{"category": self.DISH[0], "dish": self.DISH[1], "cap": 10}])
+        store.create_order(100, "Mario", "333", "", self._items(2))
+        assert store.availability(*self.DISH) == {"": 6}
+        store.update_order(100, "Mario", "333", "", self._items(1))
+        assert store.availability(*self.DISH) == {"": 8}
+        store.delete_order(100)
+        assert store.availability(*self.DISH) == {"": 10}
+        assert store.availability("Antipasti", "Insalata russa con gamberi") == {}
+
+    def test_over_cap_write_is_rolled_back(self, store):
+        store.replace_dish_caps([{"category": self.DISH[0], "dish": self.DISH[1], "cap": 4}])
+        store.create_order(100, "Mario", "333", "", self._items(1))
+        with pytest.raises(SoldOutError) as excinfo:
+            store.create_order(101, "Anna", "333", "", self._items(2))
+        assert excinfo.value.shortages == [(*self.DISH, "", 2)]
+        assert store.get_order(101) is None
+        assert store.availability(*self.DISH) == {"": 2}
+
+    def test_editing_keeps_own_reservation(self, store):
+        store.create_order(100, "Mario", "333", "", self._items(2))
+        store.replace_dish_caps([{"category": self.DISH[0], "dish": self.DISH[1], "cap": 3}])
+        # Already above a lowered cap: edits that do not add covers still go through
+        assert store.update_order(100, "Mario", "333", "nota", self._items(2))
+        with pytest.raises(SoldOutError):
+            store.update_order(100, "Mario", "333", "", self._items(3))
+
+    def test_day_cap_only_counts_that_day(self, store):
+        store.replace_dish_caps([{"category": self.DISH[0], "dish": self.DISH[1], "day": "2025-12-24", "cap": 4}])
+        store.create_order(100, "Mario", "333", "", self._items(2), pickup="2025-12-24 10:00")
+        store.create_order(101, "Anna", "333", "", self._items(5), pickup="2025-12-23 10:00")
+        assert store.availability(*self.DISH, day="2025-12-24") == {"2025-12-24": 0}
+        assert store.availability_map("2025-12-24") == {self.DISH: 0}
+        assert store.availability_map("2025-12-23") == {}
+
+    def test_restore_rebuilds_counters(self, tmp_path, store):
+        store.create_order(100, "Mario", "333", "", self._items(2), pickup="2025-12-24 10:00")
+        restored = OrderStore(tmp_path / "restored.sqlite3")
+        restored.restore(store.export_state())
+        restored.replace_dish_caps([{"category": self.DISH[0], "dish": self.DISH[1], "cap": 10}])
+        assert restored.list_dish_caps()[0]["reserved"] == 4
+        restored.close()
+
+
+class TestCustomerIndex:
+    """Test the Rubrica search index"""
+
+    @pytest.fixture
+    def index(self):
+        return CustomerIndex([
+            {"id": 1, "name": "Niccolò D'Amico", "contact": "+39 333 123 4567", "note": ""},
+            {"id": 2, "name": "Mario Rossi", "contact": "mario.rossi@example.it", "note": ""},
+            {"id": 3, "name": "Maria Rossini", "contact": "340 111 2223", "note": ""},
+        ])
+
+    def _ids(self, index, query):
+        return [customer["id"] for customer in index.search(query)]
+
+    def test_fold_text(self):
+        assert fold_text("  Niccolò D'Amico ") == "niccolo d amico"
+
+    def test_accent_folded_prefix(self, index):
+        assert self._ids(index, "NICCOLO") == [1]
+        assert self._ids(index, "amic") == [1]
+
+    def test_exact_word_ranks_before_prefix(self, index):
+        assert self._ids(index, "rossi") == [2, 3]
+        assert self._ids(index, "maria ross") == [3]
+        # Same score: shorter name first
+        assert self._ids(index, "mari ross") == [2, 3]
+
+    def test_suggestions_are_top_k(self, index):
+        """The order form typeahead asks for a few best matches only."""
+        assert [c["id"] for c in index.search("ross", limit=1)] == [2]
+        assert [c["id"] for c in index.search("333 123", limit=5)] == [1]
+
+    def test_substring_and_phone_digits(self, index):
+        assert self._ids(index, "ossin") == [3]
+        assert self._ids(index, "123 45") == [1]
+        assert self._ids(index, "example") == [2]
+
+    def test_every_word_must_match(self, index):
+        assert self._ids(index, "mario rossini") == []
+        assert self._ids(index, "") == []
+
+    def test_incremental_updates(self, index):
+        index.upsert({"id": 2, "name": "Mario Bianchi", "contact": "", "note": ""})
+        assert self._ids(index, "rossi") == [3]
+        assert self._ids(index, "bian") == [2]
+        index.remove(3)
+        assert self._ids(index, "ross") == []
+        assert len(index) == 2
+        assert [customer["id"] for customer in index] == [1, 2]
+
+
+class TestCustomerOrders:
+    """Test the customer → orders join index"""
+
+    ITEMS = [{"category": "Crudi", "dish": "Tartare tonno 120gr", "portion": 1, "qty": 1}]  # €16.00
+
+    def _order(self, order_id, customer_id, created_at="2025-12-20T10:00:00", customer="Mario"):
+        return {
+            "order_id": order_id,
+            "customer": customer,
+            "customer_id": customer_id,
+            "created_at": created_at,
+            "items": self.ITEMS,
+        }
+
+    def test_stats_per_customer(self):
+        index = CustomerOrdersIndex([
+            self._order(100, 1, "2025-12-20T10:00:00"),
+            self._order(101, 1, "2025-12-22T09:00:00"),
+            self._order(102, None),
+        ])
+        stats = index.stats(1)
+        assert (stats.orders, stats.last_order_at, stats.spend) == (2, "2025-12-22T09:00:00", 32.0)
+        assert index.stats(2).orders == 0
+        assert index.order_ids(1) == [100, 101]
+
+    def test_bulk_amounts_are_used(self):
+        index = CustomerOrdersIndex([self._order(100, 1)], amounts={100: 5.0})
+        assert index.stats(1).spend == 5.0
+
+    def test_relink_and_remove(self):
+        first = self._order(100, 1, "2025-12-22T09:00:00")
+        index = CustomerOrdersIndex([first, self._order(101, 1, "2025-12-20T10:00:00")])
+        index.replace_order(first, self._order(100, 2, "2025-12-22T09:00:00", customer="Mario R."))
+        assert index.stats(1).orders == 1
+        assert index.stats(1).last_order_at == "2025-12-20T10:00:00"
+        assert index.stats(2).orders == 1
+        index.remove_order(self._order(101, 1))
+        assert index.stats(1).orders == 0
+
+    def test_store_keeps_customer_link_across_renames(self, store):
+        customer_id = store.create_customer("Mario Rossi", "333", "")
+        store.create_order(100, "Mario Rossi", "333", "", self.ITEMS, customer_id=customer_id)
+        store.update_customer(customer_id, "Mario Rossi Jr", "333", "")
+        order = store.get_order(100)
+        assert order["customer_id"] == customer_id
+        assert order["created_at"]
+        store.delete_customer(customer_id)
+        assert store.get_order(100)["customer_id"] is None
+
+    def test_deleting_customer_logs_unlinked_orders(self, store):
+        """Sessions re-read orders whose link the delete cleared, so no dead ID is saved back."""
+        customer_id = store.create_customer("Mario Rossi", "333", "")
+        store.create_order(100, "Mario Rossi", "333", "", self.ITEMS, customer_id=customer_id)
+        version = store.data_version()
+        store.delete_customer(customer_id)
+        assert ("order", 100, "saved") in store.changes_since(version)
+        order = store.get_order(100)
+        assert order["customer_id"] is None
+        assert store.update_order(100, order["customer"], order["contact"], "", self.ITEMS, customer_id=order["customer_id"])
+
+    def test_match_exact_customer(self):
+        customers = CustomerIndex([
+            {"id": 1, "name": "Mario Rossi", "contact": "333 1234567", "note": ""},
+            {"id": 2, "name": "Mario Rossi", "contact": "340 7654321", "note": ""},
+        ])
+        assert customers.match("mario rossi", "3331234567") == 1
+        assert customers.match("Mario", "3331234567") is None
+        assert customers.match("Mario Rossi", "") is None
+
+
+class TestCustomerDedupe:
+    """Test phone normalization, the duplicate-phone index and the merge pass"""
+
+    @pytest.mark.parametrize("contact", ["333 123 4567", "+39 333-1234567", "0039 3331234567", "39 3331234567"])
+    def test_phone_key_normalizes_italian_formats(self, contact):
+        assert phone_key(contact) == "+393331234567"
+
+    @pytest.mark.parametrize("contact", ["", "mario@rossi.it", "int. 12", "vedi note"])
+    def test_phone_key_ignores_non_phones(self, contact):
+        assert phone_key(contact) == ""
+
+    def test_same_phone_lookup_follows_edits(self):
+        customers = CustomerIndex([
+            {"id": 1, "name": "Rossi", "contact": "333 1234567", "note": ""},
+            {"id": 2, "name": "Anna Bianchi", "contact": "340 1112222", "note": ""},
+        ])
+        assert [c["id"] for c in customers.same_phone("+39 3331234567")] == [1]
+        assert customers.same_phone("333 1234567", exclude=1) == []
+        customers.upsert({"id": 1, "name": "Rossi", "contact": "347 0000000", "note": ""})
+        assert customers.same_phone("333 1234567") == []
+        customers.remove(2)
+        assert customers.same_phone("340 1112222") == []
+        assert [c["id"] for c in customers] == [1]
+
+    def test_proposals_group_same_person(self):
+        customers = [
+            {"id": 1, "name": "Rossi", "contact": "333 1234567", "note": ""},
+            {"id": 2, "name": "ROSSI Mario", "contact": "+39 333-1234567", "note": ""},
+            {"id": 3, "name": "Mario Rossi", "contact": "", "note": ""},
+            {"id": 4, "name": "Mario Rossi", "contact": "340 1112222", "note": ""},
+            {"id": 5, "name": "Anna Bianchi", "contact": "333 1234567", "note": ""},
+        ]
+        proposals = dedupe_proposals(customers, order_counts=lambda customer_id: 2 if customer_id == 1 else 0)
+        assert [(p.keep, p.duplicates) for p in proposals] == [(1, (2, 3))]
+        assert 0.75 <= proposals[0].score <= 1
+
+    def test_keeper_defaults_to_fullest_name(self):
+        customers = [
+            {"id": 1, "name": "Rossi", "contact": "333 1234567", "note": ""},
+            {"id": 2, "name": "Mario Rossi", "contact": "3331234567", "note": ""},
+        ]
+        assert dedupe_proposals(customers)[0].keep == 2
+
+    def test_merge_repoints_orders(self, tmp_path, sample_order):
+        journal = OrderJournal(tmp_path / "journal")
+        store = OrderStore(tmp_path / "ordini.sqlite3", journal=journal)
+        keep = store.create_customer("Mario Rossi", "", "")
+        duplicate = store.create_customer("Rossi", "333 1234567", "senza glutine")
+        store.create_order(100, "Rossi", "333 1234567", "", sample_order["items"], customer_id=duplicate)
+        version = store.data_version()
+
+        assert store.merge_customers(keep, [duplicate]) == 1
+        assert store.get_order(100)["customer_id"] == keep
+        assert store.get_customer(duplicate) is None
+        assert store.get_customer(keep)["contact"] == "333 1234567"
+        assert store.get_customer(keep)["note"] == "senza glutine"
+        assert ("order", 100, "saved") in store.changes_since(version)
+        store.close()
+
+        replayed = OrderJournal(tmp_path / "journal").state
+        assert replayed["orders"][100]["customer_id"] == keep
+        assert list(replayed["customers"]) == [keep]
+
+
+class TestFrameFilterIndex:
+    """Test the Dashboard bitmap filters against plain pandas masks"""
+
+    @pytest.fixture
+    def frame(self, sample_orders):
+        table = OrdersTable(sample_orders)
+        # An edit re-appends the order's rows, so the frame is no longer sorted by order ID
+        table.upsert_order({**sample_orders[0], "items": sample_orders[0]["items"][:1]})
+        return table.to_frame()
+
+    def _expected(self, frame, equals, order_range):
+        mask = (frame["ordine"] >= order_range[0]) & (frame["ordine"] <= order_range[1])
+        for column, value in equals.items():
+            mask &= frame[column] == value
+        return frame[mask]
+
+    @pytest.mark.parametrize(
+        "equals, order_range",
+        [
+            ({}, (101, 102)),
+            ({"cliente": "Mario Rossi"}, (100, 102)),
+            ({"categoria": "Antipasti", "cliente": "Mario Rossi"}, (100, 101)),
+            ({"piatto": "Insalata russa"}, (0, 10_000)),
+            ({"cliente": "Nessuno"}, (100, 102)),
+        ],
+    )
+    def test_select_matches_pandas(self, frame, equals, order_range):
+        selected = FrameFilterIndex(frame).select(equals, order_range)
+        pd.testing.assert_frame_equal(selected, self._expected(frame, equals, order_range))
+
+    def test_no_filter_returns_frame_itself(self, frame):
+        filters = FrameFilterIndex(frame)
+        assert filters.select({}, filters.order_bounds) is frame
+
+    def test_options_and_bounds(self, frame):
+        filters = FrameFilterIndex(frame)
+        assert filters.options["cliente"] == ["Giulia Bianchi", "Mario Rossi"]
+        assert filters.options["categoria"] == sorted(frame["categoria"].astype(str).unique())
+        assert filters.order_bounds == (100, 102)
+
+    def test_bitmaps_are_shared_and_read_only(self, frame):
+        filters = FrameFilterIndex(frame)
+        bitmap = filters.bitmap("cliente", "Mario Rossi")
+        assert filters.bitmap("cliente", "Mario Rossi") is bitmap
+        assert not bitmap.flags.writeable
+
+
+class TestOrderCube:
+    """Test the Dashboard cube against the row-level pandas functions"""
+
+    @pytest.fixture
+    def orders(self, sample_orders):
+        pickups = ["2025-12-24 10:00", "2025-12-24 11:30", ""]
+        return [{**order, "pickup": pickup} for order, pickup in zip(sample_orders, pickups)]
+
+    def _check(self, cube, orders, equals):
+        frame = OrdersTable(orders).to_frame()
+        mask = pd.Series(True, index=frame.index)
+        for column, value in equals.items():
+            mask &= frame[column] == value
+        rows = frame[mask]
+        lines = line_amounts(frame)
+        view = cube.query(**equals)
+
+        assert (view.ordini, view.vassoi, view.coperti) == (rows["ordine"].nunique(), rows["vassoi"].sum(), rows["coperti"].sum())
+        assert view.importo == pytest.approx(lines[mask].sum())
+        totals_df, freq_df = totals_and_freq_from_df(rows)
+        pd.testing.assert_frame_equal(view.totals, totals_df.reset_index(drop=True), check_dtype=False, check_categorical=False)
+        pd.testing.assert_frame_equal(view.freq, freq_df.reset_index(drop=True), check_dtype=False, check_categorical=False)
+        for by, got in ((["categoria"], view.by_category), (["cliente", "contatto"], view.by_customer)):
+            expected = revenue_breakdown(rows, lines, by).sort_values(by, ignore_index=True)
+            pd.testing.assert_frame_equal(got, expected, check_dtype=False, check_categorical=False)
+
+    @pytest.mark.parametrize(
+        "equals",
+        [{}, {"cliente": "Mario Rossi"}, {"categoria": "Antipasti"}, {"piatto": "Insalata russa", "cliente": "Giulia Bianchi"}],
+    )
+    def test_matches_row_level_figures(self, orders, equals):
+        self._check(OrderCube(orders), orders, equals)
+
+    def test_patches_keep_figures_exact(self, orders):
+        cube = OrderCube(orders)
+        cube.query()  # memoised answers must be dropped on change
+        edited = {**orders[0], "items": orders[0]["items"][:1], "customer": "Mario R."}
+        cube.replace_order(orders[0], edited)
+        cube.remove_order(orders[2])
+        current = [edited, orders[1]]
+        self._check(cube, current, {})
+        self._check(cube, current, {"cliente": "Mario Rossi"})
+        assert len(cube) == len(OrderCube(current))
+
+    def test_pickup_days(self, orders):
+        cube = OrderCube(orders)
+        by_day = cube.query().by_day
+        assert by_day["giorno"].tolist() == ["", "2025-12-24"]
+        assert by_day["ordini"].tolist() == [1, 2]
+        assert cube.query(giorno="2025-12-24", categoria="Antipasti").vassoi == 2
+
+    def test_production_plan_from_cube_totals(self, orders):
+        """Production yields are linear in trays, so the cube totals give the same plan as the rows."""
+        plan = production_plan(OrderCube(orders).query().totals)
+        pd.testing.assert_frame_equal(plan, production_plan(OrdersTable(orders).to_frame()), check_dtype=False)
+
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # RUN TESTS
 # ═══════════════════════════════════════════════════════════════════════════════